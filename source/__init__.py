@@ -31,6 +31,81 @@ import importlib
 
 
 if "bpy" in locals():
+    if "meshArrays" in locals():
+        importlib.reload(meshArrays)
+    else:
+        from .ops import meshArrays
+        
+    if "normalLayers" in locals():
+        importlib.reload(normalLayers)
+    else:
+        from .ops import normalLayers
+        
+    if "profiler" in locals():
+        importlib.reload(profiler)
+    else:
+        from .ops import profiler
+        
+    if "strokeRecord" in locals():
+        importlib.reload(strokeRecord)
+    else:
+        from .ops import strokeRecord
+        
+    if "transferNormals" in locals():
+        importlib.reload(transferNormals)
+    else:
+        from .ops import transferNormals
+        
+    if "falloff" in locals():
+        importlib.reload(falloff)
+    else:
+        from .ops import falloff
+        
+    if "brushMath" in locals():
+        importlib.reload(brushMath)
+    else:
+        from .ops import brushMath
+        
+    if "meshCache" in locals():
+        importlib.reload(meshCache)
+    else:
+        from .ops import meshCache
+        
+    if "occlusion" in locals():
+        importlib.reload(occlusion)
+    else:
+        from .ops import occlusion
+        
+    if "overlay" in locals():
+        importlib.reload(overlay)
+    else:
+        from .ops import overlay
+        
+    if "recoveryJournal" in locals():
+        importlib.reload(recoveryJournal)
+    else:
+        from .ops import recoveryJournal
+        
+    if "normalFiles" in locals():
+        importlib.reload(normalFiles)
+    else:
+        from .ops import normalFiles
+        
+    if "bakeNormals" in locals():
+        importlib.reload(bakeNormals)
+    else:
+        from .ops import bakeNormals
+        
+    if "curveBrush" in locals():
+        importlib.reload(curveBrush)
+    else:
+        from .ops import curveBrush
+        
+    if "fillBrush" in locals():
+        importlib.reload(fillBrush)
+    else:
+        from .ops import fillBrush
+        
     if "normalTool" in locals():
         importlib.reload(normalTool)
     else:
@@ -42,15 +117,44 @@ if "bpy" in locals():
         from .ops import fixSeamNormals
         
 else:
+    from .ops import meshArrays
+    from .ops import normalLayers
+    from .ops import profiler
+    from .ops import strokeRecord
+    from .ops import transferNormals
+    from .ops import falloff
+    from .ops import brushMath
+    from .ops import meshCache
+    from .ops import occlusion
+    from .ops import overlay
+    from .ops import recoveryJournal
+    from .ops import normalFiles
+    from .ops import bakeNormals
+    from .ops import curveBrush
+    from .ops import fillBrush
     from .ops import normalTool
     from .ops import fixSeamNormals
 
 def register():
     normalTool.register()
     fixSeamNormals.register()
+    transferNormals.register()
+    curveBrush.register()
+    fillBrush.register()
+    recoveryJournal.register()
+    normalFiles.register()
+    normalLayers.register()
+    bakeNormals.register()
 
 
 def unregister():
     normalTool.unregister()
     fixSeamNormals.unregister()
+    transferNormals.unregister()
+    curveBrush.unregister()
+    fillBrush.unregister()
+    recoveryJournal.unregister()
+    normalFiles.unregister()
+    normalLayers.unregister()
+    bakeNormals.unregister()
 
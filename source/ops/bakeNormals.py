@@ -0,0 +1,177 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import importlib
+import os
+import sys
+import time
+import numpy as np
+
+from . import meshArrays
+
+#Worker processes start without bpy and cannot import the add-on package, so the rasterizer
+# is imported as a top level module from this directory and the pool uses that copy.
+def tile_module():
+    ops_dir = os.path.dirname(os.path.abspath(__file__))
+    if ops_dir not in sys.path:
+        sys.path.append(ops_dir)
+    return importlib.import_module("bakeTiles")
+
+#Per loop arrays of a mesh for the bake.  The tangent frame comes from the named UV map.
+#Returns (uvs, attributes, triangle loops)
+def read_bake_data(mesh, uv_map):
+    tiles = tile_module()
+
+    uvs = np.empty(len(mesh.loops) * 2, dtype = np.float32)
+    mesh.uv_layers[uv_map].data.foreach_get("uv", uvs)
+
+    #Raises RuntimeError if the mesh has faces with more than four sides
+    mesh.calc_tangents(uvmap = uv_map)
+    try:
+        tangents = np.empty(len(mesh.loops) * 3, dtype = np.float32)
+        mesh.loops.foreach_get("tangent", tangents)
+        signs = np.empty(len(mesh.loops), dtype = np.float32)
+        mesh.loops.foreach_get("bitangent_sign", signs)
+    finally:
+        mesh.free_tangents()
+
+    loop_verts = meshArrays.read_loop_vertex_indices(mesh)
+    attrs = tiles.loop_attributes(
+        meshArrays.read_loop_normals(mesh),
+        meshArrays.read_vertex_normals(mesh)[loop_verts],
+        tangents.reshape(-1, 3),
+        signs)
+    tri_loops, tri_verts = meshArrays.read_loop_triangles(mesh)
+    return uvs.reshape(-1, 2), attrs, tri_loops
+
+#Bake the custom normals of obj into a tangent space normal map image.  Works in background mode.
+#processes - worker processes to use.  1 bakes in this process and 0 uses one per CPU.
+#filepath - if given, the image is also saved to this file
+#Returns the image
+def bake_normal_map(obj, width, height, uv_map = None, margin = 4, processes = 0, flip_green = False, filepath = None):
+    mesh = obj.data
+    if uv_map == None:
+        if mesh.uv_layers.active == None:
+            raise ValueError(obj.name + " has no UV map")
+        uv_map = mesh.uv_layers.active.name
+
+    uvs, attrs, tri_loops = read_bake_data(mesh, uv_map)
+    pixels = tile_module().bake_image(uvs, attrs, tri_loops, width, height, margin = margin, processes = processes, flip_green = flip_green)
+
+    name = obj.name + "_normal"
+    image = bpy.data.images.get(name)
+    if image != None and tuple(image.size) != (width, height):
+        bpy.data.images.remove(image)
+        image = None
+    if image == None:
+        image = bpy.data.images.new(name, width, height, alpha = False)
+    image.colorspace_settings.name = 'Non-Color'
+    image.pixels.foreach_set(pixels.ravel())
+    image.update()
+
+    if filepath:
+        image.filepath_raw = filepath
+        image.file_format = 'OPEN_EXR' if os.path.splitext(filepath)[1].lower() == ".exr" else 'PNG'
+        image.save()
+    return image
+
+#---------------------------
+
+class BakeNormalMapOperator(bpy.types.Operator):
+    """Bake the custom normals of the active mesh into a tangent space normal map on the CPU"""
+    bl_idname = "kitfox.nt_bake_normal_map"
+    bl_label = "Bake Normal Map"
+    bl_options = {"REGISTER", "UNDO"}
+
+    width : bpy.props.IntProperty(
+        name = "Width",
+        description = "Width of the normal map in pixels",
+        default = 1024,
+        min = 1,
+        soft_max = 8192
+    )
+
+    height : bpy.props.IntProperty(
+        name = "Height",
+        description = "Height of the normal map in pixels",
+        default = 1024,
+        min = 1,
+        soft_max = 8192
+    )
+
+    margin : bpy.props.IntProperty(
+        name = "Margin",
+        description = "Pixels the edges of each UV island are extended by",
+        default = 4,
+        min = 0,
+        soft_max = 64
+    )
+
+    processes : bpy.props.IntProperty(
+        name = "Processes",
+        description = "Number of worker processes.  0 uses one per CPU",
+        default = 0,
+        min = 0,
+        soft_max = 64
+    )
+
+    flip_green : bpy.props.BoolProperty(
+        name = "Flip Green (DirectX)",
+        description = "Point the green channel down, for engines that use DirectX style normal maps",
+        default = False
+    )
+
+    filepath : bpy.props.StringProperty(
+        name = "File Path",
+        description = "File to save the normal map to.  Leave blank to only create the image",
+        default = "",
+        subtype = 'FILE_PATH'
+    )
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj != None and obj.type == 'MESH' and obj.mode == 'OBJECT'
+
+    def execute(self, context):
+        obj = context.active_object
+        start = time.perf_counter()
+        try:
+            image = bake_normal_map(obj, self.width, self.height, margin = self.margin, processes = self.processes,
+                flip_green = self.flip_green, filepath = bpy.path.abspath(self.filepath) if self.filepath else None)
+        except (RuntimeError, ValueError, OSError) as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, "Baked %s in %.2f s" % (image.name, time.perf_counter() - start))
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+#---------------------------
+
+def register():
+    bpy.utils.register_class(BakeNormalMapOperator)
+
+
+def unregister():
+    bpy.utils.unregister_class(BakeNormalMapOperator)
+
+
+if __name__ == "__main__":
+    register()
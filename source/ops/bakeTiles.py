@@ -0,0 +1,190 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+#Rasterizes per-loop normals into a tangent space normal map on the CPU.  Only needs numpy so it
+# can run in worker processes that do not have bpy.
+
+import concurrent.futures
+import multiprocessing
+import numpy as np
+
+#Width and height of the tiles the image is split into for the workers
+TILE_SIZE = 128
+
+#Barycentric coordinates this far outside a triangle still count as inside, so texels on shared edges are not missed
+EDGE_EPSILON = 1e-6
+
+#Per loop attributes interpolated across each triangle, in this order
+ATTR_NORMAL = slice(0, 3)
+ATTR_VERT_NORMAL = slice(3, 6)
+ATTR_TANGENT = slice(6, 9)
+ATTR_BITANGENT = slice(9, 12)
+ATTR_COUNT = 12
+
+
+#Tangent frame of every loop.  The tangent is made perpendicular to the vertex normal so the map
+# is relative to the shading the mesh has without custom normals.
+#Returns (loops, ATTR_COUNT) float32 array of attributes for bake_image()
+def loop_attributes(normals, vert_normals, tangents, bitangent_signs):
+    tangents = tangents - vert_normals * np.einsum('ij,ij->i', tangents, vert_normals)[:, None]
+    tangents /= np.maximum(np.linalg.norm(tangents, axis = 1), 1e-12)[:, None]
+    bitangents = np.cross(vert_normals, tangents) * bitangent_signs[:, None]
+    return np.concatenate((normals, vert_normals, tangents, bitangents), axis = 1).astype(np.float32)
+
+#Rasterize the triangles overlapping one tile
+#x0, y0, width, height - pixel rectangle of the tile
+#tri_uvs - (n, 3, 2) pixel coordinates of triangle corners
+#tri_attrs - (n, 3, ATTR_COUNT) attributes of triangle corners
+#Returns (x0, y0, normals, covered) where normals is a (height, width, 3) tangent space array and covered a (height, width) bool array
+def bake_tile(x0, y0, width, height, tri_uvs, tri_attrs):
+    normals = np.zeros((height, width, 3), dtype = np.float32)
+    covered = np.zeros((height, width), dtype = bool)
+
+    #Texel range of each triangle's bounding box, clipped to the tile
+    lo = np.ceil(tri_uvs.min(axis = 1) - .5).astype(np.int64) - (x0, y0)
+    hi = np.floor(tri_uvs.max(axis = 1) - .5).astype(np.int64) - (x0, y0)
+    lo = np.maximum(lo, 0)
+    hi = np.minimum(hi, (width - 1, height - 1))
+    spans = np.maximum(hi - lo + 1, 0)
+    counts = spans[:, 0] * spans[:, 1]
+
+    #One entry for every (triangle, texel in its bounding box) pair
+    tri = np.repeat(np.arange(len(tri_uvs)), counts)
+    if len(tri) == 0:
+        return x0, y0, normals, covered
+    local = np.arange(len(tri)) - np.repeat(np.cumsum(counts) - counts, counts)
+    px = lo[tri, 0] + local % spans[tri, 0]
+    py = lo[tri, 1] + local // spans[tri, 0]
+
+    #Barycentric coordinates of texel centers
+    a = tri_uvs[tri, 0]
+    e1 = tri_uvs[tri, 1] - a
+    e2 = tri_uvs[tri, 2] - a
+    dx = px + x0 + .5 - a[:, 0]
+    dy = py + y0 + .5 - a[:, 1]
+    denom = e1[:, 0] * e2[:, 1] - e2[:, 0] * e1[:, 1]
+    valid = np.abs(denom) > 1e-12
+    denom = np.where(valid, denom, 1)
+    b1 = (dx * e2[:, 1] - e2[:, 0] * dy) / denom
+    b2 = (e1[:, 0] * dy - dx * e1[:, 1]) / denom
+    b0 = 1 - b1 - b2
+    inside = valid & (b0 >= -EDGE_EPSILON) & (b1 >= -EDGE_EPSILON) & (b2 >= -EDGE_EPSILON)
+
+    tri = tri[inside]
+    px = px[inside]
+    py = py[inside]
+    bary = np.stack((b0[inside], b1[inside], b2[inside]), axis = 1).astype(np.float32)
+
+    attrs = np.einsum('ij,ijk->ik', bary, tri_attrs[tri])
+    normal = attrs[:, ATTR_NORMAL]
+    normal /= np.maximum(np.linalg.norm(normal, axis = 1), 1e-12)[:, None]
+    #Like MikkTSpace, the interpolated frame is used without normalizing it again
+    tangent_space = np.stack((
+        np.einsum('ij,ij->i', normal, attrs[:, ATTR_TANGENT]),
+        np.einsum('ij,ij->i', normal, attrs[:, ATTR_BITANGENT]),
+        np.einsum('ij,ij->i', normal, attrs[:, ATTR_VERT_NORMAL])), axis = 1)
+    tangent_space /= np.maximum(np.linalg.norm(tangent_space, axis = 1), 1e-12)[:, None]
+
+    #Where UV islands overlap, the last triangle wins
+    normals[py, px] = tangent_space
+    covered[py, px] = True
+    return x0, y0, normals, covered
+
+#Spread the edge texels of each UV island outward by margin texels so filtering does not bleed in the background
+def dilate(normals, covered, margin):
+    for i in range(margin):
+        total = np.zeros_like(normals)
+        count = np.zeros(covered.shape, dtype = np.float32)
+        for axis, shift in ((0, 1), (0, -1), (1, 1), (1, -1)):
+            total += np.roll(normals * covered[..., None], shift, axis = axis)
+            count += np.roll(covered, shift, axis = axis)
+
+        #np.roll wraps around, which is what tiling textures want anyway
+        grow = ~covered & (count > 0)
+        if not np.any(grow):
+            break
+        normals[grow] = total[grow] / count[grow, None]
+        normals[grow] /= np.maximum(np.linalg.norm(normals[grow], axis = 1), 1e-12)[:, None]
+        covered |= grow
+
+#(tile index, triangles) for every tile that some triangle overlaps
+def bin_triangles(tri_uvs, width, height, tile_size):
+    tiles_x = -(-width // tile_size)
+    tiles_y = -(-height // tile_size)
+    lo = np.clip(np.floor(tri_uvs.min(axis = 1) // tile_size).astype(np.int64), 0, (tiles_x - 1, tiles_y - 1))
+    hi = np.clip(np.floor(tri_uvs.max(axis = 1) // tile_size).astype(np.int64), 0, (tiles_x - 1, tiles_y - 1))
+
+    #Triangles entirely outside the image are skipped
+    inside = np.all(tri_uvs.max(axis = 1) >= 0, axis = 1) & (tri_uvs.min(axis = 1)[:, 0] < width) & (tri_uvs.min(axis = 1)[:, 1] < height)
+    spans = (hi - lo + 1) * inside[:, None]
+    counts = spans[:, 0] * spans[:, 1]
+
+    tri = np.repeat(np.arange(len(tri_uvs)), counts)
+    local = np.arange(len(tri)) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile = (lo[tri, 1] + local // spans[tri, 0]) * tiles_x + lo[tri, 0] + local % spans[tri, 0]
+
+    order = np.argsort(tile, kind = 'stable')
+    tile = tile[order]
+    tri = tri[order]
+    starts = np.flatnonzero(np.r_[True, tile[1:] != tile[:-1]]) if len(tile) else np.zeros(0, dtype = np.int64)
+    ends = np.r_[starts[1:], len(tile)]
+    return tiles_x, [(int(tile[s]), tri[s:e]) for s, e in zip(starts, ends)]
+
+#Bake a tangent space normal map
+#uvs - (loops, 2) UV coordinates
+#attrs - (loops, ATTR_COUNT) array from loop_attributes()
+#tri_loops - (n, 3) loops of each triangle
+#processes - worker processes to use.  1 bakes in this process and 0 uses one per CPU.
+#flip_green - if True the green channel points down, as DirectX style engines expect
+#Returns (height, width, 4) float32 RGBA image, bottom row first
+def bake_image(uvs, attrs, tri_loops, width, height, margin = 4, processes = 0, flip_green = False, tile_size = TILE_SIZE):
+    tri_uvs = uvs[tri_loops].astype(np.float64) * (width, height)
+    tri_attrs = attrs[tri_loops]
+
+    tiles_x, bins = bin_triangles(tri_uvs, width, height, tile_size)
+    jobs = []
+    for tile, tris in bins:
+        x0 = (tile % tiles_x) * tile_size
+        y0 = (tile // tiles_x) * tile_size
+        jobs.append((x0, y0, min(tile_size, width - x0), min(tile_size, height - y0), tri_uvs[tris], tri_attrs[tris]))
+
+    normals = np.zeros((height, width, 3), dtype = np.float32)
+    covered = np.zeros((height, width), dtype = bool)
+
+    def place(result):
+        x0, y0, tile_normals, tile_covered = result
+        h, w = tile_covered.shape
+        normals[y0:y0 + h, x0:x0 + w] = tile_normals
+        covered[y0:y0 + h, x0:x0 + w] = tile_covered
+
+    if processes == 1 or len(jobs) <= 1:
+        for job in jobs:
+            place(bake_tile(*job))
+    else:
+        #Workers are started fresh rather than forked, since forking a process with a GPU context is not safe
+        with concurrent.futures.ProcessPoolExecutor(max_workers = processes or None, mp_context = multiprocessing.get_context('spawn')) as pool:
+            for result in pool.map(bake_tile, *zip(*jobs)):
+                place(result)
+
+    dilate(normals, covered, margin)
+
+    #Texels no triangle covers point straight out of the surface
+    normals[~covered] = (0, 0, 1)
+    if flip_green:
+        normals[..., 1] *= -1
+    image = np.ones((height, width, 4), dtype = np.float32)
+    image[..., :3] = normals * .5 + .5
+    return image
@@ -0,0 +1,469 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+from mathutils.kdtree import KDTree
+
+from . import meshArrays
+from . import transferNormals
+
+#Vectorized versions of the math the normal brush does for a single loop.  Used when
+# many dabs or many loops are processed at once.
+
+
+#Rotate unit vectors a toward unit vectors b by fraction t of the angle between them.
+#Rows where a and b are parallel or opposite are left unchanged.
+def slerp_normals(a, b, t):
+    dot = np.clip(np.einsum('ij,ij->i', a, b), -1, 1)
+    angle = np.arccos(dot)
+    sin = np.sin(angle)
+
+    result = np.array(a, dtype = np.float64)
+    ok = sin > 1e-6
+    if np.any(ok):
+        t = np.broadcast_to(t, dot.shape)[ok]
+        wa = np.sin((1 - t) * angle[ok]) / sin[ok]
+        wb = np.sin(t * angle[ok]) / sin[ok]
+        result[ok] = wa[:, None] * a[ok] + wb[:, None] * b[ok]
+    return result
+
+#Convert world space directions to the local space of obj.  Matches the transform the brush has
+# always used for normals (the transpose of the object matrix).
+def world_to_local_dirs(obj, dirs):
+    m = meshArrays.matrix_to_array(obj.matrix_world)
+    return np.asarray(dirs, dtype = np.float64) @ m[:3, :3]
+
+#Direction normals are pulled toward in local space of obj.
+#positions - (n, 3) local vertex positions the directions are calculated for
+#vert_normals - (n, 3) local vertex normals
+#comb_dirs - world space direction of travel, (3,) or (n, 3)
+#smooth_normals - local space average normal, (3,) or (n, 3)
+#transfer_normals - (n, 3) local space normals copied from the transfer source
+#Returns (n, 3) unit vectors.  Rows are zero where the brush has no direction.
+def brush_directions(settings, obj, positions, vert_normals, comb_dirs = None, smooth_normals = None, transfer_normals = None):
+    brush_type = settings.brush_type
+    count = len(positions)
+    dirs = np.zeros((count, 3))
+
+    if brush_type == "FIXED":
+        dirs[:] = world_to_local_dirs(obj, np.array(settings.normal))
+
+    elif brush_type == "COMB":
+        if comb_dirs is not None:
+            dirs[:] = world_to_local_dirs(obj, comb_dirs)
+
+    elif brush_type == "ATTRACT" or brush_type == "REPEL":
+        targets = attract_targets(settings)
+        if targets:
+            #Target origins in local space, computed once for all loops
+            world = np.array([t.matrix_world.translation for t in targets], dtype = np.float64)
+            target_locs = meshArrays.transform_points(obj.matrix_world.inverted(), world)
+            dirs[:] = blend_target_dirs(positions, target_locs, settings.target_weighting)
+            if brush_type == "REPEL":
+                dirs = -dirs
+
+    elif brush_type == "SMOOTH":
+        if smooth_normals is not None:
+            dirs[:] = smooth_normals
+
+    elif brush_type == "VERTEX":
+        dirs[:] = vert_normals
+
+    elif brush_type == "TRANSFER":
+        if transfer_normals is not None:
+            dirs[:] = transfer_normals
+
+    return meshArrays.normalize(dirs)
+
+
+#Sign vectors for each mirrored copy of a dab, in the order the brush has always generated them
+def symmetry_signs(settings):
+    signs = [(1, 1, 1)]
+    if settings.symmetry_x:
+        signs = signs + [(-x, y, z) for x, y, z in signs]
+    if settings.symmetry_y:
+        signs = signs + [(x, -y, z) for x, y, z in signs]
+    if settings.symmetry_z:
+        signs = signs + [(x, y, -z) for x, y, z in signs]
+    return np.array(signs, dtype = np.float64)
+
+
+#Objects the Attract and Repel brushes point toward
+def attract_targets(settings):
+    if settings.target_mode == 'COLLECTION':
+        if settings.target_collection == None:
+            return []
+        return list(settings.target_collection.all_objects)
+    if settings.target == None:
+        return []
+    return [settings.target]
+
+#Direction from each position toward a blend of several target points
+#positions - (n, 3) array
+#targets - (t, 3) array, in the same space as positions
+#weighting - 'INVERSE_DISTANCE' weights each target by 1 / distance squared, 'NEAREST' uses only the closest target
+def blend_target_dirs(positions, targets, weighting):
+    offsets = targets[None, :, :] - positions[:, None, :]
+    dist = np.linalg.norm(offsets, axis = 2)
+
+    if len(targets) == 1:
+        return offsets[:, 0]
+
+    if weighting == 'NEAREST':
+        nearest = np.argmin(dist, axis = 1)
+        return offsets[np.arange(len(positions)), nearest]
+
+    unit = offsets / np.maximum(dist, 1e-12)[:, :, None]
+    weights = 1 / np.maximum(dist, 1e-6) ** 2
+    return np.einsum('nt,ntk->nk', weights, unit)
+
+
+#---------------------------
+
+def build_kdtree(points):
+    kd = KDTree(len(points))
+    for i, co in enumerate(points.tolist()):
+        kd.insert(co, i)
+    kd.balance()
+    return kd
+
+#Points inserted per step by build_kdtree_steps()
+KDTREE_STEP = 20000
+
+#build_kdtree() a step at a time, inserting at most step points per step.  Yields between steps;
+# the balanced tree is the return value.  balance() is a single call made after the last step.
+def build_kdtree_steps(points, step = KDTREE_STEP):
+    kd = KDTree(len(points))
+    for start in range(0, len(points), step):
+        for i, co in enumerate(points[start:start + step].tolist(), start):
+            kd.insert(co, i)
+        yield
+    kd.balance()
+    return kd
+
+#Number of times build_kdtree_steps() yields for count points
+def kdtree_step_count(count, step = KDTREE_STEP):
+    return -(-count // step)
+
+#Find every point within radius of each center
+#Returns (point_idx, center_idx, dist) arrays with one entry per pair
+def gather_pairs(kd, centers, radius):
+    point_idx = []
+    center_idx = []
+    dist = []
+    for i, c in enumerate(centers):
+        found = kd.find_range(c, radius)
+        point_idx.extend(f[1] for f in found)
+        dist.extend(f[2] for f in found)
+        center_idx.extend([i] * len(found))
+
+    return (np.array(point_idx, dtype = np.int64),
+        np.array(center_idx, dtype = np.int64),
+        np.array(dist, dtype = np.float64))
+
+#Shortest distance along mesh edges from seed vertices to the vertices of a region.  Paths may
+# only pass through the region, and distances past limit are dropped, so the work is bounded by
+# the size of the region.  Edges are relaxed in bulk until no distance improves.
+#cache - MeshCache of the mesh
+#region - sorted unique vertex indices
+#seed_verts, seed_dist - vertices of the region the search starts from and their starting distances
+#Returns (n,) distance for each vertex of region, inf where not reached
+def surface_distances(cache, region, seed_verts, seed_dist, limit):
+    offsets, neighbors = cache.vertex_adjacency()
+    src, nbrs = meshArrays.expand_csr(offsets, neighbors, region)
+    dst = np.minimum(np.searchsorted(region, nbrs), len(region) - 1)
+    inside = region[dst] == nbrs
+    src = src[inside]
+    dst = dst[inside]
+
+    coords = cache.world_coords()
+    lengths = np.linalg.norm(coords[region[src]] - coords[region[dst]], axis = 1)
+
+    dist = np.full(len(region), np.inf)
+    np.minimum.at(dist, np.searchsorted(region, seed_verts), seed_dist)
+
+    for i in range(len(region)):
+        relaxed = dist.copy()
+        np.minimum.at(relaxed, dst, dist[src] + lengths)
+        relaxed[relaxed > limit] = np.inf
+        if np.array_equal(relaxed, dist):
+            break
+        dist = relaxed
+    return dist
+
+#Replace the straight line distances of brush pairs with distances over the surface, so a dab
+# does not jump across gaps to nearby parts of the mesh (eg, from one lip to the other).
+#The search for each dab starts from the vertex nearest its center and the vertices around it.
+#vert_idx, center_idx, dist - pairs as returned by gather_pairs()
+#Returns (n,) distances, inf for vertices not reachable within radius
+def geodesic_pair_distances(cache, vert_idx, center_idx, dist, radius):
+    offsets, neighbors = cache.vertex_adjacency()
+    result = np.full(len(vert_idx), np.inf)
+
+    for center in np.unique(center_idx):
+        pairs = np.flatnonzero(center_idx == center)
+        region, slot = np.unique(vert_idx[pairs], return_inverse = True)
+        region_dist = np.full(len(region), np.inf)
+        region_dist[slot] = dist[pairs]
+
+        nearest = region[np.argmin(region_dist)]
+        ring = neighbors[offsets[nearest]:offsets[nearest + 1]]
+        seeds = np.concatenate(([nearest], ring[np.isin(ring, region)]))
+        seed_dist = region_dist[np.searchsorted(region, seeds)]
+
+        result[pairs] = surface_distances(cache, region, seeds, seed_dist, radius)[slot]
+
+    return result
+
+#Combine the effect of several dabs on the same loops.  Repeatedly rotating toward a direction by
+# fractions w1, w2, ... moves a total of 1 - (1 - w1)(1 - w2)..., and the direction used is the
+# weighted average of the individual dab directions.
+#loop_idx - (n,) loop each contribution applies to
+#weights - (n,) fraction of rotation in [0, 1]
+#dirs - (n, 3) unit direction of each contribution
+#Returns (loops, targets, amounts) for each loop touched
+def combine_dabs(loop_idx, weights, dirs):
+    use = (weights > 0) & np.any(dirs != 0, axis = 1)
+    loop_idx = loop_idx[use]
+    weights = weights[use]
+    dirs = dirs[use]
+
+    loops = np.unique(loop_idx)
+    if len(loops) == 0:
+        return loops, np.zeros((0, 3)), np.zeros(0)
+
+    slot = np.searchsorted(loops, loop_idx)
+
+    targets = np.zeros((len(loops), 3))
+    for axis in range(3):
+        targets[:, axis] = np.bincount(slot, weights = weights * dirs[:, axis], minlength = len(loops))
+    targets = meshArrays.normalize(targets)
+
+    log_keep = np.bincount(slot, weights = np.log1p(-np.minimum(weights, 1 - 1e-9)), minlength = len(loops))
+    amounts = 1 - np.exp(log_keep)
+
+    #Directions that cancel out leave the loop alone
+    ok = np.any(targets != 0, axis = 1)
+    return loops[ok], targets[ok], amounts[ok]
+
+#Rotate loop normals by the combined effect of several dabs
+#Returns (loops, new_normals) for the loops that changed
+def apply_dabs(normals, loop_idx, weights, dirs):
+    loops, targets, amounts = combine_dabs(loop_idx, weights, dirs)
+    return loops, slerp_normals(normals[loops], targets, amounts)
+
+
+#Rotate each row of c by the rotation that takes unit vector a to unit vector b
+def rotate_between(a, b, c):
+    axis = np.cross(a, b)
+    sin = np.linalg.norm(axis, axis = 1)
+    cos = np.einsum('ij,ij->i', a, b)
+
+    result = np.array(c, dtype = np.float64)
+    ok = sin > 1e-9
+    if np.any(ok):
+        k = axis[ok] / sin[ok, None]
+        cr = c[ok]
+        s = sin[ok, None]
+        co = cos[ok, None]
+        result[ok] = cr * co + np.cross(k, cr) * s + k * np.einsum('ij,ij->i', k, cr)[:, None] * (1 - co)
+    return result
+
+#Merge the rotations of mirrored copies of a single dab the way the brush always has: each copy
+# rotates the original normal and the results are averaged.
+#Returns (loops, new_normals) for the loops that changed
+def merge_rotations(normals, loop_idx, weights, dirs):
+    use = (weights > 0) & np.any(dirs != 0, axis = 1)
+    loop_idx = loop_idx[use]
+    rotated = slerp_normals(normals[loop_idx], dirs[use], weights[use])
+
+    loops, slot = np.unique(loop_idx, return_inverse = True)
+    merged = np.zeros((len(loops), 3))
+    for axis in range(3):
+        merged[:, axis] = np.bincount(slot, weights = rotated[:, axis], minlength = len(loops))
+    merged = meshArrays.normalize(merged)
+
+    #Copies that cancel out leave the loop alone
+    ok = np.any(merged != 0, axis = 1)
+    return loops[ok], merged[ok]
+
+#Merge mirrored copies of the same dab with merge_rotations(), so that when many dabs are applied
+# at once only separate dabs compound in combine_dabs() and symmetry works as in the modal brush.
+#dab_idx - dab each pair's copy belongs to
+#Returns (loop_idx, weights, dirs) with one entry per (loop, dab).  Each direction is picked so that
+# rotating the normal toward it by the weight gives the merged result.
+def merge_copies(normals, loop_idx, dab_idx, weights, dirs):
+    use = (weights > 0) & np.any(dirs != 0, axis = 1)
+    loop_idx = loop_idx[use]
+    dab_idx = dab_idx[use]
+    weights = weights[use]
+    dirs = dirs[use]
+    if len(loop_idx) == 0:
+        return loop_idx, weights, dirs
+
+    rotated = slerp_normals(normals[loop_idx], dirs, weights)
+
+    dab_count = int(dab_idx.max()) + 1
+    keys, slot = np.unique(loop_idx.astype(np.int64) * dab_count + dab_idx, return_inverse = True)
+    merged = np.zeros((len(keys), 3))
+    for axis in range(3):
+        merged[:, axis] = np.bincount(slot, weights = rotated[:, axis], minlength = len(keys))
+    merged = meshArrays.normalize(merged)
+    amounts = np.zeros(len(keys))
+    np.maximum.at(amounts, slot, weights)
+
+    #Extend the rotation from the normal to the merged result by 1 / weight, but not past the far side of the sphere
+    group_loops = keys // dab_count
+    start = normals[group_loops]
+    angle = np.arccos(np.clip(np.einsum('ij,ij->i', start, merged), -1, 1))
+    t = np.minimum(1 / np.minimum(amounts, 1), np.pi / np.maximum(angle, 1e-9) * .999)
+    targets = slerp_normals(start, merged, t)
+
+    #Copies that cancel out leave the loop alone
+    ok = np.any(merged != 0, axis = 1)
+    return group_loops[ok], np.minimum(amounts[ok], 1), targets[ok]
+
+#Laplacian relaxation of the normal field over the vertex graph, limited to verts.  Vertices
+# bordering the region take part in the averaging but are not moved.
+#cache - MeshCache of the mesh
+#verts - (n,) unique vertices to relax
+#weights - (n,) fraction each vertex moves toward its neighbors' average on every iteration
+#Returns (start, end) vertex normals for verts, from which loop normals can be rotated
+def relax_vertex_normals(cache, verts, weights, iterations):
+    offsets, neighbors = cache.vertex_adjacency()
+    src, nbrs = meshArrays.expand_csr(offsets, neighbors, verts)
+
+    region = np.unique(np.concatenate((verts, nbrs)))
+    vslot = np.searchsorted(region, verts)
+    nslot = np.searchsorted(region, nbrs)
+
+    #Starting vertex normal is the average of the loop normals around it
+    lsrc, lloops = cache.loops_of_verts(region)
+    field = np.zeros((len(region), 3))
+    for axis in range(3):
+        field[:, axis] = np.bincount(lsrc, weights = cache.loop_normals[lloops, axis], minlength = len(region))
+    field = meshArrays.normalize(field)
+
+    start = field[vslot].copy()
+    counts = np.maximum(np.bincount(src, minlength = len(verts)), 1)
+    weights = np.asarray(weights)[:, None]
+
+    for i in range(iterations):
+        avg = np.zeros((len(verts), 3))
+        nfield = field[nslot]
+        for axis in range(3):
+            avg[:, axis] = np.bincount(src, weights = nfield[:, axis], minlength = len(verts)) / counts
+        cur = field[vslot]
+        field[vslot] = meshArrays.normalize(cur + weights * (avg - cur))
+
+    return start, field[vslot]
+
+#Relax the loops in loop_idx.  pair_verts gives the vertex of each entry and weights its strength.
+#Returns (loops, new_normals)
+def relax_loops(cache, loop_idx, pair_verts, weights, iterations, factor):
+    use = weights > 0
+    loop_idx = loop_idx[use]
+    pair_verts = pair_verts[use]
+    weights = weights[use]
+    if len(loop_idx) == 0:
+        return loop_idx, np.zeros((0, 3))
+
+    verts, vslot = np.unique(pair_verts, return_inverse = True)
+    vert_weights = np.zeros(len(verts))
+    np.maximum.at(vert_weights, vslot, weights)
+
+    start, end = relax_vertex_normals(cache, verts, vert_weights * factor, iterations)
+
+    loops, first = np.unique(loop_idx, return_index = True)
+    lv = vslot[first]
+    return loops, rotate_between(start[lv], end[lv], cache.loop_normals[loops])
+
+
+#Apply many dabs to one mesh at once and write the normals in a single call.
+#cache - MeshCache of the mesh being brushed
+#vert_idx, dab_idx, weights - one entry for each (vertex, dab) pair the brush touches.  weights
+#   are the falloff of the dab at the vertex in [0, 1]
+#comb_dirs - (dabs, 3) world space direction of travel for each dab
+#signs - (dabs, 3) symmetry mirror applied to the direction of each dab
+#loop_mask - optional (loops,) bool array.  Loops that are False are not changed.
+#copy_of - (dabs,) index of the dab each dab is a mirrored copy of, or of itself.  Copies of one dab
+#   are merged like the modal brush merges them rather than compounding.
+#Returns the number of loops changed
+def apply_brush_pairs(context, settings, cache, vert_idx, dab_idx, weights, comb_dirs = None, signs = None, sampler = None, loop_mask = None, copy_of = None):
+    obj = cache.obj
+    loop_normals = cache.loop_normals
+
+    src, loops = cache.loops_of_verts(vert_idx)
+    pair_verts = vert_idx[src]
+    pair_dabs = dab_idx[src]
+    falloff = weights[src]
+
+    strength = falloff * settings.strength
+
+    if settings.selected_faces_only:
+        strength[~cache.poly_select[cache.loop_polys[loops]]] = 0
+    if settings.selected_verts_only:
+        strength[~cache.vert_select[pair_verts]] = 0
+    if loop_mask is not None:
+        strength[~loop_mask[loops]] = 0
+
+    if settings.brush_type == "SMOOTH" and settings.smooth_mode == "RELAX":
+        changed, new_normals = relax_loops(cache, loops, pair_verts, strength, settings.smooth_iterations, settings.smooth_factor)
+        if len(changed) == 0:
+            return 0
+        cache.write_normals(changed, new_normals)
+        cache.flush_normals()
+        cache.flush_layers()
+        return len(changed)
+
+    smooth_normals = None
+    if settings.brush_type == "SMOOTH":
+        dab_count = int(pair_dabs.max()) + 1 if len(pair_dabs) else 0
+        smooth = np.zeros((dab_count, 3))
+        for axis in range(3):
+            smooth[:, axis] = np.bincount(pair_dabs, weights = falloff * loop_normals[loops, axis], minlength = dab_count)
+        smooth_normals = meshArrays.normalize(smooth)[pair_dabs]
+
+    transfer_normals = None
+    if settings.brush_type == "TRANSFER":
+        source = settings.transfer_source
+        if source == None or source == obj:
+            return 0
+        if sampler == None or sampler.source != source:
+            sampler = transferNormals.NormalSampler(source, context.evaluated_depsgraph_get())
+        verts, inverse = np.unique(pair_verts, return_inverse = True)
+        normals, valid = sampler.sample_vertices(obj, cache.coords[verts])
+        transfer_normals = normals[inverse]
+        strength[~valid[inverse]] = 0
+
+    dirs = brush_directions(settings, obj, cache.coords[pair_verts], cache.vert_normals[pair_verts],
+        comb_dirs = None if comb_dirs is None else comb_dirs[pair_dabs],
+        smooth_normals = smooth_normals,
+        transfer_normals = transfer_normals)
+    if signs is not None:
+        dirs = dirs * signs[pair_dabs]
+    if copy_of is not None:
+        loops, strength, dirs = merge_copies(loop_normals, loops, copy_of[pair_dabs], strength, dirs)
+
+    changed, new_normals = apply_dabs(loop_normals, loops, strength, dirs)
+    if len(changed) == 0:
+        return 0
+
+    cache.write_normals(changed, new_normals)
+    cache.flush_normals()
+    cache.flush_layers()
+    return len(changed)
@@ -0,0 +1,155 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import numpy as np
+
+from mathutils.geometry import interpolate_bezier
+
+from . import brushMath
+from . import falloff
+from . import meshArrays
+from . import meshCache
+
+
+#World space polyline for every spline of a curve object
+def curve_polylines(obj):
+    polylines = []
+
+    for spline in obj.data.splines:
+        coords = []
+        if spline.type == 'BEZIER':
+            points = list(spline.bezier_points)
+            segments = list(zip(points[:-1], points[1:]))
+            if spline.use_cyclic_u and len(points) > 1:
+                segments.append((points[-1], points[0]))
+
+            resolution = max(spline.resolution_u, 1) + 1
+            for p0, p1 in segments:
+                seg = interpolate_bezier(p0.co, p0.handle_right, p1.handle_left, p1.co, resolution)
+                if coords:
+                    seg = seg[1:]
+                coords.extend(seg)
+        else:
+            #Poly and NURBS splines follow their control points
+            coords = [p.co.to_3d() for p in spline.points]
+            if spline.use_cyclic_u and len(coords) > 1:
+                coords.append(coords[0])
+
+        if len(coords) > 1:
+            local = np.array([tuple(c) for c in coords], dtype = np.float64)
+            polylines.append(meshArrays.transform_points(obj.matrix_world, local))
+
+    return polylines
+
+#Place points along a polyline at even spacing
+#Returns (points, tangents) as (n, 3) arrays
+def resample_polyline(points, spacing):
+    seg = np.diff(points, axis = 0)
+    seg_len = np.linalg.norm(seg, axis = 1)
+    cum = np.concatenate(([0], np.cumsum(seg_len)))
+    total = cum[-1]
+    if total <= 0:
+        return np.zeros((0, 3)), np.zeros((0, 3))
+
+    dist = np.arange(0, total, spacing)
+    if total - dist[-1] > spacing * .5:
+        dist = np.append(dist, total)
+
+    seg_idx = np.clip(np.searchsorted(cum, dist, side = 'right') - 1, 0, len(seg) - 1)
+    frac = (dist - cum[seg_idx]) / np.where(seg_len[seg_idx] > 0, seg_len[seg_idx], 1)
+
+    samples = points[seg_idx] + seg[seg_idx] * frac[:, None]
+    tangents = meshArrays.normalize(seg[seg_idx])
+    return samples, tangents
+
+
+#---------------------------
+
+class CurveBrushOperator(bpy.types.Operator):
+    """Apply the normal brush along the active curve object to the selected meshes."""
+    bl_idname = "kitfox.nt_brush_along_curve"
+    bl_label = "Brush Along Curve"
+    bl_options = {"REGISTER", "UNDO"}
+
+    spacing : bpy.props.FloatProperty(
+        name = "Spacing",
+        description = "Distance between dabs as a fraction of the brush radius",
+        default = .25,
+        min = .01,
+        soft_max = 2
+    )
+
+    def execute(self, context):
+        settings = context.scene.normal_brush_props
+        radius = settings.radius
+
+        curve = context.active_object
+        if curve == None or not curve.type == 'CURVE':
+            self.report({"WARNING"}, "Active object is not a curve")
+            return {'CANCELLED'}
+
+        objs = [p for p in context.selected_objects if p.type == 'MESH']
+        if not objs:
+            self.report({"WARNING"}, "No meshes selected")
+            return {'CANCELLED'}
+
+        if radius <= 0:
+            self.report({"WARNING"}, "Brush radius is zero")
+            return {'CANCELLED'}
+
+        samples = [resample_polyline(p, self.spacing * radius) for p in curve_polylines(curve)]
+        samples = [s for s in samples if len(s[0])]
+        if not samples:
+            self.report({"WARNING"}, "Curve has no length")
+            return {'CANCELLED'}
+
+        centers = np.concatenate([s[0] for s in samples])
+        tangents = np.concatenate([s[1] for s in samples])
+
+        #Mirrored copies of each dab
+        signs = brushMath.symmetry_signs(settings)
+        dab_centers = np.concatenate([centers * s for s in signs])
+        dab_tangents = np.concatenate([tangents for s in signs])
+        dab_signs = np.repeat(signs, len(centers), axis = 0)
+
+        changed = 0
+        for obj in objs:
+            cache = meshCache.MeshCache(obj, settings.use_shape_keys)
+            if settings.use_evaluated and not cache.sync_evaluated(context.evaluated_depsgraph_get()):
+                self.report({"WARNING"}, cache.eval_error)
+
+            vert_idx, dab_idx, dist = brushMath.gather_pairs(cache.kdtree(), dab_centers.tolist(), radius)
+            weights = falloff.brush_falloff(settings, dist, radius)
+
+            changed += brushMath.apply_brush_pairs(context, settings, cache, vert_idx, dab_idx, weights,
+                comb_dirs = dab_tangents, signs = dab_signs, copy_of = np.tile(np.arange(len(centers)), len(signs)))
+
+        self.report({"INFO"}, "%d dabs changed %d loops" % (len(centers), changed))
+        return {'FINISHED'}
+
+#---------------------------
+
+def register():
+    bpy.utils.register_class(CurveBrushOperator)
+
+
+def unregister():
+    bpy.utils.unregister_class(CurveBrushOperator)
+
+
+if __name__ == "__main__":
+    register()
@@ -0,0 +1,129 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import numpy as np
+
+#Brush falloff and pressure response are baked into lookup tables indexed by
+# t = 1 - distance / radius (or by pressure), so a dab costs one table lookup per loop.
+
+LUT_SIZE = 256
+
+#Custom curves are kept on RGB Curve nodes in a hidden node group, since add-on settings
+# cannot own a CurveMapping directly.  The combined (C) curve of each node is used.  The group is
+# only made once a custom curve is chosen, and the brush settings hold the only reference to it,
+# so it is not saved in files that never used one.
+CURVE_GROUP_NAME = ".NormalBrushCurves"
+FALLOFF_NODE = "Falloff"
+PRESSURE_NODE = "Pressure"
+
+
+def preset_curve(shape, t):
+    if shape == 'SMOOTH':
+        return t * t * (3 - 2 * t)
+    elif shape == 'SPHERE':
+        return np.sqrt(np.clip(2 * t - t * t, 0, 1))
+    elif shape == 'ROOT':
+        return np.sqrt(t)
+    elif shape == 'SHARP':
+        return t * t
+    elif shape == 'CONSTANT':
+        return np.ones_like(t)
+    return t
+
+#Node holding the custom curve of the given name.  If settings is given, the node is created if
+# needed and the group is referenced from settings.
+def curve_node(name, settings = None):
+    group = bpy.data.node_groups.get(CURVE_GROUP_NAME)
+    if settings != None:
+        if group == None:
+            group = bpy.data.node_groups.new(CURVE_GROUP_NAME, 'ShaderNodeTree')
+        #Files saved by older versions kept the group alive with a fake user
+        group.use_fake_user = False
+        settings.curve_group = group
+    if group == None:
+        return None
+
+    node = group.nodes.get(name)
+    if node == None and settings != None:
+        node = group.nodes.new('ShaderNodeRGBCurve')
+        node.name = name
+        node.label = name
+    return node
+
+def curve_signature(mapping):
+    curve = mapping.curves[3]
+    return tuple((p.location[0], p.location[1], p.handle_type) for p in curve.points)
+
+def bake_custom(name, t):
+    node = curve_node(name)
+    if node == None:
+        return t
+    mapping = node.mapping
+    mapping.initialize()
+    curve = mapping.curves[3]
+    return np.array([mapping.evaluate(curve, x) for x in t.tolist()])
+
+
+_tables = {}
+
+#Lookup table for a preset or custom curve.  Rebuilt only when the shape or curve points change.
+def lookup_table(shape, custom_name):
+    key = shape
+    if shape == 'CUSTOM':
+        node = curve_node(custom_name)
+        key = (shape, custom_name, None if node == None else curve_signature(node.mapping))
+
+    table = _tables.get(key)
+    if table is None:
+        t = np.linspace(0, 1, LUT_SIZE)
+        if shape == 'CUSTOM':
+            table = bake_custom(custom_name, t)
+        else:
+            table = preset_curve(shape, t)
+        table = np.clip(table, 0, 1)
+
+        if len(_tables) > 32:
+            _tables.clear()
+        _tables[key] = table
+    return table
+
+def falloff_table(settings):
+    return lookup_table(settings.falloff_shape, FALLOFF_NODE)
+
+def sample_table(table, t):
+    idx = np.rint(np.clip(t, 0, 1) * (LUT_SIZE - 1)).astype(np.int32)
+    return table[idx]
+
+#Falloff of the brush at distance dist from its center
+def brush_falloff(settings, dist, radius):
+    t = 1 - np.asarray(dist) / radius
+    return np.where(t > 0, sample_table(falloff_table(settings), t), 0)
+
+#Strength multiplier for a pen pressure
+def pressure_response(settings, pressure):
+    table = lookup_table(settings.pressure_curve, PRESSURE_NODE)
+    return float(sample_table(table, pressure))
+
+
+#Make sure the custom curve nodes exist when a custom curve is chosen
+def update_falloff_shape(settings, context):
+    if settings.falloff_shape == 'CUSTOM':
+        curve_node(FALLOFF_NODE, settings)
+
+def update_pressure_curve(settings, context):
+    if settings.pressure_curve == 'CUSTOM':
+        curve_node(PRESSURE_NODE, settings)
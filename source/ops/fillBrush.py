@@ -0,0 +1,106 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import numpy as np
+
+from . import brushMath
+from . import falloff
+from . import meshCache
+
+
+class FillNormalsOperator(bpy.types.Operator):
+    """Apply the current brush to every selected face or vertex of the selected meshes."""
+    bl_idname = "kitfox.nt_fill_normals"
+    bl_label = "Fill Selection"
+    bl_options = {"REGISTER", "UNDO"}
+
+    selection : bpy.props.EnumProperty(
+        name = "Selection",
+        items=(
+            ('FACES', "Faces", "Affect the loops of selected faces"),
+            ('VERTICES', "Vertices", "Affect every loop of selected vertices")
+        ),
+        default = 'FACES'
+    )
+
+    falloff_mode : bpy.props.EnumProperty(
+        name = "Falloff",
+        items=(
+            ('NONE', "None", "Apply the brush at full strength everywhere"),
+            ('CURSOR', "3D Cursor", "Fade out over the brush radius around the 3D cursor")
+        ),
+        default = 'NONE'
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'OBJECT'
+
+    def execute(self, context):
+        settings = context.scene.normal_brush_props
+
+        if settings.brush_type == "COMB":
+            self.report({"WARNING"}, "Comb brush needs a stroke direction and cannot fill a selection")
+            return {'CANCELLED'}
+
+        objs = [p for p in context.selected_objects if p.type == 'MESH']
+        if not objs:
+            self.report({"WARNING"}, "No meshes selected")
+            return {'CANCELLED'}
+
+        cursor = np.array(context.scene.cursor.location)
+
+        changed = 0
+        for obj in objs:
+            cache = meshCache.MeshCache(obj, settings.use_shape_keys)
+            if settings.use_evaluated and not cache.sync_evaluated(context.evaluated_depsgraph_get()):
+                self.report({"WARNING"}, cache.eval_error)
+
+            if self.selection == 'FACES':
+                loop_mask = cache.poly_select[cache.loop_polys]
+                vert_idx = np.unique(cache.loop_verts[loop_mask])
+            else:
+                loop_mask = None
+                vert_idx = np.nonzero(cache.vert_select)[0]
+
+            if len(vert_idx) == 0:
+                continue
+
+            if self.falloff_mode == 'CURSOR':
+                dist = np.linalg.norm(cache.world_coords()[vert_idx] - cursor, axis = 1)
+                weights = falloff.brush_falloff(settings, dist, settings.radius)
+            else:
+                weights = np.ones(len(vert_idx))
+
+            dab_idx = np.zeros(len(vert_idx), dtype = np.int64)
+            changed += brushMath.apply_brush_pairs(context, settings, cache, vert_idx, dab_idx, weights, loop_mask = loop_mask)
+
+        self.report({"INFO"}, "Changed %d loops" % changed)
+        return {'FINISHED'}
+
+#---------------------------
+
+def register():
+    bpy.utils.register_class(FillNormalsOperator)
+
+
+def unregister():
+    bpy.utils.unregister_class(FillNormalsOperator)
+
+
+if __name__ == "__main__":
+    register()
@@ -16,9 +16,115 @@
 
 import bpy
 import bpy.utils.previews
-import bmesh
-import mathutils
-import math
+import numpy as np
+
+from . import brushMath
+from . import meshArrays
+from . import normalLayers
+
+#Vertices closer than this in world space are treated as the same point on a seam
+EPSILON = .00001
+
+
+#Loops at a vertex on the mesh boundary, ie whose edge or the edge before it has only one face
+#prev - previous loop around the polygon of each loop
+def boundary_loops(mesh, prev):
+    loop_edges = meshArrays.read_loop_edge_indices(mesh)
+    on_boundary = np.bincount(loop_edges, minlength = len(mesh.edges))[loop_edges] == 1
+    return np.flatnonzero(on_boundary | on_boundary[prev])
+
+#World space data for the boundary loops of obj
+#Returns (loops, positions, corner_normals, face_normals, angles)
+def boundary_loop_data(obj):
+    mesh = obj.data
+    coords = meshArrays.transform_points(obj.matrix_world, meshArrays.read_vertex_coords(mesh))
+    loop_verts = meshArrays.read_loop_vertex_indices(mesh)
+    loop_polys = meshArrays.read_loop_polygon_indices(mesh)
+    prev, next = meshArrays.read_loop_neighbors(mesh)
+    loops = boundary_loops(mesh, prev)
+
+    positions = coords[loop_verts[loops]]
+    to_prev = coords[loop_verts[prev[loops]]] - positions
+    to_next = coords[loop_verts[next[loops]]] - positions
+
+    face_normals = meshArrays.transform_normals(obj.matrix_world, meshArrays.read_polygon_normals(mesh))[loop_polys[loops]]
+
+    #A mirroring transform reverses the winding of faces
+    handedness = np.sign(np.linalg.det(meshArrays.matrix_to_array(obj.matrix_world)[:3, :3]))
+    corner_normals = meshArrays.normalize(np.cross(to_next, to_prev) * handedness)
+    degenerate = ~np.any(corner_normals != 0, axis = 1)
+    corner_normals[degenerate] = face_normals[degenerate]
+
+    cos = np.einsum('ij,ij->i', meshArrays.normalize(to_prev), meshArrays.normalize(to_next))
+    angles = np.arccos(np.clip(cos, -1, 1))
+
+    return loops, positions, corner_normals, face_normals, angles
+
+#World space boundary edges of obj as (starts, ends, start_normals, end_normals).  Each end takes
+# the corner normal of the first boundary loop at its vertex, as exact matching does.
+#loops, corner_normals - boundary loops and their normals from boundary_loop_data()
+def boundary_edge_data(obj, loops, corner_normals):
+    mesh = obj.data
+    coords = meshArrays.transform_points(obj.matrix_world, meshArrays.read_vertex_coords(mesh))
+    loop_edges = meshArrays.read_loop_edge_indices(mesh)
+    edges = np.flatnonzero(np.bincount(loop_edges, minlength = len(mesh.edges)) == 1)
+    edge_verts = meshArrays.read_edge_vertices(mesh)[edges]
+
+    vert_normals = np.zeros((len(coords), 3))
+    verts, first = np.unique(meshArrays.read_loop_vertex_indices(mesh)[loops], return_index = True)
+    vert_normals[verts] = corner_normals[first]
+
+    return coords[edge_verts[:, 0]], coords[edge_verts[:, 1]], vert_normals[edge_verts[:, 0]], vert_normals[edge_verts[:, 1]]
+
+#Find the nearest point on a set of segments to each point, if it is within max_dist.
+#Segments are sampled at no more than their median length apart and the samples put in a KD-tree,
+# so each point only tests the few segments near it.
+#starts, ends - (m, 3) ends of each segment
+#Returns (points, segments, t) for each point that was in range, where t is how far along the segment its nearest point is
+def project_to_segments(starts, ends, points, max_dist):
+    lengths = np.linalg.norm(ends - starts, axis = 1)
+    spacing = max(float(np.median(lengths)), 1e-9)
+    counts = np.maximum(np.ceil(lengths / spacing), 1).astype(np.int64)
+
+    #Middle of each of the equal pieces a segment is cut into.  Every point of a segment is within
+    # spacing / 2 of one of its samples.
+    seg = np.repeat(np.arange(len(starts)), counts)
+    piece = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts)
+    frac = ((piece + .5) / counts[seg])[:, None]
+    samples = starts[seg] + (ends[seg] - starts[seg]) * frac
+
+    kd = brushMath.build_kdtree(samples)
+    sample_idx, point_idx, dist = brushMath.gather_pairs(kd, points.tolist(), max_dist + spacing / 2)
+    pairs = np.unique(np.stack((point_idx, seg[sample_idx]), axis = 1), axis = 0)
+    if len(pairs) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+    point_idx, seg_idx = pairs[:, 0], pairs[:, 1]
+
+    #Exact distance to each candidate segment
+    a = starts[seg_idx]
+    ab = ends[seg_idx] - a
+    t = np.einsum('ij,ij->i', points[point_idx] - a, ab) / np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-24)
+    t = np.clip(t, 0, 1)
+    dist = np.linalg.norm(a + ab * t[:, None] - points[point_idx], axis = 1)
+
+    #Nearest segment in range for each point
+    order = np.lexsort((dist, point_idx))
+    order = order[dist[order] <= max_dist]
+    hit, first = np.unique(point_idx[order], return_index = True)
+    best = order[first]
+    return hit, seg_idx[best], t[best]
+
+#Write world space normals to some loops of obj.  Every other loop is reset to its automatic
+# normal, unless the mesh has normal layers, where only the active layer's loops are changed.
+def write_world_normals(obj, loops, normals):
+    mesh = obj.data
+    #n_local = M^T n_world, which is the inverse transpose of the world to local matrix
+    normals = meshArrays.transform_normals(obj.matrix_world.inverted(), normals)
+    if normalLayers.write_active_layer(mesh, loops, normals):
+        return
+    local = np.zeros((len(mesh.loops), 3))
+    local[loops] = normals
+    meshArrays.write_loop_normals(mesh, local)
 
 
 #---------------------------
@@ -29,12 +135,27 @@ class CopySeamNormalsOperator(bpy.types.Operator):
     bl_label = "Copy Seam Normals"
     bl_options = {"REGISTER", "UNDO"}
 
+    match_mode : bpy.props.EnumProperty(
+        name = "Match", 
+        items=(
+            ('VERTEX', "Vertices", "Copy to vertices that lie on a boundary vertex of the active mesh"),
+            ('EDGE', "Nearest Edge", "Project each boundary vertex onto the nearest boundary edge of the active mesh and blend the normals at its ends.  For seams whose pieces have different numbers of edges")
+        ),
+        default = 'VERTEX'
+    )
+    
+    search_distance : bpy.props.FloatProperty(
+        name = "Search Distance", 
+        description = "In Nearest Edge mode, how far a vertex may be from the active boundary and still be matched", 
+        default = .01, 
+        min = 0, 
+        soft_max = 1, 
+        subtype = 'DISTANCE'
+    )
 
     def execute(self, context):
-        epsilon = .00001
-        
         active_obj = context.active_object
-        if not active_obj.type == 'MESH':
+        if active_obj == None or not active_obj.type == 'MESH':
             self.report({"WARNING"}, "Active object is not a mesh")
             return {'CANCELLED'}
         
@@ -43,36 +164,62 @@ class CopySeamNormalsOperator(bpy.types.Operator):
             self.report({"WARNING"}, "No objects to copy to selected")
             return {'CANCELLED'}
 
-        bm = bmesh.new()
-        bm.from_mesh(active_obj.data)
-        
-        update_loops = []
-        
-        for face in bm.faces:
-            for lp in face.loops:
-                if lp.edge.is_boundary or lp.link_loop_prev.edge.is_boundary:
-                    update_loops.append(lp)
+        #Seams are matched in world space so the pieces can have different transforms
+        active_loops, positions, corner_normals, face_normals, angles = boundary_loop_data(active_obj)
+        if len(active_loops) == 0:
+            self.report({"WARNING"}, "Active object has no boundary")
+            return {'CANCELLED'}
+            
+        if self.match_mode == 'EDGE':
+            self.copy_to_nearest_edges(active_obj, neighbor_objs, active_loops, corner_normals)
+            return {'FINISHED'}
+            
+        kd = brushMath.build_kdtree(positions)
+        bounds_min = positions.min(axis = 0) - EPSILON
+        bounds_max = positions.max(axis = 0) + EPSILON
 
         for nobj in neighbor_objs:
             mesh = nobj.data
+            coords = meshArrays.transform_points(nobj.matrix_world, meshArrays.read_vertex_coords(mesh))
             
-            normals = []
-
-            for loop in mesh.loops:
-                vert = mesh.vertices[loop.vertex_index]
-                
-                normal = mathutils.Vector((0, 0, 0))
-                for lp in update_loops:
-                    if (lp.vert.co - vert.co).length < epsilon:
-                        normal = lp.calc_normal()
-                        break
-                
-                normals.append(normal)
-                
-            mesh.normals_split_custom_set(normals)
+            #Only vertices near the active boundary need a lookup
+            near = np.flatnonzero(np.all((coords >= bounds_min) & (coords <= bounds_max), axis = 1))
+            point_idx, center_idx, dist = brushMath.gather_pairs(kd, coords[near].tolist(), EPSILON)
+            
+            #Each vertex takes the first matching boundary loop of the active mesh
+            order = np.lexsort((point_idx, center_idx))
+            matched, first = np.unique(center_idx[order], return_index = True)
+            
+            vert_normals = np.zeros((len(coords), 3))
+            vert_normals[near[matched]] = corner_normals[point_idx[order][first]]
+            
+            loop_verts = meshArrays.read_loop_vertex_indices(mesh)
+            write_world_normals(nobj, np.arange(len(loop_verts)), vert_normals[loop_verts])
 
         return {'FINISHED'}
 
+    #Give each boundary vertex of the neighbors the normal of the nearest point on the active boundary
+    def copy_to_nearest_edges(self, active_obj, neighbor_objs, active_loops, corner_normals):
+        starts, ends, start_normals, end_normals = boundary_edge_data(active_obj, active_loops, corner_normals)
+        bounds_min = np.minimum(starts, ends).min(axis = 0) - self.search_distance
+        bounds_max = np.maximum(starts, ends).max(axis = 0) + self.search_distance
+        
+        for nobj in neighbor_objs:
+            mesh = nobj.data
+            coords = meshArrays.transform_points(nobj.matrix_world, meshArrays.read_vertex_coords(mesh))
+            loop_verts = meshArrays.read_loop_vertex_indices(mesh)
+            prev, next = meshArrays.read_loop_neighbors(mesh)
+            
+            verts = np.unique(loop_verts[boundary_loops(mesh, prev)])
+            verts = verts[np.all((coords[verts] >= bounds_min) & (coords[verts] <= bounds_max), axis = 1)]
+            hit, seg, t = project_to_segments(starts, ends, coords[verts], self.search_distance)
+            
+            vert_normals = np.zeros((len(coords), 3))
+            t = t[:, None]
+            vert_normals[verts[hit]] = meshArrays.normalize(start_normals[seg] * (1 - t) + end_normals[seg] * t)
+            
+            write_world_normals(nobj, np.arange(len(loop_verts)), vert_normals[loop_verts])
+
 #---------------------------
 
 class SmoothSeamNormalsOperator(bpy.types.Operator):
@@ -82,57 +229,29 @@ class SmoothSeamNormalsOperator(bpy.types.Operator):
     bl_options = {"REGISTER", "UNDO"}
 
     def execute(self, context):
-        epsilon = .00001
-        
         objs = [p for p in context.selected_objects if p.type == 'MESH']
         if not objs:
             self.report({"WARNING"}, "No active object selected or active object is not a mesh")
             return {'CANCELLED'}
 
-        bm_meshes = []
-        for obj in objs:
-            bm = bmesh.new()
-            bm.from_mesh(obj.data)
-            bm_meshes.append(bm)
-
-        #Find loops on edge
-        update_loops = []
-        update_normals = {}
-        
-        for obj, bm in zip(objs, bm_meshes):
-            for face in bm.faces:
-                for lp in face.loops:
-                    if lp.edge.is_boundary or lp.link_loop_prev.edge.is_boundary:
-                        update_loops.append((obj, bm, lp))
-
-
-        for obj, bm, loop_focus in update_loops:
-            weighted_normal = mathutils.Vector((0, 0, 0))
+        #Boundary loops of every object, in world space
+        data = [boundary_loop_data(obj) for obj in objs]
+        counts = [len(d[0]) for d in data]
+        positions = np.concatenate([d[1] for d in data])
+        weighted = np.concatenate([d[3] * d[4][:, None] for d in data])
+
+        #Angle weighted sum of the face normals of every boundary loop at the same point
+        normals = np.zeros((len(positions), 3))
+        if len(positions):
+            kd = brushMath.build_kdtree(positions)
+            point_idx, center_idx, dist = brushMath.gather_pairs(kd, positions.tolist(), EPSILON)
+            np.add.at(normals, center_idx, weighted[point_idx])
+        normals = meshArrays.normalize(normals)
             
-            for obj_peer, bm_peer, loop_peer in update_loops:
-                if (loop_peer.vert.co - loop_focus.vert.co).length < epsilon:
-                    weighted_normal += loop_peer.face.normal * loop_peer.calc_angle()
-           
-            weighted_normal.normalize()
-            key = (obj.name, loop_focus.index)
-            update_normals[key] = weighted_normal
-            
-        for obj in objs:
-            mesh = obj.data
-            
-            normals = []
-            for loop in mesh.loops:
-                key = (obj.name, loop.index)
-                if key in update_normals:
-                    normals.append(update_normals[key])
-                else:
-                    normals.append(mathutils.Vector((0, 0, 0)))
-                
-            mesh.normals_split_custom_set(normals)
-        
-        #Write back to source meshes
-        for bm, obj in zip(bm_meshes, objs):
-            bm.free()
+        offset = 0
+        for obj, d, count in zip(objs, data, counts):
+            write_world_normals(obj, d[0], normals[offset:offset + count])
+            offset += count
             
         return {'FINISHED'}
         
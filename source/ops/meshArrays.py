@@ -0,0 +1,176 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import numpy as np
+
+#Bulk accessors for mesh data.  Everything is read and written with
+# foreach_get/foreach_set so that no per-element Python objects are created.
+
+def read_vertex_coords(mesh):
+    coords = np.empty(len(mesh.vertices) * 3, dtype = np.float32)
+    mesh.vertices.foreach_get("co", coords)
+    return coords.reshape(-1, 3)
+
+def read_vertex_normals(mesh):
+    normals = np.empty(len(mesh.vertices) * 3, dtype = np.float32)
+    mesh.vertices.foreach_get("normal", normals)
+    return normals.reshape(-1, 3)
+
+def read_vertex_select(mesh):
+    select = np.empty(len(mesh.vertices), dtype = bool)
+    mesh.vertices.foreach_get("select", select)
+    return select
+
+def read_edge_vertices(mesh):
+    verts = np.empty(len(mesh.edges) * 2, dtype = np.int32)
+    mesh.edges.foreach_get("vertices", verts)
+    return verts.reshape(-1, 2)
+
+def read_loop_vertex_indices(mesh):
+    indices = np.empty(len(mesh.loops), dtype = np.int32)
+    mesh.loops.foreach_get("vertex_index", indices)
+    return indices
+
+#Split normal of every loop in local space
+def read_loop_normals(mesh):
+    normals = np.empty(len(mesh.loops) * 3, dtype = np.float32)
+    if bpy.app.version >= (4, 1, 0):
+        mesh.corner_normals.foreach_get("vector", normals)
+    else:
+        mesh.calc_normals_split()
+        mesh.loops.foreach_get("normal", normals)
+    return normals.reshape(-1, 3)
+
+def read_polygon_normals(mesh):
+    normals = np.empty(len(mesh.polygons) * 3, dtype = np.float32)
+    mesh.polygons.foreach_get("normal", normals)
+    return normals.reshape(-1, 3)
+
+def read_polygon_centers(mesh):
+    centers = np.empty(len(mesh.polygons) * 3, dtype = np.float32)
+    mesh.polygons.foreach_get("center", centers)
+    return centers.reshape(-1, 3)
+
+def read_polygon_select(mesh):
+    select = np.empty(len(mesh.polygons), dtype = bool)
+    mesh.polygons.foreach_get("select", select)
+    return select
+
+#Index of the polygon that owns each loop
+def read_loop_polygon_indices(mesh):
+    totals = np.empty(len(mesh.polygons), dtype = np.int32)
+    mesh.polygons.foreach_get("loop_total", totals)
+    return np.repeat(np.arange(len(mesh.polygons), dtype = np.int32), totals)
+
+def read_loop_edge_indices(mesh):
+    indices = np.empty(len(mesh.loops), dtype = np.int32)
+    mesh.loops.foreach_get("edge_index", indices)
+    return indices
+
+#Returns (prev, next) arrays giving the loops before and after each loop around its polygon
+def read_loop_neighbors(mesh):
+    starts = np.empty(len(mesh.polygons), dtype = np.int32)
+    mesh.polygons.foreach_get("loop_start", starts)
+    totals = np.empty(len(mesh.polygons), dtype = np.int32)
+    mesh.polygons.foreach_get("loop_total", totals)
+
+    loop_starts = np.repeat(starts, totals)
+    loop_totals = np.repeat(totals, totals)
+    pos = np.arange(len(loop_starts)) - loop_starts
+    prev = loop_starts + (pos - 1) % loop_totals
+    next = loop_starts + (pos + 1) % loop_totals
+    return prev, next
+
+#Returns (loops, verts) arrays of shape (n, 3) describing the triangulation of the mesh
+def read_loop_triangles(mesh):
+    mesh.calc_loop_triangles()
+    count = len(mesh.loop_triangles)
+
+    loops = np.empty(count * 3, dtype = np.int32)
+    mesh.loop_triangles.foreach_get("loops", loops)
+    verts = np.empty(count * 3, dtype = np.int32)
+    mesh.loop_triangles.foreach_get("vertices", verts)
+
+    return loops.reshape(-1, 3), verts.reshape(-1, 3)
+
+#normals - (n, 3) array of local space normals, one per loop.  Zero length vectors reset a loop to its automatic normal.
+def write_loop_normals(mesh, normals):
+    mesh.normals_split_custom_set(normals)
+    mesh.update()
+
+
+#---------------------------
+
+def matrix_to_array(matrix):
+    return np.array(matrix, dtype = np.float64)
+
+#Apply a 4x4 matrix to an (n, 3) array of points
+def transform_points(matrix, points):
+    m = matrix_to_array(matrix)
+    return points @ m[:3, :3].T + m[:3, 3]
+
+#Apply the rotational part of a 4x4 matrix to an (n, 3) array of directions
+def transform_directions(matrix, dirs):
+    m = matrix_to_array(matrix)
+    return dirs @ m[:3, :3].T
+
+#Transform an (n, 3) array of normals by the inverse transpose of matrix.  Result is normalized.
+def transform_normals(matrix, normals):
+    m = matrix_to_array(matrix)
+    mIT = np.linalg.inv(m[:3, :3]).T
+    return normalize(normals @ mIT.T)
+
+#Normalize the rows of an (n, 3) array.  Zero length rows are left as zero.
+def normalize(vectors):
+    lengths = np.linalg.norm(vectors, axis = 1, keepdims = True)
+    return np.divide(vectors, lengths, out = np.zeros_like(vectors), where = lengths > 1e-12)
+
+#---------------------------
+
+#Compressed sparse row lookup for a one to many mapping.
+#rows - (n,) array giving the row each item belongs to
+#count - number of rows
+#Returns (offsets, items) so that the items in row r are items[offsets[r]:offsets[r + 1]]
+def build_csr(rows, count):
+    items = np.argsort(rows, kind = 'stable').astype(np.int32)
+    offsets = np.zeros(count + 1, dtype = np.int64)
+    np.cumsum(np.bincount(rows, minlength = count), out = offsets[1:])
+    return offsets, items
+
+#Gather the items of several rows of a CSR table
+#Returns (sources, items) where sources[i] is the position in rows that items[i] came from
+def expand_csr(offsets, items, rows):
+    rows = np.asarray(rows)
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    sources = np.repeat(np.arange(len(rows)), counts)
+    positions = np.arange(len(sources)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    return sources, items[positions]
+
+#Table mapping each vertex to the loops that use it
+def build_vertex_loops(mesh, loop_verts = None):
+    if loop_verts is None:
+        loop_verts = read_loop_vertex_indices(mesh)
+    return build_csr(loop_verts, len(mesh.vertices))
+
+#Table mapping each vertex to the vertices it shares an edge with
+def build_vertex_adjacency(mesh):
+    edges = read_edge_vertices(mesh)
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    cols = np.concatenate((edges[:, 1], edges[:, 0]))
+    offsets, items = build_csr(rows, len(mesh.vertices))
+    return offsets, cols[items]
@@ -0,0 +1,382 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import numpy as np
+
+from . import brushMath
+from . import meshArrays
+from . import normalLayers
+
+#Marks a cache whose positions come from the evaluated mesh
+EVALUATED = "<evaluated>"
+
+#Number of write_normals() calls remembered by changed_since()
+CHANGE_LOG_SIZE = 64
+
+#Largest distance, as a fraction of the mesh size, an original vertex may be from the evaluated
+# vertex it is matched to when the modifiers renumber vertices
+EVAL_MATCH_TOLERANCE = 1e-3
+
+#Loops handled per step when a cache is built a step at a time
+LOOP_STEP = 131072
+
+#Slices splitting count loops into ranges of at most step
+def loop_ranges(count, step = LOOP_STEP):
+    for start in range(0, count, step):
+        yield slice(start, min(start + step, count))
+
+#Number of ranges loop_ranges() gives for count loops
+def loop_step_count(count, step = LOOP_STEP):
+    return -(-count // step)
+
+#Modifiers that only move vertices, or only change other data
+DEFORM_MODIFIERS = {
+    'ARMATURE', 'CAST', 'CLOTH', 'CORRECTIVE_SMOOTH', 'CURVE', 'DATA_TRANSFER', 'DISPLACE', 'HOOK',
+    'LAPLACIANDEFORM', 'LAPLACIANSMOOTH', 'LATTICE', 'MESH_CACHE', 'MESH_DEFORM', 'NORMAL_EDIT',
+    'SHRINKWRAP', 'SIMPLE_DEFORM', 'SMOOTH', 'SOFT_BODY', 'SURFACE_DEFORM', 'UV_PROJECT', 'UV_WARP',
+    'VERTEX_WEIGHT_EDIT', 'VERTEX_WEIGHT_MIX', 'VERTEX_WEIGHT_PROXIMITY', 'WARP', 'WAVE', 'WEIGHTED_NORMAL'
+    }
+
+
+#True if every modifier of obj shown in the viewport keeps the original vertices first and in
+# order.  Deform modifiers do, and so do Subdivision Surface, Multiresolution, Mirror and Array
+# without merging and simple Solidify, which add their new vertices after the originals.
+def keeps_vertex_order(obj):
+    for mod in obj.modifiers:
+        if not mod.show_viewport or mod.type in DEFORM_MODIFIERS or mod.type in ('SUBSURF', 'MULTIRES'):
+            continue
+        if mod.type == 'MIRROR' and not mod.use_mirror_merge:
+            continue
+        if mod.type == 'ARRAY' and not mod.use_merge_vertices and mod.start_cap == None and mod.end_cap == None:
+            continue
+        if mod.type == 'SOLIDIFY' and mod.solidify_mode == 'EXTRUDE':
+            continue
+        return False
+    return True
+
+#Index of the evaluated vertex standing in for each original vertex
+#base_coords, loop_verts - vertex positions and loop vertices of the original mesh
+#eval_coords, eval_loop_verts - the same for the evaluated mesh
+#keeps_order - result of keeps_vertex_order() for the object
+#Returns (eval_index, same_faces) where same_faces is True if the first faces of the evaluated mesh
+# are the original faces, or (None, False) if the vertices cannot be matched
+def match_evaluated_vertices(base_coords, loop_verts, eval_coords, eval_loop_verts, keeps_order):
+    count = len(base_coords)
+    same_faces = np.array_equal(eval_loop_verts[:len(loop_verts)], loop_verts)
+    if len(eval_coords) >= count and (keeps_order or same_faces):
+        return np.arange(count), same_faces
+
+    #Other modifiers (eg, Weld, Boolean or Mirror with merging) renumber vertices.  Each original
+    # vertex is matched to the evaluated vertex at its rest position, which fails if a modifier
+    # moved or removed it (eg, Bevel, Decimate, Remesh or any deform modifier before them).
+    if len(eval_coords) == 0:
+        return None, False
+    tolerance = max(float(np.ptp(base_coords, axis = 0).max()) if count else 0, 1e-6) * EVAL_MATCH_TOLERANCE
+    kd = brushMath.build_kdtree(eval_coords)
+    eval_index = np.empty(count, dtype = np.int64)
+    for i, co in enumerate(base_coords.tolist()):
+        found_co, idx, dist = kd.find(co)
+        if idx == None or dist > tolerance:
+            return None, False
+        eval_index[i] = idx
+    return eval_index, False
+
+
+class MeshCache:
+    """Arrays describing one mesh object.  Read once and reused for every dab of a session."""
+
+    #use_shape_keys - if true, positions come from the active shape key of obj rather than the base mesh
+    def __init__(self, obj, use_shape_keys = False):
+        for step in self.read_steps(obj, use_shape_keys):
+            pass
+
+    #Build a cache a step at a time, so a large mesh can be read from a timer without stalling
+    # the interface.  Yields between steps; the finished cache is the return value.
+    @classmethod
+    def build_steps(cls, obj, use_shape_keys = False):
+        cache = cls.__new__(cls)
+        yield from cache.read_steps(obj, use_shape_keys)
+        return cache
+
+    #Number of times build_steps() yields for mesh
+    @staticmethod
+    def build_step_count(mesh):
+        return 5 + loop_step_count(len(mesh.loops))
+
+    #The work of __init__().  Each bulk read is one step, as foreach_get() can only read a whole
+    # collection, and work done per loop is split into LOOP_STEP loop ranges.
+    def read_steps(self, obj, use_shape_keys):
+        self.obj = obj
+        mesh = obj.data
+
+        self.base_coords = meshArrays.read_vertex_coords(mesh)
+        self.base_vert_normals = meshArrays.read_vertex_normals(mesh)
+        self.base_poly_normals = meshArrays.read_polygon_normals(mesh)
+        self.vert_select = meshArrays.read_vertex_select(mesh)
+        self.poly_select = meshArrays.read_polygon_select(mesh)
+        yield
+
+        self.loop_verts = meshArrays.read_loop_vertex_indices(mesh)
+        self.loop_polys = meshArrays.read_loop_polygon_indices(mesh)
+        yield
+
+        self.vert_loops = meshArrays.build_csr(self.loop_verts, len(self.base_coords))
+        yield
+
+        self._world_coords = None
+        self._kdtree = None
+        self._adjacency = None
+        self._triangles = None
+
+        #Incremented whenever coords or loop_normals change
+        self.revision = 0
+        #Incremented whenever coords change
+        self.geometry = 0
+        #True if mesh_normals has edits the mesh does not have yet
+        self.mesh_dirty = False
+        #(revision, loops) for recent calls to write_normals()
+        self.change_log = collections.deque(maxlen = CHANGE_LOG_SIZE)
+
+        self.layers = None
+        self.layer_key = None
+        yield from self.read_normals(normalLayers.stack_key(mesh))
+
+        self.shape_key = None
+        self.eval_index = None
+        self.eval_same_faces = False
+        #Why evaluated positions cannot be used, once that has been found out
+        self.eval_error = None
+        self.coords = self.base_coords
+        self.vert_normals = self.base_vert_normals
+        self.poly_normals = self.base_poly_normals
+        self.sync_shape_key(use_shape_keys)
+        yield
+
+    #Make coords and the spatial index follow the active shape key (or the base mesh if
+    # use_shape_keys is false).  Key data is only read again when the active key changes.
+    #Returns True if the positions changed
+    def sync_shape_key(self, use_shape_keys):
+        key = self.obj.active_shape_key if use_shape_keys else None
+        name = None if key == None else key.name
+        if name == self.shape_key:
+            return False
+
+        self.shape_key = name
+        if key == None:
+            self.coords = self.base_coords
+            self.vert_normals = self.base_vert_normals
+            self.poly_normals = self.base_poly_normals
+        else:
+            coords = np.empty(len(self.base_coords) * 3, dtype = np.float32)
+            key.data.foreach_get("co", coords)
+            self.coords = coords.reshape(-1, 3)
+            self.vert_normals = np.array(key.normals_vertex_get(), dtype = np.float32).reshape(-1, 3)
+            self.poly_normals = np.array(key.normals_polygon_get(), dtype = np.float32).reshape(-1, 3)
+
+        self._world_coords = None
+        self._kdtree = None
+        self.revision += 1
+        self.geometry += 1
+        self.change_log.clear()
+        return True
+
+    @property
+    def evaluated(self):
+        return self.shape_key == EVALUATED
+
+    #Take positions from the mesh as deformed by its modifiers.  Evaluated vertices are matched
+    # to original vertices through eval_index, which is worked out by match_evaluated_vertices()
+    # on the first call and reused.
+    #Returns False and sets eval_error if the modifiers change the mesh in a way that cannot be
+    # matched.  Later calls then return False straight away.
+    def sync_evaluated(self, depsgraph):
+        if self.eval_error != None:
+            return False
+
+        obj_eval = self.obj.evaluated_get(depsgraph)
+        mesh = obj_eval.to_mesh()
+        try:
+            coords = meshArrays.read_vertex_coords(mesh)
+            if self.eval_index is None or (len(self.eval_index) and self.eval_index.max() >= len(coords)):
+                self.eval_index, self.eval_same_faces = match_evaluated_vertices(self.base_coords, self.loop_verts,
+                    coords, meshArrays.read_loop_vertex_indices(mesh), keeps_vertex_order(self.obj))
+                if self.eval_index is None:
+                    self.eval_error = "Modifiers of %s move or remove its vertices, so the brush uses the undeformed mesh" % self.obj.name
+                    return False
+
+            coords = coords[self.eval_index]
+            #Read at the start of every stroke, so nothing built from the positions is thrown away
+            # unless the pose actually changed
+            if self.evaluated and np.array_equal(coords, self.coords):
+                return True
+
+            self.coords = coords
+            self.vert_normals = meshArrays.read_vertex_normals(mesh)[self.eval_index]
+            if self.eval_same_faces:
+                self.poly_normals = meshArrays.read_polygon_normals(mesh)[:len(self.base_poly_normals)]
+            else:
+                self.poly_normals = self.base_poly_normals
+        finally:
+            obj_eval.to_mesh_clear()
+
+        self.shape_key = EVALUATED
+        self._world_coords = None
+        self._kdtree = None
+        self.revision += 1
+        self.geometry += 1
+        self.change_log.clear()
+        return True
+
+    #Vertex positions in world space
+    def world_coords(self):
+        if self._world_coords is None:
+            self._world_coords = meshArrays.transform_points(self.obj.matrix_world, self.coords)
+        return self._world_coords
+
+    #KD-tree of world space vertex positions
+    def kdtree(self):
+        if self._kdtree is None:
+            self._kdtree = brushMath.build_kdtree(self.world_coords())
+        return self._kdtree
+
+    #Build the KD-tree a step at a time, inserting brushMath.KDTREE_STEP vertices per step.
+    # Yields between steps.  A tree built from positions that changed meanwhile is dropped.
+    def kdtree_steps(self):
+        if self._kdtree is None:
+            geometry = self.geometry
+            kd = yield from brushMath.build_kdtree_steps(self.world_coords())
+            if geometry == self.geometry:
+                self._kdtree = kd
+
+    #CSR table (offsets, neighbors) of vertices connected by an edge
+    def vertex_adjacency(self):
+        if self._adjacency is None:
+            self._adjacency = meshArrays.build_vertex_adjacency(self.obj.data)
+        return self._adjacency
+
+    #Vertex indices of the mesh's triangulated faces as a (n, 3) array
+    def triangles(self):
+        if self._triangles is None:
+            self._triangles = meshArrays.read_loop_triangles(self.obj.data)[1]
+        return self._triangles
+
+    #Make loop_normals follow the active normal layer of the mesh, or its custom normals if it has no
+    # layers.  Layer data is only read again when the layers, their weights or the active layer change.
+    #Returns True if the normals changed
+    def sync_layers(self):
+        key = normalLayers.stack_key(self.obj.data)
+        if key == self.layer_key:
+            return False
+
+        self.flush_normals()
+        self.flush_layers()
+        for step in self.read_normals(key):
+            pass
+        return True
+
+    #Read the normals the brush edits: the custom normals of the mesh, or the layer stack if key
+    # (from normalLayers.stack_key()) is not None.  Yields after the read and after each LOOP_STEP
+    # loops converted or blended.
+    def read_normals(self, key):
+        mesh = self.obj.data
+        self.layer_key = key
+        if key == None:
+            self.layers = None
+            normals = meshArrays.read_loop_normals(mesh)
+            yield
+            self.loop_normals = np.empty(normals.shape, dtype = np.float64)
+            for loops in loop_ranges(len(normals)):
+                self.loop_normals[loops] = normals[loops]
+                yield
+            self.mesh_normals = self.loop_normals
+        else:
+            self.layers = normalLayers.LayerStack(mesh)
+            yield
+            self.loop_normals = self.layers.active_normals
+            self.mesh_normals = np.empty(self.loop_normals.shape, dtype = np.float64)
+            for loops in loop_ranges(len(self.loop_normals)):
+                self.mesh_normals[loops] = self.layers.blend(self.layer_base(loops), loops)
+                yield
+
+        self.revision += 1
+        self.change_log.clear()
+
+    #Vertex normal of each loop (or only the given loops) that normal layers are blended over
+    def layer_base(self, loops = None):
+        if loops is None:
+            return self.base_vert_normals[self.loop_verts]
+        return self.base_vert_normals[self.loop_verts[loops]]
+
+    #Write edits made by write_normals() to the custom normals of the mesh
+    def flush_normals(self):
+        if self.mesh_dirty:
+            meshArrays.write_loop_normals(self.obj.data, self.mesh_normals)
+            self.mesh_dirty = False
+
+    #Write edits of the active normal layer to its mesh attribute
+    def flush_layers(self):
+        if self.layers != None:
+            self.layers.flush(self.obj.data)
+
+    #Loops using each of verts.  Returns (sources, loops) as from meshArrays.expand_csr()
+    def loops_of_verts(self, verts):
+        offsets, items = self.vert_loops
+        return meshArrays.expand_csr(offsets, items, verts)
+
+    #Re-read normals after the mesh was changed by something other than write_normals()
+    def refresh_normals(self):
+        #The layer arrays are out of date too, so they are read again rather than flushed
+        self.mesh_dirty = False
+        self.layers = None
+        self.layer_key = None
+        self.loop_normals = meshArrays.read_loop_normals(self.obj.data).astype(np.float64)
+        self.mesh_normals = self.loop_normals
+        self.sync_layers()
+        self.revision += 1
+        self.change_log.clear()
+
+    #Replace the normals of some loops.  With normal layers, only the changed loops are blended again.
+    #Setting custom normals always writes the whole mesh, so the mesh is only updated by
+    # flush_normals() and the layer by flush_layers(), which callers make once per stroke or frame.
+    def write_normals(self, loops, normals):
+        self.loop_normals[loops] = normals
+        if self.layers != None:
+            self.layers.dirty = True
+            self.mesh_normals[loops] = self.layers.blend(self.layer_base(loops), loops)
+        self.mesh_dirty = True
+        self.revision += 1
+        self.change_log.append((self.revision, np.asarray(loops)))
+
+    #Loops whose normals were replaced since the given revision, or None if that is not known
+    # (eg, everything was re-read or the positions changed)
+    def changed_since(self, revision):
+        if revision == self.revision:
+            return np.zeros(0, dtype = np.int64)
+        if not self.change_log or self.change_log[0][0] > revision + 1:
+            return None
+        return np.unique(np.concatenate([loops for rev, loops in self.change_log if rev > revision]))
+
+    #Line segments from each loop's vertex along its normal, as a (2 * loops, 3) array
+    #loops - indices or a slice of the loops to draw, or None for every loop
+    def normal_lines(self, length, loops = None):
+        if loops is None:
+            loops = slice(None)
+        verts = self.loop_verts[loops]
+        lines = np.empty((len(verts) * 2, 3), dtype = np.float32)
+        lines[0::2] = self.coords[verts]
+        lines[1::2] = lines[0::2] + self.mesh_normals[loops] * length
+        return lines
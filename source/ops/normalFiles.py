@@ -0,0 +1,205 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import hashlib
+import os
+import struct
+import zipfile
+import numpy as np
+
+from . import meshArrays
+from . import normalLayers
+
+#Custom normals are saved as a sidecar file that can be applied to another copy of the mesh
+# without opening the .blend they came from.
+#   .npz - 'normals' (loops, 3) float32 array and a 'fingerprint' of the mesh topology.  Stored
+#          uncompressed so the normals can be memory mapped straight out of the archive.
+#   .npy - only the (loops, 3) normals, for other tools.  Checked against the loop count only.
+
+#Zip local file header.  Only the signature and the lengths of the name and extra field are needed.
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+
+#Hash of the connectivity of a mesh.  Meshes with the same fingerprint have their loops in the
+# same order, though their vertices may have moved.
+def topology_fingerprint(mesh):
+    totals = np.empty(len(mesh.polygons), dtype = np.int32)
+    mesh.polygons.foreach_get("loop_total", totals)
+
+    h = hashlib.blake2b(digest_size = 16)
+    h.update(np.array((len(mesh.vertices), len(mesh.edges), len(mesh.loops), len(mesh.polygons)), dtype = np.int64).tobytes())
+    h.update(totals.tobytes())
+    h.update(meshArrays.read_loop_vertex_indices(mesh).tobytes())
+    return h.hexdigest()
+
+def export_normals(obj, filepath):
+    mesh = obj.data
+    normals = meshArrays.read_loop_normals(mesh)
+
+    if os.path.splitext(filepath)[1].lower() == ".npy":
+        np.save(filepath, normals)
+    else:
+        with open(filepath, 'wb') as f:
+            np.savez(f, normals = normals, fingerprint = np.array(topology_fingerprint(mesh)))
+
+#Memory map an array stored uncompressed in a .npz archive
+def map_npz_member(filepath, name):
+    with zipfile.ZipFile(filepath) as zf:
+        info = zf.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(filepath) as data:
+            return data[name]
+
+    with open(filepath, 'rb') as f:
+        f.seek(info.header_offset)
+        signature, name_len, extra_len = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+        if signature != b'PK\x03\x04':
+            raise ValueError("Corrupt archive: " + filepath)
+        f.seek(name_len + extra_len, os.SEEK_CUR)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(filepath, dtype = dtype, mode = 'r', offset = offset, shape = shape, order = 'F' if fortran_order else 'C')
+
+#Read normals saved by export_normals() for the mesh of obj
+#Raises ValueError if they were saved from a mesh with different topology
+def load_normals(obj, filepath):
+    mesh = obj.data
+
+    if os.path.splitext(filepath)[1].lower() == ".npy":
+        normals = np.load(filepath, mmap_mode = 'r')
+    else:
+        with np.load(filepath) as data:
+            if "fingerprint" not in data or "normals" not in data:
+                raise ValueError("Not a normals file: " + filepath)
+            fingerprint = str(data["fingerprint"])
+        if fingerprint != topology_fingerprint(mesh):
+            raise ValueError("Normals in %s were saved from a mesh with different topology than %s" % (os.path.basename(filepath), obj.name))
+        normals = map_npz_member(filepath, "normals")
+
+    if normals.shape != (len(mesh.loops), 3):
+        raise ValueError("%s holds %d normals but %s has %d loops" % (os.path.basename(filepath), len(normals), obj.name, len(mesh.loops)))
+    return normals
+
+def import_normals(obj, filepath):
+    normals = np.ascontiguousarray(load_normals(obj, filepath), dtype = np.float32)
+    if not normalLayers.write_active_layer(obj.data, None, normals):
+        meshArrays.write_loop_normals(obj.data, normals)
+
+
+#---------------------------
+
+class ExportNormalsOperator(bpy.types.Operator):
+    """Save the custom normals of the active mesh to a .npz (or .npy) file"""
+    bl_idname = "kitfox.nt_export_normals"
+    bl_label = "Export Normals"
+
+    filepath : bpy.props.StringProperty(
+        name = "File Path",
+        description = "File to save normals to",
+        subtype = 'FILE_PATH'
+    )
+
+    filter_glob : bpy.props.StringProperty(
+        default = "*.npz;*.npy",
+        options = {'HIDDEN'}
+    )
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj != None and obj.type == 'MESH' and obj.mode == 'OBJECT'
+
+    def execute(self, context):
+        obj = context.active_object
+        filepath = bpy.path.abspath(self.filepath)
+        if not os.path.splitext(filepath)[1]:
+            filepath += ".npz"
+
+        try:
+            export_normals(obj, filepath)
+        except OSError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, "Saved %d normals of %s" % (len(obj.data.loops), obj.name))
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = bpy.path.clean_name(context.active_object.name) + ".npz"
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+#---------------------------
+
+class ImportNormalsOperator(bpy.types.Operator):
+    """Apply custom normals saved by Export Normals to the active mesh.  The mesh must have the same topology it was saved from"""
+    bl_idname = "kitfox.nt_import_normals"
+    bl_label = "Import Normals"
+    bl_options = {"REGISTER", "UNDO"}
+
+    filepath : bpy.props.StringProperty(
+        name = "File Path",
+        description = "File to load normals from",
+        subtype = 'FILE_PATH'
+    )
+
+    filter_glob : bpy.props.StringProperty(
+        default = "*.npz;*.npy",
+        options = {'HIDDEN'}
+    )
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj != None and obj.type == 'MESH' and obj.mode == 'OBJECT'
+
+    def execute(self, context):
+        obj = context.active_object
+        try:
+            import_normals(obj, bpy.path.abspath(self.filepath))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.report({'INFO'}, "Loaded %d normals onto %s" % (len(obj.data.loops), obj.name))
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+#---------------------------
+
+def register():
+    bpy.utils.register_class(ExportNormalsOperator)
+    bpy.utils.register_class(ImportNormalsOperator)
+
+
+def unregister():
+    bpy.utils.unregister_class(ExportNormalsOperator)
+    bpy.utils.unregister_class(ImportNormalsOperator)
+
+
+if __name__ == "__main__":
+    register()
@@ -0,0 +1,330 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import numpy as np
+
+from . import meshArrays
+
+#Normal layers are stored as FLOAT_VECTOR face corner attributes of the mesh.  The stack is
+# blended from the bottom up, starting from the vertex normals, with each layer mixed over the
+# layers below it by its weight.  The result is written to the custom normals of the mesh.
+
+ATTRIBUTE_PREFIX = "normal_layer."
+
+
+def read_layer(mesh, attribute):
+    normals = np.empty(len(mesh.loops) * 3, dtype = np.float32)
+    mesh.attributes[attribute].data.foreach_get("vector", normals)
+    return normals.reshape(-1, 3)
+
+def write_layer(mesh, attribute, normals):
+    mesh.attributes[attribute].data.foreach_set("vector", np.ascontiguousarray(normals, dtype = np.float32).ravel())
+
+#Layers of the mesh whose attributes exist, bottom first.  Returns (list of (attribute, weight), position of the active layer)
+def stack_layers(mesh):
+    layers = []
+    active = -1
+    for i, layer in enumerate(mesh.normal_layers):
+        if layer.attribute not in mesh.attributes:
+            continue
+        if i == mesh.normal_layer_index:
+            active = len(layers)
+        layers.append((layer.attribute, layer.weight))
+    if active == -1:
+        active = len(layers) - 1
+    return layers, active
+
+#Identifies the layers of a mesh, their weights and the active layer.  None if the mesh has no layers.
+def stack_key(mesh):
+    layers, active = stack_layers(mesh)
+    if not layers:
+        return None
+    return (tuple(layers), active)
+
+#Blend layers over base.  base and every layer are (n, 3) arrays.  Returns normalized (n, 3) float64 array.
+def blend_layers(base, layers, weights):
+    #Layers under the top layer with full weight are hidden, so blending starts there
+    start = 0
+    for i, weight in enumerate(weights):
+        if weight >= 1:
+            start = i + 1
+    result = np.array(layers[start - 1] if start > 0 else base, dtype = np.float64)
+
+    step = np.empty_like(result)
+    for layer, weight in zip(layers[start:], weights[start:]):
+        if weight <= 0:
+            continue
+        np.subtract(layer, result, out = step)
+        step *= weight
+        result += step
+
+    #Zero length rows are left as zero
+    lengths = np.sqrt(np.einsum('ij,ij->i', result, result))
+    np.maximum(lengths, 1e-12, out = lengths)
+    result /= lengths[:, None]
+    return result
+
+#Blend the layers of a mesh and write the result to its custom normals
+def resolve_mesh(mesh):
+    layers, active = stack_layers(mesh)
+    if not layers:
+        return
+    base = meshArrays.read_vertex_normals(mesh)[meshArrays.read_loop_vertex_indices(mesh)]
+    normals = blend_layers(base, [read_layer(mesh, attribute) for attribute, weight in layers], [weight for attribute, weight in layers])
+    meshArrays.write_loop_normals(mesh, normals)
+
+#Write normals the way the brush does.  With normal layers they go into the active layer and the
+# stack is blended again, so the next blend keeps them.  Other tools call this rather than
+# setting the custom normals of a layered mesh directly.
+#loops - indices of the loops to change, or None for every loop
+#normals - local space normals for those loops
+#Returns False, and changes nothing, if the mesh has no layers
+def write_active_layer(mesh, loops, normals):
+    layers, active = stack_layers(mesh)
+    if not layers:
+        return False
+    attribute = layers[active][0]
+    if loops is None:
+        write_layer(mesh, attribute, normals)
+    else:
+        values = read_layer(mesh, attribute)
+        values[loops] = normals
+        write_layer(mesh, attribute, values)
+    resolve_mesh(mesh)
+    return True
+
+
+class LayerStack:
+    """Arrays of the normal layers of one mesh.  Edits go to the array of the active layer and are
+    written to its attribute by flush()."""
+
+    def __init__(self, mesh):
+        layers, self.active = stack_layers(mesh)
+        self.attributes = [attribute for attribute, weight in layers]
+        self.weights = [weight for attribute, weight in layers]
+        self.layers = [read_layer(mesh, attribute).astype(np.float64) for attribute in self.attributes]
+        #True if the active layer has edits its attribute does not have yet
+        self.dirty = False
+
+    @property
+    def active_normals(self):
+        return self.layers[self.active]
+
+    #Blended normals of some loops.  base holds the vertex normal of each of those loops.
+    #loops - indices of the loops to blend, or None for every loop
+    def blend(self, base, loops = None):
+        if loops is None:
+            return blend_layers(base, self.layers, self.weights)
+        return blend_layers(base, [layer[loops] for layer in self.layers], self.weights)
+
+    def flush(self, mesh):
+        if self.dirty and self.attributes[self.active] in mesh.attributes:
+            write_layer(mesh, self.attributes[self.active], self.active_normals)
+        self.dirty = False
+
+
+#---------------------------
+
+def layer_weight_changed(self, context):
+    resolve_mesh(self.id_data)
+
+#Keep the attribute named after the layer
+def layer_name_changed(self, context):
+    mesh = self.id_data
+    attr = mesh.attributes.get(self.attribute)
+    if attr != None and attr.name != ATTRIBUTE_PREFIX + self.name:
+        attr.name = ATTRIBUTE_PREFIX + self.name
+        #The attribute may have been given a different name to keep it unique
+        self.attribute = attr.name
+
+class NormalLayer(bpy.types.PropertyGroup):
+    name : bpy.props.StringProperty(
+        name = "Name",
+        description = "Name of the normal layer",
+        default = "Layer",
+        update = layer_name_changed
+    )
+
+    weight : bpy.props.FloatProperty(
+        name = "Weight",
+        description = "How much this layer covers the layers below it",
+        default = 1,
+        min = 0,
+        max = 1,
+        subtype = 'FACTOR',
+        update = layer_weight_changed
+    )
+
+    attribute : bpy.props.StringProperty(
+        name = "Attribute",
+        description = "Face corner attribute holding the normals of this layer",
+        options = {'HIDDEN'}
+    )
+
+#---------------------------
+
+class AddNormalLayerOperator(bpy.types.Operator):
+    """Add a normal layer to the active mesh, starting from its current normals"""
+    bl_idname = "kitfox.nt_add_normal_layer"
+    bl_label = "Add Normal Layer"
+    bl_options = {"REGISTER", "UNDO"}
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj != None and obj.type == 'MESH' and obj.mode == 'OBJECT'
+
+    def execute(self, context):
+        mesh = context.active_object.data
+
+        name = "Base" if len(mesh.normal_layers) == 0 else "Layer"
+        attr = mesh.attributes.new(ATTRIBUTE_PREFIX + name, 'FLOAT_VECTOR', 'CORNER')
+        #A new layer over the blended result at full weight leaves the normals unchanged
+        write_layer(mesh, attr.name, meshArrays.read_loop_normals(mesh))
+
+        layer = mesh.normal_layers.add()
+        layer.attribute = attr.name
+        layer.name = attr.name[len(ATTRIBUTE_PREFIX):]
+        mesh.normal_layer_index = len(mesh.normal_layers) - 1
+        return {'FINISHED'}
+
+class RemoveNormalLayerOperator(bpy.types.Operator):
+    """Remove the active normal layer of the active mesh"""
+    bl_idname = "kitfox.nt_remove_normal_layer"
+    bl_label = "Remove Normal Layer"
+    bl_options = {"REGISTER", "UNDO"}
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj != None and obj.type == 'MESH' and obj.mode == 'OBJECT' and len(obj.data.normal_layers) > 0
+
+    def execute(self, context):
+        mesh = context.active_object.data
+        idx = min(mesh.normal_layer_index, len(mesh.normal_layers) - 1)
+
+        attr = mesh.attributes.get(mesh.normal_layers[idx].attribute)
+        if attr != None:
+            mesh.attributes.remove(attr)
+        mesh.normal_layers.remove(idx)
+        mesh.normal_layer_index = max(idx - 1, 0)
+
+        #With no layers left the normals are kept as they were last blended
+        resolve_mesh(mesh)
+        return {'FINISHED'}
+
+class MoveNormalLayerOperator(bpy.types.Operator):
+    """Move the active normal layer up or down the stack"""
+    bl_idname = "kitfox.nt_move_normal_layer"
+    bl_label = "Move Normal Layer"
+    bl_options = {"REGISTER", "UNDO"}
+
+    direction : bpy.props.EnumProperty(
+        items = (
+            ('UP', "Up", ""),
+            ('DOWN', "Down", "")
+        ),
+        name = "Direction",
+        default = 'UP'
+    )
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj != None and obj.type == 'MESH' and obj.mode == 'OBJECT' and len(obj.data.normal_layers) > 1
+
+    def execute(self, context):
+        mesh = context.active_object.data
+        idx = mesh.normal_layer_index
+        #The list is drawn top layer first
+        target = idx + 1 if self.direction == 'UP' else idx - 1
+        if target < 0 or target >= len(mesh.normal_layers):
+            return {'CANCELLED'}
+
+        mesh.normal_layers.move(idx, target)
+        mesh.normal_layer_index = target
+        resolve_mesh(mesh)
+        return {'FINISHED'}
+
+#---------------------------
+
+class KITFOX_UL_normal_layers(bpy.types.UIList):
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        row = layout.row(align = True)
+        row.prop(item, "name", text = "", emboss = False)
+        row.prop(item, "weight", text = "", slider = True)
+
+class NormalLayersPropsPanel(bpy.types.Panel):
+
+    """Properties Panel for normal layers on tool shelf"""
+    bl_label = "Normal Layers"
+    bl_idname = "OBJECT_PT_normal_layers_props"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = "Kitfox - Normal"
+
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.object
+        return obj != None and obj.type == 'MESH' and obj.mode == 'OBJECT'
+
+    def draw(self, context):
+        layout = self.layout
+        mesh = context.object.data
+
+        row = layout.row()
+        #Top of the stack is drawn first
+        row.template_list("KITFOX_UL_normal_layers", "", mesh, "normal_layers", mesh, "normal_layer_index", rows = 3, sort_reverse = True, sort_lock = True)
+
+        col = row.column(align = True)
+        col.operator("kitfox.nt_add_normal_layer", icon = 'ADD', text = "")
+        col.operator("kitfox.nt_remove_normal_layer", icon = 'REMOVE', text = "")
+        col.separator()
+        col.operator("kitfox.nt_move_normal_layer", icon = 'TRIA_UP', text = "").direction = 'UP'
+        col.operator("kitfox.nt_move_normal_layer", icon = 'TRIA_DOWN', text = "").direction = 'DOWN'
+
+
+#---------------------------
+
+def register():
+    bpy.utils.register_class(NormalLayer)
+    bpy.utils.register_class(AddNormalLayerOperator)
+    bpy.utils.register_class(RemoveNormalLayerOperator)
+    bpy.utils.register_class(MoveNormalLayerOperator)
+    bpy.utils.register_class(KITFOX_UL_normal_layers)
+    bpy.utils.register_class(NormalLayersPropsPanel)
+
+    bpy.types.Mesh.normal_layers = bpy.props.CollectionProperty(type = NormalLayer)
+    bpy.types.Mesh.normal_layer_index = bpy.props.IntProperty(name = "Active Normal Layer", default = 0)
+
+
+def unregister():
+    #The properties reference NormalLayer, so they go first
+    del bpy.types.Mesh.normal_layers
+    del bpy.types.Mesh.normal_layer_index
+
+    bpy.utils.unregister_class(NormalLayersPropsPanel)
+    bpy.utils.unregister_class(KITFOX_UL_normal_layers)
+    bpy.utils.unregister_class(MoveNormalLayerOperator)
+    bpy.utils.unregister_class(RemoveNormalLayerOperator)
+    bpy.utils.unregister_class(AddNormalLayerOperator)
+    bpy.utils.unregister_class(NormalLayer)
+
+
+if __name__ == "__main__":
+    register()
@@ -17,16 +17,29 @@
 import bpy
 import bpy.utils.previews
 import os
-import bgl
 import blf
 import gpu
 import mathutils
 import math
 import bmesh
+import numpy as np
+import time
+import collections
 
 from gpu_extras.batch import batch_for_shader
 from bpy_extras import view3d_utils
 
+from . import brushMath
+from . import falloff
+from . import meshArrays
+from . import meshCache
+from . import occlusion
+from . import overlay
+from . import profiler
+from . import recoveryJournal
+from . import strokeRecord
+from . import transferNormals
+
 def ray_cast(context, viewlayer, ray_origin, view_vector):
     if bpy.app.version >= (2, 91, 0):
         return context.scene.ray_cast(viewlayer.depsgraph, ray_origin, view_vector)
@@ -39,6 +52,38 @@ def redraw_all_viewports(context):
         if area.type == 'VIEW_3D':
             area.tag_redraw()
 
+#Corners of a unit box as (8, 3) array of 0s and 1s
+BOX_CORNERS = np.array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)], dtype = bool)
+
+#True if the bounding box of obj, grown by margin in world space, may be inside the view of rv3d
+def object_in_view(obj, rv3d, margin = 0):
+    corners = meshArrays.transform_points(obj.matrix_world, np.array([tuple(c) for c in obj.bound_box], dtype = np.float64))
+    box = np.where(BOX_CORNERS, corners.max(axis = 0) + margin, corners.min(axis = 0) - margin)
+    
+    clip = np.c_[box, np.ones(8)] @ meshArrays.matrix_to_array(rv3d.perspective_matrix).T
+    w = clip[:, 3:]
+    #Distance of each corner inside each of the six clip planes.  The box is out of view if every corner is outside one plane.
+    planes = np.concatenate((clip[:, :3] + w, w - clip[:, :3]), axis = 1)
+    return not np.any(np.all(planes < 0, axis = 0))
+
+#Tag the 3D views of every window that show some of objs for redraw.  Views in local view
+# without the objects, or looking away from them, are left alone.
+#Returns True if any view was tagged
+def redraw_views_showing(context, objs, margin = 0):
+    tagged = False
+    for window in context.window_manager.windows:
+        if window.scene != context.scene:
+            continue
+        for area in window.screen.areas:
+            if area.type != 'VIEW_3D':
+                continue
+            space = area.spaces.active
+            views = [space.region_3d] + list(space.region_quadviews)
+            if any(obj.visible_in_viewport_get(space) and any(object_in_view(obj, rv3d, margin) for rv3d in views) for obj in objs):
+                area.tag_redraw()
+                tagged = True
+    return tagged
+
 
 class NormalToolSettings(bpy.types.PropertyGroup):
     brush_type : bpy.props.EnumProperty(
@@ -48,7 +93,8 @@ class NormalToolSettings(bpy.types.PropertyGroup):
             ('ATTRACT', "Attract", "Normals point toward target object"),
             ('REPEL', "Repel", "Normals point away from target object"),
             ('SMOOTH', "Smooth", "Average the normal direction under the brush"),
-            ('VERTEX', "Vertex", "Get normal values from mesh vertices")
+            ('VERTEX', "Vertex", "Get normal values from mesh vertices"),
+            ('TRANSFER', "Transfer", "Copy normals from the nearest point on the source object")
         ),
         default='COMB'
     )
@@ -75,6 +121,52 @@ class NormalToolSettings(bpy.types.PropertyGroup):
         default = True
     )
     
+    falloff_shape : bpy.props.EnumProperty(
+        name = "Falloff", 
+        description = "How the strength of the brush fades from its center to its edge", 
+        items=(
+            ('LINEAR', "Linear", "Fade evenly to the edge"),
+            ('SMOOTH', "Smooth", "Ease in and out"),
+            ('SPHERE', "Sphere", "Stay strong until close to the edge"),
+            ('ROOT', "Root", "Fade slowly near the center"),
+            ('SHARP', "Sharp", "Fade quickly away from the center"),
+            ('CONSTANT', "Constant", "Full strength everywhere under the brush"),
+            ('CUSTOM', "Custom", "Use a custom curve")
+        ),
+        default = 'LINEAR',
+        update = falloff.update_falloff_shape
+    )
+    
+    falloff_distance : bpy.props.EnumProperty(
+        name = "Distance", 
+        description = "How distance from the brush center is measured", 
+        items=(
+            ('EUCLIDEAN', "Straight", "Straight line distance.  Fastest"),
+            ('GEODESIC', "Surface", "Distance along the surface, so the brush does not jump across gaps to nearby parts of the mesh")
+        ),
+        default = 'EUCLIDEAN'
+    )
+    
+    pressure_curve : bpy.props.EnumProperty(
+        name = "Pressure Response", 
+        description = "How pen pressure maps to brush strength", 
+        items=(
+            ('LINEAR', "Linear", "Strength is proportional to pressure"),
+            ('ROOT', "Soft", "Light pressure already gives a strong effect"),
+            ('SHARP', "Hard", "Heavy pressure is needed for a strong effect"),
+            ('CUSTOM', "Custom", "Use a custom curve")
+        ),
+        default = 'LINEAR',
+        update = falloff.update_pressure_curve
+    )
+    
+    curve_group : bpy.props.PointerProperty(
+        name = "Curves", 
+        description = "Hidden node group holding the custom falloff and pressure curves", 
+        type = bpy.types.NodeTree,
+        options = {'HIDDEN'}
+    )
+    
     normal_length : bpy.props.FloatProperty(
         name = "Normal Length", 
         description="Display length of normal", 
@@ -82,6 +174,25 @@ class NormalToolSettings(bpy.types.PropertyGroup):
         min=0, 
         soft_max = 1
     )
+    
+    overlay_color : bpy.props.EnumProperty(
+        name = "Overlay Color", 
+        description = "How normals are colored in the overlay", 
+        items=(
+            ('UNIFORM', "Uniform", "Draw every normal in the same color"),
+            ('DEVIATION', "Deviation", "Color normals by how far they have been turned from the vertex normal")
+        ),
+        default = 'UNIFORM'
+    )
+    
+    deviation_range : bpy.props.FloatProperty(
+        name = "Deviation Range", 
+        description = "Angle from the vertex normal that is drawn in full red in Deviation coloring", 
+        default = math.radians(45), 
+        min = math.radians(1), 
+        max = math.pi, 
+        subtype = 'ANGLE'
+    )
 
     selected_verts_only : bpy.props.BoolProperty(
         name = "Selected Vertices Only", 
@@ -113,6 +224,18 @@ class NormalToolSettings(bpy.types.PropertyGroup):
         description = "Only affect normals on front facing faces", 
         default = True
     )
+    
+    visible_only : bpy.props.BoolProperty(
+        name = "Visible Only", 
+        description = "Only affect normals that can be seen from the viewpoint.  Skips surfaces hidden behind other parts of the selected meshes", 
+        default = False
+    )
+    
+    hover_preview : bpy.props.BoolProperty(
+        name = "Hover Preview", 
+        description = "While not stroking, highlight the normals a dab at the cursor would change, colored by how strongly", 
+        default = False
+    )
 
     target : bpy.props.PointerProperty(
         name = "Target", 
@@ -120,6 +243,70 @@ class NormalToolSettings(bpy.types.PropertyGroup):
         type = bpy.types.Object
     )
     
+    target_mode : bpy.props.EnumProperty(
+        name = "Target Mode", 
+        items=(
+            ('OBJECT', "Object", "Point toward a single target object"),
+            ('COLLECTION', "Collection", "Point toward every object in a collection")
+        ),
+        default = 'OBJECT'
+    )
+    
+    target_collection : bpy.props.PointerProperty(
+        name = "Targets", 
+        description = "Collection of objects Attract and Repel mode reference", 
+        type = bpy.types.Collection
+    )
+    
+    target_weighting : bpy.props.EnumProperty(
+        name = "Weighting", 
+        items=(
+            ('INVERSE_DISTANCE', "Inverse Distance", "Blend the direction to every target, weighting closer targets more"),
+            ('NEAREST', "Nearest", "Point toward the nearest target only")
+        ),
+        default = 'INVERSE_DISTANCE'
+    )
+    
+    comb_lag : bpy.props.FloatProperty(
+        name = "Lag", 
+        description = "Smooths the Comb direction.  Distance the stroke travels, relative to the brush radius, before the direction catches up with a turn", 
+        default = .25, 
+        min = 0, 
+        soft_max = 2
+    )
+    
+    smooth_mode : bpy.props.EnumProperty(
+        name = "Smooth Mode", 
+        items=(
+            ('AVERAGE', "Average", "Replace normals under the brush with their weighted average"),
+            ('RELAX', "Relax", "Repeatedly average each normal with its connected neighbors")
+        ),
+        default = 'AVERAGE'
+    )
+    
+    smooth_iterations : bpy.props.IntProperty(
+        name = "Iterations", 
+        description = "Number of times neighbors are averaged for each dab in Relax mode", 
+        default = 4, 
+        min = 1, 
+        soft_max = 20
+    )
+    
+    smooth_factor : bpy.props.FloatProperty(
+        name = "Factor", 
+        description = "Amount each normal moves toward the average of its neighbors on every iteration", 
+        default = .5, 
+        min = 0, 
+        max = 1
+    )
+    
+    transfer_source : bpy.props.PointerProperty(
+        name = "Source", 
+        description = "Object Transfer mode copies normals from", 
+        type = bpy.types.Object,
+        poll = lambda self, obj: obj.type == 'MESH'
+    )
+    
     symmetry_x : bpy.props.BoolProperty(
         name="X", 
         description = "Symmetry across the X axis",
@@ -144,6 +331,44 @@ class NormalToolSettings(bpy.types.PropertyGroup):
         default = False
     )
     
+    use_evaluated : bpy.props.BoolProperty(
+        name = "Use Modifiers", 
+        description = "Place the brush using the mesh as deformed by its modifiers, such as an armature.  Positions are updated at the start of each stroke", 
+        default = False
+    )
+    
+    record_strokes : bpy.props.BoolProperty(
+        name = "Record Strokes", 
+        description = "Save every dab made while the tool is running to the stroke file so it can be replayed later", 
+        default = False
+    )
+    
+    use_journal : bpy.props.BoolProperty(
+        name = "Crash Recovery", 
+        description = "Keep a journal of every stroke next to the .blend file.  If Blender crashes while the tool is running, Recover Normals applies the edits again", 
+        default = False
+    )
+    
+    profile : bpy.props.BoolProperty(
+        name = "Profile", 
+        description = "Time each dab and redraw of the tool and show the results in the viewport", 
+        default = False
+    )
+    
+    profile_file : bpy.props.StringProperty(
+        name = "Profile Log", 
+        description = "When profiling, timings are written to this .json or .csv file when the tool exits.  Leave blank to not save", 
+        default = "",
+        subtype = 'FILE_PATH'
+    )
+    
+    stroke_file : bpy.props.StringProperty(
+        name = "Stroke File", 
+        description = "File strokes are recorded to", 
+        default = "//normal_strokes.nbs",
+        subtype = 'FILE_PATH'
+    )
+    
 
 #---------------------------
         
@@ -156,10 +381,35 @@ coordsNormal = [(0, 0, 0), (0, 0, 1)]
 vecZ = mathutils.Vector((0, 0, 1))
 vecX = mathutils.Vector((1, 0, 0))
 
-shader = gpu.shader.from_builtin('UNIFORM_COLOR')
-batchLine = batch_for_shader(shader, 'LINES', {"pos": coordsNormal})
-batchCircle = batch_for_shader(shader, 'LINE_STRIP', {"pos": coordsCircle})
 
+_gpu_resources = None
+
+#Shaders and the fixed cursor batches.  Created on first draw rather than at import so the
+# module loads quickly and works in background mode, where there is no GPU.
+def gpu_resources():
+    global _gpu_resources
+    if _gpu_resources == None:
+        shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+        _gpu_resources = {
+            "shader": shader,
+            "color_shader": gpu.shader.from_builtin('FLAT_COLOR'),
+            "line": batch_for_shader(shader, 'LINES', {"pos": coordsNormal}),
+            "circle": batch_for_shader(shader, 'LINE_STRIP', {"pos": coordsCircle})
+        }
+    return _gpu_resources
+
+
+_profile = None
+
+#Line strip across the brush showing the height of the falloff curve.  Rebuilt when the table changes.
+def profile_batch(shader, table):
+    global _profile
+    if _profile == None or _profile[0] is not table:
+        x = np.linspace(-1, 1, 65)
+        height = falloff.sample_table(table, 1 - np.abs(x)) * .5
+        coords = np.stack((x, np.zeros_like(x), height), axis = 1).astype(np.float32)
+        _profile = (table, batch_for_shader(shader, 'LINE_STRIP', {"pos": coords}))
+    return _profile[1]
 
 #Find matrix that will rotate Z axis to point along normal
 #coord - point in world space
@@ -214,6 +464,9 @@ def calc_gizmo_transform(obj, coord, normal, ray_origin):
 
 def draw_callback(self, context):
     ctx = bpy.context
+    
+    #Changes after this point need another redraw
+    self.redraw_tagged = False
 
     region = context.region
     rv3d = context.region_data
@@ -223,10 +476,12 @@ def draw_callback(self, context):
     ray_origin = view3d_utils.region_2d_to_origin_3d(region, rv3d, viewport_center)
 
 
+    resources = gpu_resources()
+    shader = resources["shader"]
+    color_shader = resources["color_shader"]
+    
     shader.bind();
 
-    #bgl.glEnable(bgl.GL_DEPTH_TEST)
-    
     #Draw cursor
     if self.show_cursor:
         brush_radius = context.scene.normal_brush_props.radius
@@ -241,7 +496,11 @@ def draw_callback(self, context):
         gpu.matrix.multiply_matrix(m)
 
         shader.uniform_float("color", (1, 0, 1, 1))
-        batchCircle.draw(shader)
+        resources["circle"].draw(shader)
+        
+        #Falloff profile standing up from the surface
+        shader.uniform_float("color", (1, .5, 1, 1))
+        profile_batch(shader, falloff.falloff_table(context.scene.normal_brush_props)).draw(shader)
         
         gpu.matrix.pop()
 
@@ -257,54 +516,408 @@ def draw_callback(self, context):
             gpu.matrix.multiply_matrix(m)
 
             shader.uniform_float("color", (0, 1, 1, 1))
-            batchLine.draw(shader)
+            resources["line"].draw(shader)
             
             gpu.matrix.pop()
 
     
     #Draw editable normals
-    shader.uniform_float("color", (1, 1, 0, 1))
+    settings = context.scene.normal_brush_props
+    normLength = settings.normal_length
 
+    color_shader.bind()
 
-    normLength = context.scene.normal_brush_props.normal_length
-    mS = mathutils.Matrix.Scale(normLength, 4)
+    prof = self.profiler
+    if prof != None:
+        prof.begin("frame")
 
-    shader.uniform_float("color", (1, 1, 0, 1))
-
-    use_shape_keys = context.scene.normal_brush_props.use_shape_keys
-
-    for obj in ctx.selected_objects:
-        if obj.type == 'MESH':
-            success = obj.update_from_editmode()
-            mesh = obj.data
-                
-            if use_shape_keys and obj.active_shape_key:
-                mesh = obj.active_shape_key.data
-
-            #mesh.calc_normals_split()
-            coordsNormals = []
-            
-            for l in mesh.loops:
-                    
-                v = mesh.vertices[l.vertex_index]
-                coordsNormals.append(v.co)
-                coordsNormals.append(v.co + l.normal * normLength)
+    #Objects still being prepared at startup are not drawn yet
+    for obj in self.brush.mesh_objects(ctx):
+        success = obj.update_from_editmode()
+        
+        with profiler.phase(prof, "overlay_build"):
+            cache = self.brush.mesh_cache(obj, settings)
+            batches = self.overlay_batches(cache, settings)
+        
+        if prof != None:
+            prof.count("loops", len(cache.loop_verts))
 
-            batchNormals = batch_for_shader(shader, 'LINES', {"pos": coordsNormals})
-    
+        with profiler.phase(prof, "overlay_draw"):
             gpu.matrix.push()
             
             gpu.matrix.multiply_matrix(obj.matrix_world)
-            batchNormals.draw(shader)
+            for batch in batches:
+                batch.draw(color_shader)
             
             gpu.matrix.pop()
 
-    #bgl.glDisable(bgl.GL_DEPTH_TEST)
+    #Normals a dab at the cursor would change
+    if self.preview_batches == None:
+        self.preview_batches = [(obj, batch_for_shader(color_shader, 'LINES', {"pos": lines, "color": colors})) for obj, lines, colors in self.preview]
+    for obj, batch in self.preview_batches:
+        gpu.matrix.push()
+        gpu.matrix.multiply_matrix(obj.matrix_world)
+        batch.draw(color_shader)
+        gpu.matrix.pop()
+
+    if prof != None:
+        prof.end()
+
+    #Batches left over by the upload limit still need drawing after the user stops moving
+    self.keep_uploading()
+
+
+#Rolling timings of the profiler in screen space
+def draw_callback_px(self, context):
+    if self.profiler == None:
+        return
+        
+    font_id = 0
+    blf.size(font_id, 12)
+    blf.color(font_id, 1, 1, 1, 1)
+    
+    lines = ["%-8s %-20s avg %7.2f ms  p95 %7.2f ms" % s for s in self.profiler.stats()]
+    
+    y = 20 + 16 * len(lines)
+    for line in ["Normal Tool Timings"] + lines:
+        blf.position(font_id, 20, y, 0)
+        blf.draw(font_id, line)
+        y -= 16
+
+
+
+#Progress of the tool's startup in screen space
+def draw_callback_startup_px(self, context):
+    if self.startup == None:
+        return
+        
+    done, total = self.startup_progress
+    font_id = 0
+    blf.size(font_id, 14)
+    blf.color(font_id, 1, 1, 1, 1)
+    blf.position(font_id, 20, context.region.height - 40, 0)
+    blf.draw(font_id, "Preparing normals... %d%%  (%d of %d objects ready)" % (100 * done // max(total, 1), len(self.brush.active_objects), len(self.startup_objects)))
+
+
+#---------------------------
 
+class StrokeTrail:
+    """Recent positions of a stroke in a fixed size ring buffer, with a direction of travel smoothed over arc length."""
+
+    def __init__(self, size = 16):
+        self.points = collections.deque(maxlen = size)
+        self.tangent = None
+
+    def clear(self):
+        self.points.clear()
+        self.tangent = None
+
+    #lag - distance travelled before the direction has mostly caught up with a turn.  Zero for no smoothing.
+    #Smoothing depends on distance moved rather than number of events, so it behaves the same at any event rate.
+    def append(self, location, lag):
+        location = np.array(location, dtype = np.float64)
+        if self.points:
+            step = location - self.points[-1]
+            length = np.linalg.norm(step)
+            if length > 1e-9:
+                step /= length
+                if self.tangent is None or lag <= 0:
+                    self.tangent = step
+                else:
+                    alpha = 1 - math.exp(-length / lag)
+                    tangent = self.tangent + alpha * (step - self.tangent)
+                    tangent_len = np.linalg.norm(tangent)
+                    self.tangent = tangent / tangent_len if tangent_len > 1e-9 else step
+        self.points.append(location)
 
+    #Smoothed world space direction of travel, or None if the stroke has not moved yet
+    def direction(self):
+        return self.tangent
 
 #---------------------------
 
+#Ray origins closer than this fraction of the brush radius share visibility results
+VISIBILITY_ORIGIN_STEP = .05
+
+class NormalBrush:
+    """Applies brush dabs to the normals of the selected meshes.  Independent of any viewport so strokes can be replayed headless."""
+
+    def __init__(self):
+        self.stroke_trail = StrokeTrail()
+        
+        self.normal_sampler = None
+        self.caches = {}
+        self.visibility = occlusion.VisibilityCache()
+        self.profiler = None
+        
+        #Names of the objects dabs may change, or None for every selected mesh.  Lets
+        # brushing start while the tool is still preparing other objects.
+        self.active_objects = None
+        
+        #Loops changed by each dab of the current stroke, by object name
+        self.stroke_changes = {}
+        
+        #Messages for the user that have not been reported yet
+        self.warnings = []
+        
+        #True while replaying a stroke file rather than following the mouse
+        self.replaying = False
+
+    #Selected meshes that dabs may change
+    def mesh_objects(self, context):
+        return [obj for obj in context.selected_objects 
+            if obj.type == 'MESH' and (self.active_objects == None or obj.name in self.active_objects)]
+
+    def begin_stroke(self, context = None, settings = None):
+        self.stroke_trail.clear()
+        self.stroke_changes = {}
+        
+        #Positions of deformed meshes are read once per stroke rather than every dab
+        if settings != None and settings.use_evaluated:
+            depsgraph = context.evaluated_depsgraph_get()
+            for obj in self.mesh_objects(context):
+                self.sync_evaluated(self.mesh_cache(obj, settings), depsgraph)
+                
+    #Read the evaluated positions of a cache.  If its modifiers cannot be followed, the cache keeps
+    # the undeformed positions for the rest of the session and the user is warned once.
+    def sync_evaluated(self, cache, depsgraph):
+        if cache.eval_error != None:
+            return
+        if not cache.sync_evaluated(depsgraph):
+            self.warnings.append(cache.eval_error)
+        
+    #Write the normals and normal layers changed by the stroke to their meshes
+    def end_stroke(self):
+        for name in self.stroke_changes:
+            self.caches[name].flush_normals()
+            self.caches[name].flush_layers()
+            
+    #Show the edits made so far in the viewport's shading.  Called at most once per frame.
+    def flush_normals(self):
+        for cache in self.caches.values():
+            cache.flush_normals()
+        
+    #Cached arrays for obj, created on first use and kept for the rest of the session
+    #context - if given, evaluated positions are read if the cache does not have them yet
+    def mesh_cache(self, obj, settings, context = None):
+        cache = self.caches.get(obj.name)
+        if cache == None:
+            cache = meshCache.MeshCache(obj, settings.use_shape_keys)
+            self.caches[obj.name] = cache
+            
+        if settings.use_evaluated:
+            if context != None and not cache.evaluated and cache.eval_error == None:
+                self.sync_evaluated(cache, context.evaluated_depsgraph_get())
+        else:
+            cache.sync_shape_key(settings.use_shape_keys)
+        cache.sync_layers()
+        return cache
+
+    #mesh_cache() a step at a time, for reading large meshes from a timer.  Yields between steps
+    # and returns the cache.
+    def mesh_cache_steps(self, obj, settings):
+        if self.caches.get(obj.name) == None:
+            self.caches[obj.name] = yield from meshCache.MeshCache.build_steps(obj, settings.use_shape_keys)
+        return self.mesh_cache(obj, settings)
+
+    #Re-read normals after the meshes were changed outside of the brush, eg by undo
+    def refresh_normals(self):
+        for cache in self.caches.values():
+            cache.refresh_normals()
+
+    def transfer_sampler(self, context, source):
+        if self.normal_sampler == None or self.normal_sampler.source != source:
+            self.normal_sampler = transferNormals.NormalSampler(source, context.evaluated_depsgraph_get())
+        return self.normal_sampler
+
+    #Apply one dab of the brush along the ray
+    #settings - NormalToolSettings or an object with the same attributes
+    def dab(self, context, settings, ray_origin, view_vector, pressure):
+        with profiler.phase(self.profiler, "ray_cast"):
+            result, location, normal, index, object, matrix = ray_cast(context, context.view_layer, ray_origin, view_vector)
+        
+        if not result:
+            self.stroke_trail.clear()
+            return
+            
+        brush_type = settings.brush_type
+        
+        atten = settings.strength
+        if settings.use_pressure:
+            atten *= falloff.pressure_response(settings, pressure)
+        
+        #Brush center and view direction for each symmetry direction
+        signs = brushMath.symmetry_signs(settings)
+        centers = np.array(location) * signs
+        view_vecs = np.array(view_vector) * signs
+        origins = np.array(ray_origin) * signs
+        
+        if settings.visible_only:
+            with profiler.phase(self.profiler, "occluders"):
+                self.update_visibility(context, settings, ray_origin)
+        
+        self.stroke_trail.append(location, settings.comb_lag * settings.radius)
+        
+        comb_dir = None
+        if brush_type == "COMB":
+            comb_dir = self.stroke_trail.direction()
+        
+        for obj in self.mesh_objects(context):
+            if brush_type == "TRANSFER" and (settings.transfer_source == None or settings.transfer_source == obj):
+                continue
+                
+            with profiler.phase(self.profiler, "cache"):
+                cache = self.mesh_cache(obj, settings, context)
+            self.dab_object(context, settings, cache, centers, view_vecs, origins, signs, comb_dir, atten)
+
+    #Loops a dab centered at location would change and the weight of each, without changing anything.
+    #Costs about as much as the masking part of a dab, since only the brush footprint is searched.
+    #Returns a list of (cache, loops, weights)
+    def preview(self, context, settings, location, ray_origin, view_vector):
+        signs = brushMath.symmetry_signs(settings)
+        centers = np.array(location) * signs
+        view_vecs = np.array(view_vector) * signs
+        origins = np.array(ray_origin) * signs
+        
+        if settings.visible_only:
+            self.update_visibility(context, settings, ray_origin)
+        
+        previews = []
+        for obj in self.mesh_objects(context):
+            if settings.brush_type == "TRANSFER" and settings.transfer_source == obj:
+                continue
+            cache = self.mesh_cache(obj, settings, context)
+            pairs = self.dab_weights(context, settings, cache, centers, view_vecs, origins)
+            if pairs == None:
+                continue
+            loops, pair_verts, pair_copies, weights_falloff, weights = pairs
+            keep = weights > 0
+            if np.any(keep):
+                previews.append((cache, loops[keep], weights[keep]))
+        return previews
+
+    #Make sure the occluders match the selected meshes and that visibility was worked out for the current view.
+    #The view is identified by the view matrix when there is one, or else by the ray origin (eg, when replaying).
+    def update_visibility(self, context, settings, ray_origin):
+        caches = [self.mesh_cache(obj, settings, context) for obj in self.mesh_objects(context)]
+        self.visibility.update_occluders(caches)
+        
+        #Rays start at the dab's ray origin.  In a perspective view that is the eye, but in an
+        # orthographic view it follows the mouse, and when replaying it comes from each recorded dab
+        # while region_data is whatever view the operator was run from.
+        rv3d = getattr(context, "region_data", None)
+        view_key = None
+        if rv3d != None:
+            view_key = tuple(v for row in rv3d.view_matrix for v in row)
+        if rv3d == None or not rv3d.is_perspective or self.replaying:
+            quantum = max(settings.radius * VISIBILITY_ORIGIN_STEP, 1e-6)
+            view_key = (view_key, tuple(np.round(np.array(ray_origin) / quantum).astype(np.int64).tolist()))
+        self.visibility.update_view(view_key)
+
+    def dab_object(self, context, settings, cache, centers, view_vecs, origins, signs, comb_dir, atten):
+        with profiler.phase(self.profiler, "brush"):
+            changed, new_normals = self.calc_dab(context, settings, cache, centers, view_vecs, origins, signs, comb_dir, atten)
+            
+        if self.profiler != None:
+            self.profiler.count("loops", len(changed))
+            
+        if len(changed):
+            with profiler.phase(self.profiler, "write_normals"):
+                cache.write_normals(changed, new_normals)
+            self.stroke_changes.setdefault(cache.obj.name, []).append(changed)
+
+    #Every loop changed since begin_stroke() as a list of (cache, loops)
+    def stroke_loops(self):
+        return [(self.caches[name], np.unique(np.concatenate(loops))) for name, loops in self.stroke_changes.items()]
+
+    #Falloff of the brush at every loop in its footprint, with the masks of settings applied
+    #origins - world space eye position for each symmetry direction
+    #Returns (loops, pair_verts, pair_copies, weights_falloff, weights) with one entry per (loop, symmetry copy)
+    # pair.  weights_falloff is the falloff alone and weights has the masks applied.  None if no vertex is in reach.
+    def dab_weights(self, context, settings, cache, centers, view_vecs, origins):
+        obj = cache.obj
+        radius = settings.radius
+        
+        #Only vertices inside the brush footprint are visited
+        vert_idx, copy_idx, dist = brushMath.gather_pairs(cache.kdtree(), centers.tolist(), radius)
+        if len(vert_idx) == 0:
+            return None
+            
+        if settings.falloff_distance == 'GEODESIC':
+            #Surface distance is never shorter than straight line distance, so the footprint already holds every vertex in reach
+            with profiler.phase(self.profiler, "geodesic"):
+                dist = brushMath.geodesic_pair_distances(cache, vert_idx, copy_idx, dist, radius)
+            
+        src, loops = cache.loops_of_verts(vert_idx)
+        pair_verts = vert_idx[src]
+        pair_copies = copy_idx[src]
+        weights_falloff = falloff.brush_falloff(settings, dist[src], radius)
+        
+        weights = weights_falloff.copy()
+        if settings.selected_faces_only:
+            weights[~cache.poly_select[cache.loop_polys[loops]]] = 0
+        if settings.selected_verts_only:
+            weights[~cache.vert_select[pair_verts]] = 0
+        if settings.front_faces_only:
+            view_local = brushMath.world_to_local_dirs(obj, view_vecs)
+            facing = np.einsum('ij,ij->i', cache.poly_normals[cache.loop_polys[loops]], view_local[pair_copies])
+            weights[facing > 0] = 0
+        if settings.visible_only:
+            #Only pairs the other masks left in are ray tested
+            test = weights > 0
+            with profiler.phase(self.profiler, "occlusion"):
+                visible = self.visibility.visible(cache, pair_verts[test], pair_copies[test], origins)
+            weights[np.flatnonzero(test)[~visible]] = 0
+            
+        return loops, pair_verts, pair_copies, weights_falloff, weights
+
+    #Returns (loops, new_normals) for the loops changed by a dab
+    #origins - world space eye position for each symmetry direction
+    def calc_dab(self, context, settings, cache, centers, view_vecs, origins, signs, comb_dir, atten):
+        obj = cache.obj
+        brush_type = settings.brush_type
+        
+        pairs = self.dab_weights(context, settings, cache, centers, view_vecs, origins)
+        if pairs == None:
+            return np.zeros(0, dtype = np.int32), np.zeros((0, 3))
+        loops, pair_verts, pair_copies, weights_falloff, weights = pairs
+        weights *= atten
+        
+        if brush_type == "SMOOTH" and settings.smooth_mode == "RELAX":
+            changed, new_normals = brushMath.relax_loops(cache, loops, pair_verts, weights, settings.smooth_iterations, settings.smooth_factor)
+            
+        else:
+            #Weighted average of the normals around the unmirrored brush center
+            smooth_normal = None
+            if brush_type == "SMOOTH":
+                primary = pair_copies == 0
+                smooth_normal = np.sum(weights_falloff[primary, None] * cache.loop_normals[loops[primary]], axis = 0)
+            
+            transfer_normals = None
+            if brush_type == "TRANSFER":
+                sampler = self.transfer_sampler(context, settings.transfer_source)
+                verts, inverse = np.unique(pair_verts, return_inverse = True)
+                normals, valid = sampler.sample_vertices(obj, cache.coords[verts])
+                transfer_normals = normals[inverse]
+                weights[~valid[inverse]] = 0
+            
+            dirs = brushMath.brush_directions(settings, obj, cache.coords[pair_verts], cache.vert_normals[pair_verts], 
+                comb_dirs = comb_dir, 
+                smooth_normals = smooth_normal, 
+                transfer_normals = transfer_normals)
+            dirs = dirs * signs[pair_copies]
+            
+            changed, new_normals = brushMath.merge_rotations(cache.loop_normals, loops, weights, dirs)
+            
+        return changed, new_normals
+
+
+#---------------------------
+
+#Startup work done per timer call, in seconds, and the pause between calls
+STARTUP_SLICE = .02
+STARTUP_INTERVAL = .01
+
 class ModalDrawOperator(bpy.types.Operator):
     """Adjust normals"""
     bl_idname = "kitfox.normal_tool"
@@ -322,7 +935,118 @@ class ModalDrawOperator(bpy.types.Operator):
         self.history_limit = 10
         self.history_bookmarks = {}
         
-        self.stroke_trail = []
+        self.brush = NormalBrush()
+        self.recorder = None
+        self.profiler = None
+        self.journal = None
+        
+        self.overlays = {}
+        
+        #True while the views showing the objects are waiting to redraw
+        self.redraw_tagged = False
+        #What the views looked like when they were last tagged
+        self.drawn_state = None
+        
+        #(object, lines, colors) of the hover preview, and batches drawing them once they are built
+        self.preview = []
+        self.preview_batches = []
+        
+        self.startup = None
+        self.startup_objects = []
+        self.startup_progress = (0, 0)
+        self._startup_timer = self.startup_tick
+        self._journal_timer = self.journal_tick
+        
+    def overlay_entry(self, obj):
+        entry = self.overlays.get(obj.name)
+        if entry == None:
+            entry = overlay.NormalOverlay()
+            self.overlays[obj.name] = entry
+        return entry
+        
+    #Batches of lines showing the normals of a cached mesh.  Only updated after the normals change.
+    def overlay_batches(self, cache, settings):
+        entry = self.overlay_entry(cache.obj)
+        return entry.update(cache, gpu_resources()["color_shader"], settings.normal_length, settings.overlay_color, settings.deviation_range)
+        
+    #Session setup for each object, split into steps of bounded size so it can run a little at a
+    # time from a timer.  An object can be brushed once its overlay is ready.
+    def startup_steps(self, settings, objs):
+        for obj in objs:
+            #Converting the mesh to bmesh is a single call, so the snapshot is one step
+            with profiler.phase(self.profiler, "history_snapshot"):
+                bm = bmesh.new()
+                bm.from_mesh(obj.data)
+                self.history_bookmarks[0][obj] = bm
+                #The object has not been changed yet, so it looks like this in every state of the history
+                for map in self.history:
+                    map[obj] = bm.copy()
+            yield
+            
+            cache = yield from profiler.phase_steps(self.profiler, "cache", self.brush.mesh_cache_steps(obj, settings))
+            yield from profiler.phase_steps(self.profiler, "spatial_index", cache.kdtree_steps())
+            entry = self.overlay_entry(obj)
+            yield from profiler.phase_steps(self.profiler, "overlay_build",
+                entry.prepare_steps(cache, settings.normal_length, settings.overlay_color, settings.deviation_range))
+            self.brush.active_objects.add(obj.name)
+
+    #Number of steps startup_steps() yields for obj
+    def startup_step_count(self, obj):
+        mesh = obj.data
+        return (1 + meshCache.MeshCache.build_step_count(mesh) + brushMath.kdtree_step_count(len(mesh.vertices))
+            + overlay.prepare_step_count(len(mesh.loops)))
+
+    #Timer callback running startup steps for a short time slice.  Keeps running until the
+    # startup is done and the overlay is uploaded.
+    def startup_tick(self):
+        if self.startup != None:
+            if self.profiler != None:
+                self.profiler.begin("startup")
+                
+            deadline = time.perf_counter() + STARTUP_SLICE
+            done, total = self.startup_progress
+            try:
+                while time.perf_counter() < deadline:
+                    next(self.startup)
+                    done += 1
+            except StopIteration:
+                self.startup = None
+            self.startup_progress = (done, total)
+            
+            if self.profiler != None:
+                self.profiler.end()
+                
+        self.request_redraw(bpy.context)
+        
+        if self.startup != None or any(entry.pending for entry in self.overlays.values()):
+            return STARTUP_INTERVAL
+        return None
+        
+    #Keep the views redrawing from the startup timer while overlay batches are waiting to be
+    # uploaded.  A full rebuild of the overlay, eg after changing the normal length or an undo,
+    # can leave batches behind when nothing else would cause another redraw.
+    def keep_uploading(self):
+        if any(entry.pending for entry in self.overlays.values()) and not bpy.app.timers.is_registered(self._startup_timer):
+            bpy.app.timers.register(self._startup_timer, first_interval = STARTUP_INTERVAL)
+
+    #Prepare objs for brushing in the background, most important first
+    def start_startup(self, context, objs):
+        self.brush.active_objects = set()
+        self.history = [{}]
+        self.history_idx = 0
+        self.history_bookmarks[0] = {}
+        
+        self.startup_objects = objs
+        self.startup_progress = (0, sum(self.startup_step_count(obj) for obj in objs))
+        self.startup = self.startup_steps(context.scene.normal_brush_props, objs)
+        self._handle_startup_px = bpy.types.SpaceView3D.draw_handler_add(draw_callback_startup_px, (self, context), 'WINDOW', 'POST_PIXEL')
+        bpy.app.timers.register(self._startup_timer)
+        
+    def stop_startup(self):
+        self.startup = None
+        if bpy.app.timers.is_registered(self._startup_timer):
+            bpy.app.timers.unregister(self._startup_timer)
+        bpy.types.SpaceView3D.draw_handler_remove(self._handle_startup_px, 'WINDOW')
         
     def free_snapshot(self, map):
         for obj in map:
@@ -332,13 +1056,13 @@ class ModalDrawOperator(bpy.types.Operator):
     #if bookmark is other than -1, snapshot added to bookmark library rather than undo stack
     def history_snapshot(self, context, bookmark = -1):
         map = {}
-        for obj in context.selected_objects:
-            if obj.type == 'MESH':
-                bm = bmesh.new()
-                
-                mesh = obj.data
-                bm.from_mesh(mesh)
-                map[obj] = bm
+        #Objects still being prepared are added to every snapshot once they are ready
+        for obj in self.brush.mesh_objects(context):
+            bm = bmesh.new()
+            
+            mesh = obj.data
+            bm.from_mesh(mesh)
+            map[obj] = bm
                 
         if bookmark != -1:
             self.history_bookmarks[bookmark] = map
@@ -373,15 +1097,12 @@ class ModalDrawOperator(bpy.types.Operator):
             
         
     def history_restore_bookmark(self, context, bookmark):
-        map = self.history[bookmark]
+        map = self.history_bookmarks[bookmark]
     
-        for obj in context.selected_objects:
-            if obj.type == 'MESH':
-                bm = map[obj]
-                
-                mesh = obj.data
-                bm.to_mesh(mesh)
-                mesh.update()
+        for obj, bm in map.items():
+            mesh = obj.data
+            bm.to_mesh(mesh)
+            mesh.update()
         
     def history_undo_to_snapshot(self, context, idx):
         if idx < 0 or idx >= len(self.history):
@@ -391,13 +1112,19 @@ class ModalDrawOperator(bpy.types.Operator):
        
         map = self.history[self.history_idx]
         
-        for obj in context.selected_objects:
-            if obj.type == 'MESH':
-                bm = map[obj]
-                
-                mesh = obj.data
-                bm.to_mesh(mesh)
-                mesh.update()
+        for obj, bm in map.items():
+            mesh = obj.data
+            bm.to_mesh(mesh)
+            mesh.update()
+        
+        old_normals = None
+        if self.journal != None:
+            old_normals = {name: cache.mesh_normals.copy() for name, cache in self.brush.caches.items()}
+        
+        self.brush.refresh_normals()
+        
+        if old_normals != None:
+            self.journal_changes(old_normals)
         
     def history_clear(self, context):
         for key in self.history_bookmarks:
@@ -413,10 +1140,6 @@ class ModalDrawOperator(bpy.types.Operator):
 
     def dab_brush(self, context, event):
         mouse_pos = (event.mouse_region_x, event.mouse_region_y)
-        
-        targetObj = context.scene.normal_brush_props.target
-
-        ctx = bpy.context
 
         region = context.region
         rv3d = context.region_data
@@ -424,195 +1147,15 @@ class ModalDrawOperator(bpy.types.Operator):
         view_vector = view3d_utils.region_2d_to_vector_3d(region, rv3d, mouse_pos)
         ray_origin = view3d_utils.region_2d_to_origin_3d(region, rv3d, mouse_pos)
 
-        viewlayer = bpy.context.view_layer
-        result, location, normal, index, object, matrix = ray_cast(context, viewlayer, ray_origin, view_vector)
-        
-        center = None
-        center_count = 0
+        settings = context.scene.normal_brush_props
+        if self.recorder != None:
+            self.recorder.record_dab(ray_origin, view_vector, event.pressure)
 
-        selVertsOnly = context.scene.normal_brush_props.selected_verts_only
-        selFacesOnly = context.scene.normal_brush_props.selected_faces_only
-        radius = context.scene.normal_brush_props.radius
-        strength = context.scene.normal_brush_props.strength
-        use_pressure = context.scene.normal_brush_props.use_pressure
-        brush_type = context.scene.normal_brush_props.brush_type
-        brush_normal = context.scene.normal_brush_props.normal
-        target = context.scene.normal_brush_props.target
-        front_faces_only = context.scene.normal_brush_props.front_faces_only
-        sym_x = context.scene.normal_brush_props.symmetry_x
-        sym_y = context.scene.normal_brush_props.symmetry_y
-        sym_z = context.scene.normal_brush_props.symmetry_z
-        
-
-        if result:
-            for obj in ctx.selected_objects:
-                if obj.type == 'MESH':
-                    mesh = obj.data
-                    
-                    #--------------------------------
-                    activeShapeKey = obj.active_shape_key
-                    #mesh2 = activeShapeKey.data
-                    
-                    #mesh2.shape_keys
-                    #--------------------------------
-                    
-                    #mesh.use_auto_smooth = True
-                    
-                    #mesh.calc_normals_split()
-
-                    #Calc normal for smoothing
-                    if brush_type == "SMOOTH":
-                        smooth_normal = None
-                        
-                        for p in mesh.polygons:
-                            for loop_idx in p.loop_indices:
-                                l = mesh.loops[loop_idx]
-                                v = mesh.vertices[l.vertex_index]
-                                pos = mathutils.Vector(v.co)
-                                wpos = obj.matrix_world @ pos
-
-                                offset = location - wpos
-                                if offset.length < radius:
-                                    weight = 1 - offset.length / radius
-                                    
-                                    if smooth_normal == None:
-                                        smooth_normal = l.normal * weight
-                                    else:
-                                        smooth_normal += l.normal * weight
-                                    
-                        if not smooth_normal == None:
-                            smooth_normal.normalize()
-                    
-                    normals = []
-                    
-                    for p in mesh.polygons:
-                        masked = False
-                        if selFacesOnly and not p.select:
-                            masked = True
-                    
-                        for loop_idx in p.loop_indices:
-                            l = mesh.loops[loop_idx]
-                            
-                            v = mesh.vertices[l.vertex_index]
-                            if selVertsOnly and not v.select:
-                                masked = True
-                            
-                            pos = mathutils.Vector(v.co)
-                            wpos = obj.matrix_world @ pos
-
-                            #Normal transform is (l2w ^ -1) ^ -1 ^ T
-                            w2ln = obj.matrix_world.copy()
-                            w2ln.transpose()
-                            
-                            nLocal = None
-                            if brush_type == "FIXED":
-                                nLocal = brush_normal.to_4d()
-                                nLocal.w = 0
-                                nLocal = w2ln @ nLocal
-                                nLocal = nLocal.to_3d()
-                                nLocal.normalize()
-
-                            elif brush_type == "COMB":
-                                if len(self.stroke_trail) > 1:
-                                    dir = self.stroke_trail[-1] - self.stroke_trail[-2]
-                                    if dir.dot(dir) > .0001:
-                                        nLocal = w2ln @ dir
-                                        nLocal.normalize()
-
-                            elif brush_type == "ATTRACT":
-                                if target != None:
-                                    m = obj.matrix_world.copy()
-                                    m.invert()
-                                    targetLoc = m @ target.matrix_world.translation
-                                    
-                                    nLocal = targetLoc - pos
-                                    nLocal.normalize()
-
-                            elif brush_type == "REPEL":
-                                if target != None:
-                                    m = obj.matrix_world.copy()
-                                    m.invert()
-                                    targetLoc = m @ target.matrix_world.translation
-                                    
-                                    nLocal = pos - targetLoc
-                                    nLocal.normalize()
-
-                            elif brush_type == "SMOOTH":
-                                nLocal = smooth_normal
-                                    
-                            elif brush_type == "VERTEX":
-                                nLocal = mathutils.Vector(v.normal)
-                            
-                            
-                            #Calc new normals (one for each symmetry direction)
-                            offsets = [location]
-                            norms = [nLocal]
-                            view_vecs = [view_vector]
-                            
-                            if sym_x:
-                                offsets = offsets + [mathutils.Vector((-p.x, p.y, p.z)) for p in offsets]
-                                norms = norms + [None if p == None else mathutils.Vector((-p.x, p.y, p.z)) for p in norms]
-                                view_vecs = view_vecs + [None if p == None else mathutils.Vector((-p.x, p.y, p.z)) for p in view_vecs]
-                            
-                            if sym_y:
-                                offsets = offsets + [mathutils.Vector((p.x, -p.y, p.z)) for p in offsets]
-                                norms = norms + [None if p == None else mathutils.Vector((p.x, -p.y, p.z)) for p in norms]
-                                view_vecs = view_vecs + [None if p == None else mathutils.Vector((p.x, -p.y, p.z)) for p in view_vecs]
-                            
-                            if sym_z:
-                                offsets = offsets + [mathutils.Vector((p.x, p.y, -p.z)) for p in offsets]
-                                norms = norms + [None if p == None else mathutils.Vector((p.x, p.y, -p.z)) for p in norms]
-                                view_vecs = view_vecs + [None if p == None else mathutils.Vector((p.x, p.y, -p.z)) for p in view_vecs]
-                            
-                            
-                            rot_to = []
-                            
-                            for loc, norm, view_vec in zip(offsets, norms, view_vecs):
-                            
-                                offset = loc - wpos
-                                t = 1 - offset.length / radius
-        
-                                vv = view_vec.to_4d()
-                                vv.w = 0
-                                view_local = w2ln @ vv
-                                view_local = view_local.to_3d()
-                                
-                                if t <= 0 or norm == None or (p.normal.dot(view_local) > 0 and front_faces_only) or masked:
-                                    pass
-                                else:
-                                    axis = l.normal.cross(norm)
-                                    angle = norm.angle(l.normal)
-                                    
-                                    atten = strength
-                                    if use_pressure:
-                                        atten *= event.pressure
-                                    
-                                    q = mathutils.Quaternion(axis, angle * t * atten)
-                                    m = q.to_matrix()
-                                    
-                                    newNorm = m @ l.normal
-                                    
-                                    rot_to.append(newNorm)
-                                    
-                            #Apply average new normal to mesh
-                            if len(rot_to) == 0:
-                                normals.append(l.normal)
-                            elif len(rot_to) == 1:
-                                normals.append(rot_to[0])
-                            else:
-                                merged_norm = mathutils.Vector(rot_to[0])
-                                for v in rot_to[1:]:
-                                    merged_norm = merged_norm + v
-                                merged_norm.normalize()
-                                normals.append(merged_norm)
-                                
-                        
-                    mesh.normals_split_custom_set(normals)
-
-            self.stroke_trail.append(location)
-            
-        else:
-            self.stroke_trail = []
+        if self.profiler != None:
+            self.profiler.begin("dab")
+        self.brush.dab(context, settings, ray_origin, view_vector, event.pressure)
+        if self.profiler != None:
+            self.profiler.end()
         
 
     def mouse_move(self, context, event):
@@ -641,6 +1184,22 @@ class ModalDrawOperator(bpy.types.Operator):
 
         if self.dragging:
             self.dab_brush(context, event)
+        else:
+            self.update_preview(context, result, location, ray_origin, view_vector)
+
+    def update_preview(self, context, result, location, ray_origin, view_vector):
+        settings = context.scene.normal_brush_props
+        preview = []
+        if result and settings.hover_preview:
+            with profiler.phase(self.profiler, "preview"):
+                for cache, loops, weights in self.brush.preview(context, settings, location, ray_origin, view_vector):
+                    lines, colors = overlay.preview_lines(cache, loops, weights, settings.normal_length)
+                    preview.append((cache.obj, lines, colors))
+                    
+        if preview or self.preview:
+            self.preview = preview
+            #Batches are built on the next draw
+            self.preview_batches = None
 
 
     def mouse_down(self, context, event):
@@ -660,21 +1219,67 @@ class ModalDrawOperator(bpy.types.Operator):
                 return {'PASS_THROUGH'}
                             
             self.dragging = True
-            self.stroke_trail = []
+            self.preview = []
+            self.preview_batches = []
+            self.brush.begin_stroke(context, context.scene.normal_brush_props)
+            if self.recorder != None:
+                self.recorder.begin_stroke(context.scene.normal_brush_props)
             
             self.dab_brush(context, event)
             
         elif event.value == "RELEASE":
             self.dragging = False
-            self.history_snapshot(context)
+            self.brush.end_stroke()
+            if self.profiler != None:
+                self.profiler.begin("snapshot")
+            with profiler.phase(self.profiler, "history_snapshot"):
+                self.history_snapshot(context)
+            with profiler.phase(self.profiler, "journal"):
+                self.journal_stroke()
+            if self.profiler != None:
+                self.profiler.end()
 
 
         return {'RUNNING_MODAL'}
     
 
+    #Redraw the views showing the objects being edited.  Requests made before those views have
+    # drawn again are merged, so there is at most one redraw per frame.
+    def request_redraw(self, context):
+        if self.redraw_tagged:
+            return
+        with profiler.phase(self.profiler, "flush_normals"):
+            self.brush.flush_normals()
+        settings = context.scene.normal_brush_props
+        self.redraw_tagged = redraw_views_showing(context, self.startup_objects, max(settings.radius, settings.normal_length))
+
+    #Everything the overlay draws depends on.  The views are only redrawn when this changes.
+    def draw_state(self, context):
+        settings = context.scene.normal_brush_props
+        cursor = tuple(self.cursor_pos) if self.show_cursor else None
+        revisions = tuple((name, cache.revision) for name, cache in self.brush.caches.items())
+        return (cursor, revisions, len(self.preview), 
+            settings.radius, settings.normal_length, settings.overlay_color, settings.deviation_range,
+            settings.brush_type, tuple(settings.normal), settings.falloff_shape)
+
     def modal(self, context, event):
-        redraw_all_viewports(context)
+        result = self.handle_event(context, event)
         
+        for msg in self.brush.warnings:
+            self.report({'WARNING'}, msg)
+        self.brush.warnings.clear()
+        
+        if 'FINISHED' in result or 'CANCELLED' in result:
+            #Clear the overlay from every view that was showing it
+            redraw_views_showing(context, self.startup_objects, max(context.scene.normal_brush_props.radius, context.scene.normal_brush_props.normal_length))
+        else:
+            state = self.draw_state(context)
+            if state != self.drawn_state:
+                self.drawn_state = state
+                self.request_redraw(context)
+        return result
+
+    def handle_event(self, context, event):
         if event.type in {'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE'}:
             # allow navigation
             return {'PASS_THROUGH'}
@@ -709,7 +1314,11 @@ class ModalDrawOperator(bpy.types.Operator):
             if event.value == 'RELEASE':
                 context.window.cursor_set("DEFAULT")
                 bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
+                self.stop_startup()
                 self.history_clear(context)
+                self.stop_journal(False)
+                self.stop_recording()
+                self.stop_profiling(context)
                 return {'FINISHED'}
             return {'RUNNING_MODAL'}
 
@@ -718,6 +1327,8 @@ class ModalDrawOperator(bpy.types.Operator):
                 brush_radius = context.scene.normal_brush_props.radius
                 brush_radius = brush_radius + .1
                 context.scene.normal_brush_props.radius = brush_radius
+                if self.recorder != None and self.dragging:
+                    self.recorder.record_settings(context.scene.normal_brush_props)
             return {'RUNNING_MODAL'}
 
         elif event.type in {'PAGE_DOWN', 'LEFT_BRACKET'}:
@@ -725,19 +1336,109 @@ class ModalDrawOperator(bpy.types.Operator):
                 brush_radius = context.scene.normal_brush_props.radius
                 brush_radius = max(brush_radius - .1, .1)
                 context.scene.normal_brush_props.radius = brush_radius
+                if self.recorder != None and self.dragging:
+                    self.recorder.record_settings(context.scene.normal_brush_props)
             return {'RUNNING_MODAL'}
             
         elif event.type in {'RIGHTMOUSE', 'ESC'}:
             if event.value == 'RELEASE':
                 bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
                 context.window.cursor_set("DEFAULT")
+                self.stop_startup()
                 self.history_restore_bookmark(context, 0)
                 self.history_clear(context)            
+                self.stop_journal(True)
+                self.stop_recording()
+                self.stop_profiling(context)
                 return {'CANCELLED'}
             return {'RUNNING_MODAL'}
 
         return {'PASS_THROUGH'}
 
+    def start_recording(self, context):
+        settings = context.scene.normal_brush_props
+        if settings.record_strokes:
+            filepath = bpy.path.abspath(settings.stroke_file)
+            try:
+                self.recorder = strokeRecord.StrokeRecorder(filepath)
+            except OSError as e:
+                self.report({'WARNING'}, "Could not record strokes: " + str(e))
+
+    def stop_recording(self):
+        if self.recorder != None:
+            self.recorder.close()
+            self.recorder = None
+
+    def start_journal(self, context):
+        if not context.scene.normal_brush_props.use_journal:
+            return
+            
+        filepath = recoveryJournal.journal_path()
+        if filepath == None:
+            self.report({'WARNING'}, "Save the file first to use Crash Recovery")
+            return
+            
+        try:
+            self.journal = recoveryJournal.Journal(filepath)
+            self.journal.begin_session()
+        except (OSError, ValueError) as e:
+            self.journal = None
+            self.report({'WARNING'}, "Could not open recovery journal: " + str(e))
+            return
+        bpy.app.timers.register(self._journal_timer, first_interval = recoveryJournal.FLUSH_INTERVAL)
+        
+    #Timer callback flushing the journal while the tool is idle
+    def journal_tick(self):
+        if self.journal == None:
+            return None
+        self.journal.flush_if_due()
+        return recoveryJournal.FLUSH_INTERVAL
+            
+    #Save the loops changed by the last stroke to the journal
+    def journal_stroke(self):
+        if self.journal != None:
+            for cache, loops in self.brush.stroke_loops():
+                self.journal.write_stroke(cache, loops)
+        self.brush.stroke_changes = {}
+        
+    #Save loops whose normals differ from old_normals, eg after undo
+    def journal_changes(self, old_normals):
+        for name, old in old_normals.items():
+            cache = self.brush.caches[name]
+            changed = np.flatnonzero(np.any(cache.mesh_normals != old, axis = 1))
+            if len(changed):
+                self.journal.write_stroke(cache, changed)
+
+    def stop_journal(self, cancelled):
+        if bpy.app.timers.is_registered(self._journal_timer):
+            bpy.app.timers.unregister(self._journal_timer)
+        if self.journal != None:
+            self.journal.end_session(cancelled)
+            self.journal.close()
+            self.journal = None
+
+    def start_profiling(self, context):
+        if context.scene.normal_brush_props.profile:
+            self.profiler = profiler.Profiler()
+            self.brush.profiler = self.profiler
+            self._handle_px = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, (self, context), 'WINDOW', 'POST_PIXEL')
+
+    def stop_profiling(self, context):
+        if self.profiler == None:
+            return
+            
+        bpy.types.SpaceView3D.draw_handler_remove(self._handle_px, 'WINDOW')
+        
+        filepath = context.scene.normal_brush_props.profile_file
+        if filepath:
+            try:
+                self.profiler.dump(bpy.path.abspath(filepath))
+            except OSError as e:
+                self.report({'WARNING'}, "Could not write profile: " + str(e))
+                
+        self.profiler = None
+        self.brush.profiler = None
+
     def invoke(self, context, event):
         if context.area.type == 'VIEW_3D':
             # the arguments we pass the the callback
@@ -749,10 +1450,23 @@ class ModalDrawOperator(bpy.types.Operator):
 
             bpy.context.window.cursor_set("PAINT_BRUSH")
             
-            redraw_all_viewports(context)
+            self.start_profiling(context)
             self.history_clear(context)
-            self.history_snapshot(context)
-            self.history_snapshot(context, 0)
+            
+            #The object under the mouse is prepared first so brushing can start on it right away
+            objs = [obj for obj in context.selected_objects if obj.type == 'MESH']
+            mouse_pos = (event.mouse_region_x, event.mouse_region_y)
+            view_vector = view3d_utils.region_2d_to_vector_3d(context.region, context.region_data, mouse_pos)
+            ray_origin = view3d_utils.region_2d_to_origin_3d(context.region, context.region_data, mouse_pos)
+            result, location, normal, index, object, matrix = ray_cast(context, context.view_layer, ray_origin, view_vector)
+            if result and object in objs:
+                objs.remove(object)
+                objs.insert(0, object)
+            
+            self.start_startup(context, objs)
+            self.request_redraw(context)
+            self.start_recording(context)
+            self.start_journal(context)
 
             context.window_manager.modal_handler_add(self)
             return {'RUNNING_MODAL'}
@@ -762,6 +1476,74 @@ class ModalDrawOperator(bpy.types.Operator):
 
 #---------------------------
 
+#Apply every dab of a stroke file to the selected meshes
+#Returns (number of dabs, seconds spent dabbing)
+def replay_strokes(context, filepath):
+    brush = NormalBrush()
+    brush.replaying = True
+    settings = context.scene.normal_brush_props
+    dabs = 0
+    elapsed = 0
+    
+    for record in strokeRecord.read_strokes(filepath):
+        if record[0] == strokeRecord.REC_SETTINGS:
+            settings = record[1]
+            
+        elif record[0] == strokeRecord.REC_STROKE:
+            brush.end_stroke()
+            brush.begin_stroke(context, settings)
+            
+        elif record[0] == strokeRecord.REC_DAB:
+            t, ray_origin, view_vector, pressure = record[1:]
+            
+            start = time.perf_counter()
+            brush.dab(context, settings, ray_origin, view_vector, pressure)
+            elapsed += time.perf_counter() - start
+            dabs += 1
+            
+    brush.end_stroke()
+    return dabs, elapsed
+
+
+class ReplayStrokesOperator(bpy.types.Operator):
+    """Apply strokes recorded by the normal tool to the selected meshes"""
+    bl_idname = "kitfox.nt_replay_strokes"
+    bl_label = "Replay Strokes"
+    bl_options = {"REGISTER", "UNDO"}
+    
+    filepath : bpy.props.StringProperty(
+        name = "File Path", 
+        description = "Stroke file to replay", 
+        subtype = 'FILE_PATH'
+    )
+    
+    filter_glob : bpy.props.StringProperty(
+        default = "*.nbs", 
+        options = {'HIDDEN'}
+    )
+
+    def execute(self, context):
+        filepath = bpy.path.abspath(self.filepath)
+        try:
+            dabs, elapsed = replay_strokes(context, filepath)
+        except (OSError, ValueError) as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        
+        msg = "Replayed %d dabs in %.3f s" % (dabs, elapsed)
+        if dabs > 0:
+            msg += " (%.2f ms per dab)" % (1000 * elapsed / dabs)
+        self.report({'INFO'}, msg)
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        if not self.filepath:
+            self.filepath = context.scene.normal_brush_props.stroke_file
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+#---------------------------
+
 class NormalPickerOperator(bpy.types.Operator):
     """Pick normal"""
     bl_idname = "kitfox.nt_pick_normal"
@@ -858,20 +1640,46 @@ class NormalToolPropsPanel(bpy.types.Panel):
         scene = context.scene
         settings = scene.normal_brush_props
         
-        pcoll = preview_collections["main"]
-        
-        
         col = layout.column();
-        col.operator("kitfox.normal_tool", text="Start Normal Tool", icon_value = pcoll["normalTool"].icon_id)
+        col.operator("kitfox.normal_tool", text="Start Normal Tool", icon_value = tool_icon_id())
+        col.operator("kitfox.nt_brush_along_curve")
+        col.operator("kitfox.nt_fill_normals")
         
         col.prop(settings, "strength")
         col.prop(settings, "use_pressure")
+        if settings.use_pressure:
+            col.prop(settings, "pressure_curve")
+            if settings.pressure_curve == 'CUSTOM':
+                node = falloff.curve_node(falloff.PRESSURE_NODE)
+                if node != None:
+                    col.template_curve_mapping(node, "mapping")
         col.prop(settings, "normal_length")
+        col.prop(settings, "overlay_color")
+        if settings.overlay_color == 'DEVIATION':
+            col.prop(settings, "deviation_range")
         col.prop(settings, "radius")
+        col.prop(settings, "falloff_shape")
+        col.prop(settings, "falloff_distance")
+        if settings.falloff_shape == 'CUSTOM':
+            node = falloff.curve_node(falloff.FALLOFF_NODE)
+            if node != None:
+                col.template_curve_mapping(node, "mapping")
         col.prop(settings, "front_faces_only")
+        col.prop(settings, "visible_only")
+        col.prop(settings, "hover_preview")
 #        col.prop(settings, "selected_verts_only")
         col.prop(settings, "selected_faces_only")
         col.prop(settings, "use_shape_keys")
+        col.prop(settings, "use_evaluated")
+        col.prop(settings, "record_strokes")
+        if settings.record_strokes:
+            col.prop(settings, "stroke_file", text = "")
+        col.operator("kitfox.nt_replay_strokes")
+        col.prop(settings, "use_journal")
+        col.operator("kitfox.nt_recover_normals")
+        col.prop(settings, "profile")
+        if settings.profile:
+            col.prop(settings, "profile_file", text = "")
 
         col.label(text="Brush Type:")
         col.prop(settings, "brush_type", expand = True)
@@ -899,7 +1707,28 @@ class NormalToolPropsPanel(bpy.types.Panel):
             
         elif brush_type == "ATTRACT" or brush_type == "REPEL":
             col = layout.column();
-            col.prop(settings, "target")
+            row = col.row()
+            row.prop(settings, "target_mode", expand = True)
+            if settings.target_mode == 'COLLECTION':
+                col.prop(settings, "target_collection")
+                col.prop(settings, "target_weighting")
+            else:
+                col.prop(settings, "target")
+            
+        elif brush_type == "TRANSFER":
+            col = layout.column();
+            col.prop(settings, "transfer_source")
+            
+        elif brush_type == "COMB":
+            col = layout.column();
+            col.prop(settings, "comb_lag")
+            
+        elif brush_type == "SMOOTH":
+            col = layout.column();
+            col.prop(settings, "smooth_mode", expand = True)
+            if settings.smooth_mode == "RELAX":
+                col.prop(settings, "smooth_iterations")
+                col.prop(settings, "smooth_factor")
             
         
         
@@ -908,33 +1737,37 @@ class NormalToolPropsPanel(bpy.types.Panel):
 
 preview_collections = {}
 
+#Icon of the Start Normal Tool button.  Loaded on first panel draw rather than when the add-on is registered.
+def tool_icon_id():
+    pcoll = preview_collections.get("main")
+    if pcoll == None:
+        icon_path = "../icons"
+        if __name__ == "__main__":
+            icon_path = "../../source/icons"
+            
+        icons_dir = os.path.join(os.path.dirname(__file__), icon_path)
+        
+        pcoll = bpy.utils.previews.new()
+        pcoll.load("normalTool", os.path.join(icons_dir, "normalTool.png"), 'IMAGE')
+        preview_collections["main"] = pcoll
+    return pcoll["normalTool"].icon_id
+
 def register():
 
     bpy.utils.register_class(NormalToolSettings)
     bpy.utils.register_class(NormalPickerOperator)
     bpy.utils.register_class(ModalDrawOperator)
+    bpy.utils.register_class(ReplayStrokesOperator)
     bpy.utils.register_class(NormalToolPropsPanel)
 
     bpy.types.Scene.normal_brush_props = bpy.props.PointerProperty(type=NormalToolSettings)
 
-    #Load icons
-    icon_path = "../icons"
-    if __name__ == "__main__":
-        icon_path = "../../source/icons"
-        
-    icons_dir = os.path.join(os.path.dirname(__file__), icon_path)
-    
-    print("icons dir: " + str(icons_dir))
-    
-    pcoll = bpy.utils.previews.new()
-    pcoll.load("normalTool", os.path.join(icons_dir, "normalTool.png"), 'IMAGE')
-    preview_collections["main"] = pcoll
-
 
 def unregister():
     bpy.utils.unregister_class(NormalToolSettings)
     bpy.utils.unregister_class(NormalPickerOperator)
     bpy.utils.unregister_class(ModalDrawOperator)
+    bpy.utils.unregister_class(ReplayStrokesOperator)
     bpy.utils.unregister_class(NormalToolPropsPanel)
 
     del bpy.types.Scene.normal_brush_props
@@ -0,0 +1,107 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+from mathutils.bvhtree import BVHTree
+
+#A vertex is hidden if a ray from the eye hits something closer than this fraction of its distance.
+# Keeps the faces around the vertex itself from hiding it.
+SURFACE_TOLERANCE = 1e-3
+
+#States of a vertex in VisibilityCache
+UNKNOWN = -1
+HIDDEN = 0
+VISIBLE = 1
+
+
+#BVH in world space of the triangles of several meshes
+def build_occluder_bvh(caches):
+    coords = []
+    tris = []
+    offset = 0
+    for cache in caches:
+        world = cache.world_coords()
+        coords.append(world)
+        tris.append(cache.triangles() + offset)
+        offset += len(world)
+
+    if not coords:
+        return None
+    coords = np.concatenate(coords)
+    tris = np.concatenate(tris)
+    return BVHTree.FromPolygons(coords.tolist(), tris.tolist(), all_triangles = True)
+
+#Ray test from each origin to each point.  Returns a bool array that is True where nothing is in the way.
+def rays_clear(bvh, origins, points):
+    offset = points - origins
+    dist = np.linalg.norm(offset, axis = 1)
+    dirs = offset / np.where(dist > 0, dist, 1)[:, None]
+    limits = dist * (1 - SURFACE_TOLERANCE)
+
+    clear = np.ones(len(points), dtype = bool)
+    for i, (origin, dir, limit) in enumerate(zip(origins.tolist(), dirs.tolist(), limits.tolist())):
+        if limit > 0 and bvh.ray_cast(origin, dir, limit)[0] != None:
+            clear[i] = False
+    return clear
+
+
+class VisibilityCache:
+    """Which vertices can be seen from the eye, with the selected meshes as occluders.
+    Vertices are only ray tested when a dab first touches them, and the results are kept until the view or the geometry changes."""
+
+    def __init__(self):
+        self.bvh = None
+        self.bvh_key = None
+        self.view_key = None
+        self.states = {}
+
+    #caches - MeshCache of every mesh that can hide another
+    def update_occluders(self, caches):
+        key = tuple((cache.obj.name, cache.geometry) for cache in caches)
+        if key != self.bvh_key:
+            self.bvh = build_occluder_bvh(caches)
+            self.bvh_key = key
+            self.states = {}
+
+    #Forget stored results if the view changed
+    def update_view(self, view_key):
+        if view_key != self.view_key:
+            self.view_key = view_key
+            self.states = {}
+
+    #cache - MeshCache of the mesh being brushed
+    #verts, copies - vertex and symmetry copy of each pair to test
+    #origins - (copies, 3) world space eye position for each symmetry copy
+    #Returns a bool array that is True for the pairs that can be seen
+    def visible(self, cache, verts, copies, origins):
+        if self.bvh == None:
+            return np.ones(len(verts), dtype = bool)
+
+        key = cache.obj.name
+        states = self.states.get(key)
+        if states is None or states.shape != (len(origins), len(cache.coords)):
+            states = np.full((len(origins), len(cache.coords)), UNKNOWN, dtype = np.int8)
+            self.states[key] = states
+
+        unknown = states[copies, verts] == UNKNOWN
+        if np.any(unknown):
+            pairs = np.unique(np.stack((copies[unknown], verts[unknown]), axis = 1), axis = 0)
+            points = cache.world_coords()[pairs[:, 1]]
+            clear = rays_clear(self.bvh, origins[pairs[:, 0]], points)
+            states[pairs[:, 0], pairs[:, 1]] = np.where(clear, VISIBLE, HIDDEN)
+
+        return states[copies, verts] == VISIBLE
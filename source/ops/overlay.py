@@ -0,0 +1,157 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+from gpu_extras.batch import batch_for_shader
+
+UNIFORM_COLOR = (1, 1, 0, 1)
+
+#Loops drawn by each batch of the overlay.  The GPU module can only upload whole vertex
+# buffers, so a dab re-uploads just the batches holding the loops it changed.
+BATCH_LOOPS = 32768
+
+#Number of batches for count loops, which is also the number of times a full rebuild by
+# NormalOverlay.prepare_steps() yields
+def prepare_step_count(count):
+    return -(-count // BATCH_LOOPS)
+
+#Most batches uploaded in one redraw, so a huge mesh appears over a few frames rather than stalling one
+MAX_UPLOADS = 16
+
+#Color of a loop at full brush weight in the hover preview.  Loops fade to white as the weight drops.
+PREVIEW_COLOR = np.array((1, 0, 1, 1), dtype = np.float32)
+
+#Colors for no deviation, half the deviation range and the full range or more
+DEVIATION_RAMP = np.array([
+    (.2, .4, 1, 1),
+    (1, 1, 0, 1),
+    (1, 0, 0, 1)
+    ], dtype = np.float32)
+
+
+#Angle in radians between each pair of rows of a and b
+def deviation_angles(a, b):
+    dot = np.einsum('ij,ij->i', a, b)
+    lengths = np.linalg.norm(a, axis = 1) * np.linalg.norm(b, axis = 1)
+    cos = dot / np.where(lengths > 0, lengths, 1)
+    return np.arccos(np.clip(cos, -1, 1))
+
+#Color of each value of t in [0, 1] along DEVIATION_RAMP
+def ramp_colors(t):
+    x = np.clip(t, 0, 1) * (len(DEVIATION_RAMP) - 1)
+    idx = np.minimum(x.astype(np.int32), len(DEVIATION_RAMP) - 2)
+    frac = (x - idx)[:, None]
+    return (DEVIATION_RAMP[idx] * (1 - frac) + DEVIATION_RAMP[idx + 1] * frac).astype(np.float32)
+
+#Color of each loop in the overlay
+#loops - indices of the loops to color
+def loop_colors(cache, loops, color_mode, max_angle):
+    if color_mode == 'DEVIATION':
+        #Compared to the normal the Vertex brush would restore
+        angles = deviation_angles(cache.mesh_normals[loops], cache.vert_normals[cache.loop_verts[loops]])
+        return ramp_colors(angles / max(max_angle, 1e-6))
+    return np.tile(np.array(UNIFORM_COLOR, dtype = np.float32), (len(loops), 1))
+
+
+#Line segments and colors highlighting loops a dab would change, colored by brush weight.
+#Returns (lines, colors) for a batch of LINES
+def preview_lines(cache, loops, weights, length):
+    lines = np.empty((len(loops) * 2, 3), dtype = np.float32)
+    lines[0::2] = cache.coords[cache.loop_verts[loops]]
+    lines[1::2] = lines[0::2] + cache.mesh_normals[loops] * length
+
+    t = np.clip(weights, 0, 1)[:, None]
+    colors = (1 - t) * np.ones(4, dtype = np.float32) + t * PREVIEW_COLOR
+    return lines, np.repeat(colors.astype(np.float32), 2, axis = 0)
+
+
+class NormalOverlay:
+    """Lines showing the normals of one cached mesh.  Vertex arrays are kept between frames and only
+    the loops changed since the last update are recalculated and uploaded."""
+
+    def __init__(self):
+        self.key = None
+        self.revision = None
+        self.lines = None
+        self.colors = None
+        self.batches = []
+        self.dirty = set()
+
+    #True if some batches are waiting to be uploaded
+    @property
+    def pending(self):
+        return len(self.dirty) > 0
+
+    #Recalculate the vertex arrays for loops changed since the last call.  Does no GPU work,
+    # so it can run outside of drawing.
+    def prepare(self, cache, length, color_mode, max_angle):
+        for step in self.prepare_steps(cache, length, color_mode, max_angle):
+            pass
+
+    #prepare() a step at a time.  A full rebuild yields after each batch of BATCH_LOOPS loops.
+    def prepare_steps(self, cache, length, color_mode, max_angle):
+        key = (cache.geometry, length, color_mode, max_angle)
+        revision = cache.revision
+        if key == self.key and revision == self.revision:
+            return
+
+        loops = None
+        if key == self.key:
+            loops = cache.changed_since(self.revision)
+
+        if loops is None:
+            count = len(cache.loop_verts)
+            lines = np.empty((count * 2, 3), dtype = np.float32)
+            #The shader's color attribute is 32 bit, so the array must be too
+            colors = np.empty((count * 2, 4), dtype = np.float32)
+            for start in range(0, count, BATCH_LOOPS):
+                batch = np.arange(start, min(start + BATCH_LOOPS, count))
+                lines[start * 2:start * 2 + len(batch) * 2] = cache.normal_lines(length, batch)
+                colors[start * 2:start * 2 + len(batch) * 2] = np.repeat(loop_colors(cache, batch, color_mode, max_angle), 2, axis = 0)
+                yield
+            self.lines = lines
+            self.colors = colors
+            batches = prepare_step_count(count)
+            #Old batches are drawn until their replacements are uploaded
+            if len(self.batches) != batches:
+                self.batches = [None] * batches
+            self.dirty = set(range(batches))
+        else:
+            self.lines[loops * 2 + 1] = self.lines[loops * 2] + cache.mesh_normals[loops] * length
+            colors = loop_colors(cache, loops, color_mode, max_angle)
+            self.colors[loops * 2] = colors
+            self.colors[loops * 2 + 1] = colors
+            self.dirty.update(np.unique(loops // BATCH_LOOPS).tolist())
+
+        #Normals changed while a rebuild was under way are picked up by the next call
+        self.key = key
+        self.revision = revision
+
+    #Upload up to max_uploads of the batches waiting for it and return every batch that can be drawn
+    #shader - must take 'pos' and 'color' attributes
+    def upload(self, shader, max_uploads = MAX_UPLOADS):
+        for i in sorted(self.dirty)[:max_uploads]:
+            start = i * BATCH_LOOPS * 2
+            end = start + BATCH_LOOPS * 2
+            self.batches[i] = batch_for_shader(shader, 'LINES', {"pos": self.lines[start:end], "color": self.colors[start:end]})
+            self.dirty.discard(i)
+        return [b for b in self.batches if b != None]
+
+    #List of line batches for shader, updated for changes to cache
+    def update(self, cache, shader, length, color_mode, max_angle):
+        self.prepare(cache, length, color_mode, max_angle)
+        return self.upload(shader)
@@ -0,0 +1,121 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import collections
+import contextlib
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+
+#Time a block of code if profiler is not None
+def phase(profiler, name):
+    if profiler == None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+#Run the generator steps, timing each step as the named phase.  Yields after each step and
+# returns the generator's return value.
+def phase_steps(profiler, name, steps):
+    while True:
+        with phase(profiler, name):
+            try:
+                next(steps)
+            except StopIteration as stop:
+                return stop.value
+        yield
+
+
+class Profiler:
+    """Records how long each phase of a dab or a redraw takes."""
+
+    def __init__(self, window = 120):
+        self.window = window
+        self.records = []
+        self.recent = {}
+        self.current = None
+        self.start_time = time.perf_counter()
+        self.event_start = None
+        #Names of the phases currently running, outermost first
+        self.open_phases = []
+
+    #Start timing one event of the given kind (eg, 'dab' or 'frame')
+    def begin(self, kind):
+        self.event_start = time.perf_counter()
+        self.current = {"kind": kind, "time": self.event_start - self.start_time, "phases": {}, "counts": {}}
+
+    #A phase started inside another is recorded under both names, eg 'brush/geodesic', since its
+    # time is also part of the outer phase
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.open_phases.append(name)
+        full_name = "/".join(self.open_phases)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.open_phases.pop()
+            if self.current != None:
+                phases = self.current["phases"]
+                phases[full_name] = phases.get(full_name, 0) + time.perf_counter() - start
+
+    def count(self, name, n):
+        if self.current != None:
+            counts = self.current["counts"]
+            counts[name] = counts.get(name, 0) + n
+
+    def end(self):
+        record = self.current
+        if record == None:
+            return
+        self.current = None
+
+        #Wall time of the whole event, including any time outside of a phase
+        record["phases"]["total"] = time.perf_counter() - self.event_start
+        self.records.append(record)
+
+        for name, secs in record["phases"].items():
+            key = (record["kind"], name)
+            if key not in self.recent:
+                self.recent[key] = collections.deque(maxlen = self.window)
+            self.recent[key].append(secs)
+
+    #Rolling statistics as a list of (kind, phase, mean ms, p95 ms)
+    def stats(self):
+        result = []
+        for (kind, name), values in sorted(self.recent.items()):
+            ms = np.array(values) * 1000
+            result.append((kind, name, float(ms.mean()), float(np.percentile(ms, 95))))
+        return result
+
+    #Write every record to a .csv or .json file
+    def dump(self, filepath):
+        if os.path.splitext(filepath)[1].lower() == ".csv":
+            phases = sorted({p for r in self.records for p in r["phases"]})
+            counts = sorted({c for r in self.records for c in r["counts"]})
+            with open(filepath, 'w', newline = '') as f:
+                writer = csv.writer(f)
+                writer.writerow(["kind", "time"] + [p + "_ms" for p in phases] + counts)
+                for r in self.records:
+                    writer.writerow([r["kind"], "%.6f" % r["time"]]
+                        + ["%.4f" % (r["phases"][p] * 1000) if p in r["phases"] else "" for p in phases]
+                        + [r["counts"].get(c, "") for c in counts])
+        else:
+            with open(filepath, 'w') as f:
+                json.dump({"records": self.records, "stats": self.stats()}, f, indent = 1)
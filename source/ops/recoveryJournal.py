@@ -0,0 +1,283 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import mmap
+import os
+import struct
+import time
+import numpy as np
+
+from bpy.app.handlers import persistent
+
+from . import meshArrays
+from . import normalLayers
+
+#The journal is a header followed by a stream of records.  Each record is a one byte type and a
+# uint32 payload length.  The header holds the offset of the end of the last complete record and
+# is only updated after a record is written, so a crash while writing loses at most that record.
+#   SESSION - empty.  The normal tool was started.
+#   STROKE  - normals of one object after a stroke: uint16 name length, utf-8 object name,
+#             uint32 loops in the mesh, uint32 n, n int32 loop indices, n * 3 float32 normals
+#   CANCEL  - empty.  The session was cancelled, so its strokes should not be recovered.
+#   FINISH  - empty.  The session ended normally.
+
+MAGIC = b'KNBJ'
+VERSION = 1
+
+REC_SESSION = 1
+REC_STROKE = 2
+REC_CANCEL = 3
+REC_FINISH = 4
+
+HEADER_FORMAT = struct.Struct('<4sIQ')
+RECORD_FORMAT = struct.Struct('<BI')
+NAME_FORMAT = struct.Struct('<H')
+STROKE_FORMAT = struct.Struct('<II')
+
+INITIAL_SIZE = 1 << 20
+#Seconds between flushes of the mapped file to disk
+FLUSH_INTERVAL = 2
+
+JOURNAL_EXT = ".nbj"
+
+#Journals currently being written, so saving the .blend does not delete them
+_open_journals = set()
+
+
+#Journal file for the current .blend, or None if it has not been saved yet
+def journal_path():
+    if not bpy.data.filepath:
+        return None
+    return os.path.splitext(bpy.data.filepath)[0] + JOURNAL_EXT
+
+
+class Journal:
+    """Append-only record of the normals changed by each stroke.  The file is memory mapped, so
+    writing a stroke costs time proportional to the loops it changed."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        exists = os.path.exists(filepath) and os.path.getsize(filepath) >= HEADER_FORMAT.size
+
+        self.file = open(filepath, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(INITIAL_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        if exists:
+            magic, version, end = HEADER_FORMAT.unpack_from(self.map, 0)
+            if magic != MAGIC or version > VERSION:
+                self.close()
+                raise ValueError("Not a normal brush journal: " + filepath)
+            self.end = end
+        else:
+            self.end = HEADER_FORMAT.size
+            self.commit()
+
+        self.last_flush = time.perf_counter()
+        #True if records were written since the last flush
+        self.unflushed = False
+        _open_journals.add(os.path.abspath(filepath))
+
+    def commit(self):
+        HEADER_FORMAT.pack_into(self.map, 0, MAGIC, VERSION, self.end)
+
+    #Make sure there is room for size more bytes, growing the file if needed
+    def reserve(self, size):
+        if self.end + size > len(self.map):
+            new_size = max(len(self.map) * 2, self.end + size)
+            self.map.close()
+            self.file.truncate(new_size)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def append(self, rec_type, payload = b''):
+        size = RECORD_FORMAT.size + len(payload)
+        self.reserve(size)
+
+        pos = self.end
+        RECORD_FORMAT.pack_into(self.map, pos, rec_type, len(payload))
+        self.map[pos + RECORD_FORMAT.size:pos + size] = payload
+        self.end = pos + size
+        self.commit()
+        self.unflushed = True
+        self.flush_if_due()
+
+    def flush(self):
+        self.map.flush()
+        self.last_flush = time.perf_counter()
+        self.unflushed = False
+
+    #Flush records written more than FLUSH_INTERVAL ago.  Also called from a timer so the last
+    # records before the user stops working reach the disk.
+    def flush_if_due(self):
+        if self.unflushed and time.perf_counter() - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def begin_session(self):
+        self.append(REC_SESSION)
+
+    #Record the current normals of some loops of a cached mesh, as written to the mesh
+    def write_stroke(self, cache, loops):
+        name = cache.obj.name.encode('utf-8')
+        loops = np.asarray(loops, dtype = np.int32)
+        payload = b''.join((
+            NAME_FORMAT.pack(len(name)), name,
+            STROKE_FORMAT.pack(len(cache.mesh_normals), len(loops)),
+            loops.tobytes(),
+            cache.mesh_normals[loops].astype(np.float32).tobytes()))
+        self.append(REC_STROKE, payload)
+
+    #cancelled - if True the strokes of this session will not be recovered
+    def end_session(self, cancelled):
+        self.append(REC_CANCEL if cancelled else REC_FINISH)
+
+    def close(self):
+        if self.map != None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        self.file.close()
+        _open_journals.discard(os.path.abspath(self.filepath))
+
+
+#Iterate over the records of a journal.  Yields one of
+#   (REC_SESSION, None), (REC_CANCEL, None), (REC_FINISH, None)
+#   (REC_STROKE, (object name, loop count, loops, normals))
+def read_journal(filepath):
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    magic, version, end = HEADER_FORMAT.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a normal brush journal: " + filepath)
+    if version > VERSION:
+        raise ValueError("Unsupported journal version " + str(version))
+
+    pos = HEADER_FORMAT.size
+    while pos < end:
+        rec_type, length = RECORD_FORMAT.unpack_from(data, pos)
+        pos += RECORD_FORMAT.size
+
+        if rec_type == REC_STROKE:
+            p = pos
+            (name_len,) = NAME_FORMAT.unpack_from(data, p)
+            p += NAME_FORMAT.size
+            name = data[p:p + name_len].decode('utf-8')
+            p += name_len
+            loop_count, n = STROKE_FORMAT.unpack_from(data, p)
+            p += STROKE_FORMAT.size
+            loops = np.frombuffer(data, dtype = np.int32, count = n, offset = p)
+            p += n * 4
+            normals = np.frombuffer(data, dtype = np.float32, count = n * 3, offset = p).reshape(-1, 3)
+            yield (REC_STROKE, (name, loop_count, loops, normals))
+        else:
+            yield (rec_type, None)
+
+        pos += length
+
+#Strokes of every session that was not cancelled, in the order they were made
+def recoverable_strokes(filepath):
+    strokes = []
+    session = []
+    for rec_type, data in read_journal(filepath):
+        if rec_type == REC_SESSION:
+            strokes.extend(session)
+            session = []
+        elif rec_type == REC_STROKE:
+            session.append(data)
+        elif rec_type == REC_CANCEL:
+            session = []
+    strokes.extend(session)
+    return strokes
+
+#Apply the strokes in a journal to the meshes of the current file.  Each mesh is written once.
+#Returns (objects changed, objects skipped because they are missing or their topology changed)
+def recover_normals(filepath):
+    normals = {}
+    skipped = set()
+    for name, loop_count, loops, values in recoverable_strokes(filepath):
+        obj = bpy.data.objects.get(name)
+        if obj == None or obj.type != 'MESH' or len(obj.data.loops) != loop_count:
+            skipped.add(name)
+            continue
+
+        if name not in normals:
+            normals[name] = (meshArrays.read_loop_normals(obj.data), set())
+        normals[name][0][loops] = values
+        normals[name][1].update(loops.tolist())
+
+    for name, (values, loops) in normals.items():
+        mesh = bpy.data.objects[name].data
+        loops = np.array(sorted(loops), dtype = np.int64)
+        if not normalLayers.write_active_layer(mesh, loops, values[loops]):
+            meshArrays.write_loop_normals(mesh, values)
+
+    return len(normals), len(skipped)
+
+
+#Once the .blend is saved its journal has nothing left to recover
+@persistent
+def delete_saved_journal(dummy):
+    filepath = journal_path()
+    if filepath != None and os.path.abspath(filepath) not in _open_journals and os.path.exists(filepath):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+
+#---------------------------
+
+class RecoverNormalsOperator(bpy.types.Operator):
+    """Apply the normal edits saved in the crash recovery journal of this file."""
+    bl_idname = "kitfox.nt_recover_normals"
+    bl_label = "Recover Normals"
+    bl_options = {"REGISTER", "UNDO"}
+
+    @classmethod
+    def poll(cls, context):
+        filepath = journal_path()
+        return filepath != None and os.path.exists(filepath) and context.mode == 'OBJECT'
+
+    def execute(self, context):
+        filepath = journal_path()
+        try:
+            changed, skipped = recover_normals(filepath)
+        except (OSError, ValueError, struct.error) as e:
+            self.report({"WARNING"}, "Could not read journal: " + str(e))
+            return {'CANCELLED'}
+
+        if skipped:
+            self.report({"WARNING"}, "Recovered normals of %d objects.  %d objects were missing or changed and were skipped" % (changed, skipped))
+        else:
+            self.report({"INFO"}, "Recovered normals of %d objects" % changed)
+        return {'FINISHED'}
+
+#---------------------------
+
+def register():
+    bpy.utils.register_class(RecoverNormalsOperator)
+    bpy.app.handlers.save_post.append(delete_saved_journal)
+
+
+def unregister():
+    bpy.utils.unregister_class(RecoverNormalsOperator)
+    bpy.app.handlers.save_post.remove(delete_saved_journal)
+
+
+if __name__ == "__main__":
+    register()
@@ -0,0 +1,164 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import mathutils
+import json
+import struct
+import time
+
+#Stroke files are a header followed by a stream of records.  Each record starts with a one byte type.
+#   SETTINGS - uint32 length followed by a utf-8 json dictionary of brush settings.  Written at
+#              the start of a stroke, or when the tool changes them mid-stroke, only if they differ
+#              from the last ones written.  Apply to every dab after it.
+#   STROKE   - double timestamp.  Marks the pen going down.
+#   DAB      - double timestamp, ray origin (3 floats), ray direction (3 floats), pressure (float)
+
+MAGIC = b'KNBS'
+VERSION = 1
+
+REC_SETTINGS = 1
+REC_STROKE = 2
+REC_DAB = 3
+
+HEADER_FORMAT = struct.Struct('<4sI')
+TYPE_FORMAT = struct.Struct('<B')
+LENGTH_FORMAT = struct.Struct('<I')
+STROKE_FORMAT = struct.Struct('<d')
+DAB_FORMAT = struct.Struct('<d7f')
+
+
+#Convert brush settings into a dictionary of plain values.  Objects and collections are stored by name.
+def settings_to_dict(settings):
+    values = {}
+    for prop in settings.bl_rna.properties:
+        name = prop.identifier
+        if name in ("rna_type", "name"):
+            continue
+
+        value = getattr(settings, name)
+        if prop.type == 'POINTER':
+            if isinstance(value, bpy.types.Object):
+                value = value.name
+            elif isinstance(value, bpy.types.Collection):
+                value = {"collection": value.name}
+            elif value != None:
+                continue
+        elif getattr(prop, "is_array", False):
+            value = list(value)
+
+        values[name] = value
+    return values
+
+
+class SettingsSnapshot:
+    """Brush settings read back from a stroke file.  Has the same attributes as NormalToolSettings."""
+
+    def __init__(self, values):
+        for name, value in values.items():
+            if isinstance(value, list):
+                value = mathutils.Vector(value)
+            setattr(self, name, value)
+
+    def __getattribute__(self, name):
+        value = object.__getattribute__(self, name)
+        if name in ("target", "transfer_source") and isinstance(value, str):
+            return bpy.data.objects.get(value)
+        if isinstance(value, dict) and "collection" in value:
+            return bpy.data.collections.get(value["collection"])
+        return value
+
+    #Settings not present in older files fall back to the current scene settings
+    def __getattr__(self, name):
+        return getattr(bpy.context.scene.normal_brush_props, name)
+
+
+#---------------------------
+
+class StrokeRecorder:
+    """Writes dabs made by the normal tool to a stroke file."""
+
+    def __init__(self, filepath):
+        self.file = open(filepath, 'wb')
+        self.file.write(HEADER_FORMAT.pack(MAGIC, VERSION))
+        self.start_time = time.perf_counter()
+        self.last_settings = None
+
+    def timestamp(self):
+        return time.perf_counter() - self.start_time
+
+    #Write the settings if they differ from the last ones written.  Reading them is slow, so this
+    # is done at the start of each stroke and when the tool changes them itself, not for every dab.
+    def record_settings(self, settings):
+        blob = json.dumps(settings_to_dict(settings), sort_keys = True).encode('utf-8')
+        if blob != self.last_settings:
+            self.file.write(TYPE_FORMAT.pack(REC_SETTINGS))
+            self.file.write(LENGTH_FORMAT.pack(len(blob)))
+            self.file.write(blob)
+            self.last_settings = blob
+
+    def begin_stroke(self, settings):
+        self.record_settings(settings)
+        self.file.write(TYPE_FORMAT.pack(REC_STROKE))
+        self.file.write(STROKE_FORMAT.pack(self.timestamp()))
+
+    def record_dab(self, ray_origin, view_vector, pressure):
+        self.file.write(TYPE_FORMAT.pack(REC_DAB))
+        self.file.write(DAB_FORMAT.pack(self.timestamp(), *ray_origin, *view_vector, pressure))
+
+    def close(self):
+        self.file.close()
+
+
+#Iterate over the records of a stroke file.  Yields one of
+#   (REC_SETTINGS, SettingsSnapshot)
+#   (REC_STROKE, timestamp)
+#   (REC_DAB, timestamp, ray_origin, view_vector, pressure)
+def read_strokes(filepath):
+    with open(filepath, 'rb') as f:
+        data = f.read()
+
+    magic, version = HEADER_FORMAT.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a normal brush stroke file: " + filepath)
+    if version > VERSION:
+        raise ValueError("Unsupported stroke file version " + str(version))
+
+    pos = HEADER_FORMAT.size
+    while pos < len(data):
+        (rec_type,) = TYPE_FORMAT.unpack_from(data, pos)
+        pos += TYPE_FORMAT.size
+
+        if rec_type == REC_SETTINGS:
+            (length,) = LENGTH_FORMAT.unpack_from(data, pos)
+            pos += LENGTH_FORMAT.size
+            values = json.loads(data[pos:pos + length].decode('utf-8'))
+            pos += length
+            yield (REC_SETTINGS, SettingsSnapshot(values))
+
+        elif rec_type == REC_STROKE:
+            (timestamp,) = STROKE_FORMAT.unpack_from(data, pos)
+            pos += STROKE_FORMAT.size
+            yield (REC_STROKE, timestamp)
+
+        elif rec_type == REC_DAB:
+            t, ox, oy, oz, dx, dy, dz, pressure = DAB_FORMAT.unpack_from(data, pos)
+            pos += DAB_FORMAT.size
+            yield (REC_DAB, t, mathutils.Vector((ox, oy, oz)), mathutils.Vector((dx, dy, dz)), pressure)
+
+        else:
+            raise ValueError("Corrupt stroke file: unknown record type " + str(rec_type))
+
@@ -0,0 +1,245 @@
+# This file is part of the Kitfox Normal Brush distribution (https://github.com/blackears/blenderNormalBrush).
+# Copyright (c) 2021 Mark McKay
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import bpy
+import numpy as np
+
+from mathutils.bvhtree import BVHTree
+
+from . import meshArrays
+from . import normalLayers
+
+#Number of nearest point queries made between progress updates
+CHUNK_SIZE = 65536
+
+#Each loop is sampled this fraction of the way from its vertex to the center of its face, so
+# loops of a vertex on a hard edge find the source surface on their own side of the edge
+LOOP_OFFSET = 1e-3
+
+
+#Barycentric coordinates of points p in triangles (a, b, c).  All arrays are (n, 3).
+def barycentric(p, a, b, c):
+    v0 = b - a
+    v1 = c - a
+    v2 = p - a
+    d00 = np.einsum('ij,ij->i', v0, v0)
+    d01 = np.einsum('ij,ij->i', v0, v1)
+    d11 = np.einsum('ij,ij->i', v1, v1)
+    d20 = np.einsum('ij,ij->i', v2, v0)
+    d21 = np.einsum('ij,ij->i', v2, v1)
+
+    denom = d00 * d11 - d01 * d01
+    degenerate = np.abs(denom) < 1e-20
+    denom[degenerate] = 1
+
+    v = (d11 * d20 - d01 * d21) / denom
+    w = (d00 * d21 - d01 * d20) / denom
+    v[degenerate] = 0
+    w[degenerate] = 0
+    u = 1 - v - w
+
+    return np.stack((u, v, w), axis = 1)
+
+#Position each loop is sampled at, in the local space of its mesh
+def loop_sample_points(coords, loop_verts, loop_polys, poly_centers):
+    corners = coords[loop_verts].astype(np.float64)
+    return corners + (poly_centers[loop_polys] - corners) * LOOP_OFFSET
+
+#---------------------------
+
+class NormalSampler:
+    """Interpolates the split normals of a source object at the point nearest to a query position.
+    The surface is kept in world space so distances are measured the same way for every source,
+    whatever its scale."""
+
+    def __init__(self, obj, depsgraph):
+        self.source = obj
+        self.matrix_world = obj.matrix_world.copy()
+
+        obj_eval = obj.evaluated_get(depsgraph)
+        mesh = obj_eval.to_mesh()
+        try:
+            coords = meshArrays.read_vertex_coords(mesh)
+            tri_loops, tri_verts = meshArrays.read_loop_triangles(mesh)
+            loop_normals = meshArrays.read_loop_normals(mesh)
+        finally:
+            obj_eval.to_mesh_clear()
+
+        coords = meshArrays.transform_points(self.matrix_world, coords.astype(np.float64))
+        self.tri_coords = coords[tri_verts]
+        #Normals stay in local space until they are interpolated
+        self.tri_normals = loop_normals[tri_loops].astype(np.float64)
+        self.bvh = BVHTree.FromPolygons(coords.tolist(), tri_verts.tolist(), all_triangles = True)
+
+    #points - (n, 3) array of world space positions
+    #max_distance - ignore surface further than this.  Zero for no limit.
+    #progress - optional callback taking the number of points processed so far
+    #Returns (normals, valid) where normals are unit length world space vectors
+    def sample(self, points, max_distance = 0, progress = None):
+        points = np.asarray(points, dtype = np.float64)
+        count = len(points)
+
+        normals = np.zeros((count, 3))
+        valid = np.zeros(count, dtype = bool)
+
+        find_nearest = self.bvh.find_nearest
+
+        for start in range(0, count, CHUNK_SIZE):
+            chunk = points[start:start + CHUNK_SIZE]
+
+            if max_distance > 0:
+                hits = [find_nearest(co, max_distance) for co in chunk.tolist()]
+            else:
+                hits = [find_nearest(co) for co in chunk.tolist()]
+
+            tri_idx = np.fromiter((-1 if h[2] is None else h[2] for h in hits), dtype = np.int64, count = len(hits))
+            hit = tri_idx >= 0
+            if np.any(hit):
+                tris = tri_idx[hit]
+                locs = np.array([h[0] for h in hits if h[2] is not None], dtype = np.float64)
+
+                corners = self.tri_coords[tris]
+                weights = barycentric(locs, corners[:, 0], corners[:, 1], corners[:, 2])
+
+                interp = np.einsum('ij,ijk->ik', weights, self.tri_normals[tris])
+
+                normals[start:start + len(chunk)][hit] = interp
+                valid[start:start + len(chunk)][hit] = True
+
+            if progress != None:
+                progress(start + len(chunk))
+
+        normals[valid] = meshArrays.transform_normals(self.matrix_world, normals[valid])
+        valid &= np.any(normals != 0, axis = 1)
+
+        return normals, valid
+
+    #Sample normals at positions in the local space of obj
+    #Returns (normals, valid) with normals in the local space of obj
+    def sample_vertices(self, obj, coords, max_distance = 0, progress = None):
+        world = meshArrays.transform_points(obj.matrix_world, coords)
+        normals, valid = self.sample(world, max_distance, progress)
+        normals[valid] = meshArrays.transform_normals(obj.matrix_world.inverted(), normals[valid])
+        return normals, valid
+
+
+#---------------------------
+
+class TransferNormalsOperator(bpy.types.Operator):
+    """Copy normals from the nearest surface of the active mesh to selected meshes."""
+    bl_idname = "kitfox.nt_transfer_normals"
+    bl_label = "Transfer Normals"
+    bl_options = {"REGISTER", "UNDO"}
+
+    max_distance : bpy.props.FloatProperty(
+        name = "Max Distance",
+        description = "Loops further than this from the source surface are left unchanged.  Zero for no limit",
+        default = 0,
+        min = 0,
+        subtype = 'DISTANCE'
+    )
+
+    selected_faces_only : bpy.props.BoolProperty(
+        name = "Selected Faces Only",
+        description = "If true, only transfer onto selected faces",
+        default = False
+    )
+
+    def execute(self, context):
+        source = context.active_object
+        if source == None or not source.type == 'MESH':
+            self.report({"WARNING"}, "Active object is not a mesh")
+            return {'CANCELLED'}
+
+        targets = [p for p in context.selected_objects if p.type == 'MESH' and p != source]
+        if not targets:
+            self.report({"WARNING"}, "No objects to transfer to selected")
+            return {'CANCELLED'}
+
+        sampler = NormalSampler(source, context.evaluated_depsgraph_get())
+
+        wm = context.window_manager
+        total = sum(len(obj.data.loops) for obj in targets)
+        wm.progress_begin(0, max(total, 1))
+        done = 0
+
+        try:
+            for obj in targets:
+                mesh = obj.data
+                loop_verts = meshArrays.read_loop_vertex_indices(mesh)
+                loop_polys = meshArrays.read_loop_polygon_indices(mesh)
+                loop_normals = meshArrays.read_loop_normals(mesh)
+
+                loops = np.arange(len(loop_verts))
+                if self.selected_faces_only:
+                    poly_select = meshArrays.read_polygon_select(mesh)
+                    loops = loops[poly_select[loop_polys]]
+
+                #Every loop is sampled, so split normals on the target keep one value per face corner
+                points = loop_sample_points(meshArrays.read_vertex_coords(mesh), loop_verts[loops], loop_polys[loops],
+                    meshArrays.read_polygon_centers(mesh))
+
+                progress = lambda n, base = done: wm.progress_update(base + n)
+                normals, valid = sampler.sample_vertices(obj, points, self.max_distance, progress)
+                done += len(mesh.loops)
+
+                if normalLayers.write_active_layer(mesh, loops[valid], normals[valid]):
+                    continue
+                new_normals = loop_normals.astype(np.float64)
+                new_normals[loops[valid]] = normals[valid]
+
+                meshArrays.write_loop_normals(mesh, new_normals)
+        finally:
+            wm.progress_end()
+
+        return {'FINISHED'}
+
+#---------------------------
+
+class TransferNormalsPropsPanel(bpy.types.Panel):
+
+    """Properties Panel for transferring normals on tool shelf"""
+    bl_label = "Transfer Normals"
+    bl_idname = "OBJECT_PT_transfer_normals_props"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = "Kitfox - Normal"
+
+
+    def draw(self, context):
+        layout = self.layout
+
+        col = layout.column();
+        col.operator("kitfox.nt_transfer_normals")
+        col.operator("kitfox.nt_export_normals")
+        col.operator("kitfox.nt_import_normals")
+        col.operator("kitfox.nt_bake_normal_map")
+
+
+#---------------------------
+
+def register():
+    bpy.utils.register_class(TransferNormalsOperator)
+    bpy.utils.register_class(TransferNormalsPropsPanel)
+
+
+def unregister():
+    bpy.utils.unregister_class(TransferNormalsOperator)
+    bpy.utils.unregister_class(TransferNormalsPropsPanel)
+
+
+if __name__ == "__main__":
+    register()
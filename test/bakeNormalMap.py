@@ -0,0 +1,29 @@
+# Bake the custom normals of a mesh in a .blend to a tangent space normal map without a GPU.
+#
+#   blender -b scene.blend -P test/bakeNormalMap.py -- object output.png [size] [processes]
+
+#Worker processes may run this file again under another name, so nothing happens unless it is the main script
+def main():
+    import bpy
+    import sys
+
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if len(argv) < 2:
+        print("usage: blender -b scene.blend -P bakeNormalMap.py -- object output.png [size] [processes]")
+        sys.exit(1)
+
+    obj = bpy.data.objects.get(argv[0])
+    if obj == None or obj.type != 'MESH':
+        print("No mesh object named " + argv[0])
+        sys.exit(1)
+
+    size = int(argv[2]) if len(argv) > 2 else 1024
+    processes = int(argv[3]) if len(argv) > 3 else 0
+
+    bpy.context.view_layer.objects.active = obj
+    result = bpy.ops.kitfox.nt_bake_normal_map(width = size, height = size, processes = processes, filepath = argv[1])
+    if result != {'FINISHED'}:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+# Replay a recorded stroke file on the selected meshes of a .blend and report timing.
+#
+#   blender -b scene.blend -P test/replayBenchmark.py -- strokes.nbs [repeat count]
+
+import bpy
+import sys
+
+argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+if not argv:
+    print("usage: blender -b scene.blend -P replayBenchmark.py -- strokes.nbs [repeat count]")
+    sys.exit(1)
+
+filepath = argv[0]
+repeat = int(argv[1]) if len(argv) > 1 else 1
+
+for i in range(repeat):
+    result = bpy.ops.kitfox.nt_replay_strokes(filepath = filepath)
+    if result != {'FINISHED'}:
+        sys.exit(1)